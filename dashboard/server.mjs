@@ -1,3 +1,5 @@
+import { createHash } from 'crypto'
+import fs from 'fs'
 import path from 'path'
 import { fileURLToPath } from 'url'
 
@@ -26,7 +28,28 @@ const ALLOW_ORIGINS = (process.env.DASHBOARD_CORS_ORIGINS || '*')
   .map((s) => s.trim())
   .filter(Boolean)
 
-const db = new Database(DB_PATH, { readonly: true, fileMustExist: false })
+const openDb = () => new Database(DB_PATH, { readonly: true, fileMustExist: false })
+const dbInode = () => {
+  try {
+    return fs.statSync(DB_PATH).ino
+  } catch {
+    return null
+  }
+}
+
+let db = openDb()
+let openedInode = dbInode()
+
+// DASHBOARD_DB_PATH may point at the bot's backup replica, which is replaced
+// by a rename: reopen once the path leads to a different file
+const refreshDb = () => {
+  const inode = dbInode()
+  if (inode === null || inode === openedInode) return false
+  db.close()
+  db = openDb()
+  openedInode = inode
+  return true
+}
 
 const app = express()
 app.use(cors({ origin: ALLOW_ORIGINS.includes('*') ? '*' : ALLOW_ORIGINS }))
@@ -242,23 +265,59 @@ const paymentTimestamp = (row) =>
   parseEnd(row.updated_at) ||
   parseEnd(row.created_at)
 
+const kyivDay = (parts) =>
+  `${parts.year}-${String(parts.month).padStart(2, '0')}-${String(parts.day).padStart(2, '0')}`
+
+// revenue_daily is keyed by Kyiv date and maintained by the bot when a payment turns paid
+const revenueMonthFromRollup = (now) => {
+  const kyivNow = getKyivParts(now)
+  const row = db
+    .prepare('SELECT COALESCE(SUM(amount), 0) AS total FROM revenue_daily WHERE day >= ? AND day <= ?')
+    .get(kyivDay({ ...kyivNow, day: 1 }), kyivDay({ ...kyivNow, day: 31 }))
+  return Number(row?.total || 0)
+}
+
+// databases not yet migrated by the bot have no rollup, scan the paid payments
+const revenueMonthFromPayments = (hasPayments, now) => {
+  if (!hasPayments) return 0
+  const { start: monthStart, end: monthEnd } = getKyivMonthBounds(now)
+  return db
+    .prepare("SELECT * FROM payments WHERE status = 'paid'")
+    .all()
+    .reduce((acc, row) => {
+      const ts = paymentTimestamp(row)
+      if (!ts) return acc
+      if (ts < monthStart || ts >= monthEnd) return acc
+      return acc + Number(row.amount || 0)
+    }, 0)
+}
+
 const buildSnapshot = ({ paymentsLimit, expiringDays, includeNonUser }) => {
   const hasUsers = tableExists('users')
   const hasPayments = tableExists('payments')
   const hasSettings = tableExists('settings')
+  const hasChannels = tableExists('channels')
 
   const usersRaw = hasUsers ? db.prepare('SELECT * FROM users').all() : []
   const paymentsRaw = hasPayments
     ? db.prepare('SELECT * FROM payments ORDER BY created_at DESC LIMIT ?').all(paymentsLimit)
     : []
-  const paymentsPaidAll = hasPayments
-    ? db.prepare("SELECT * FROM payments WHERE status = 'paid'").all()
-    : []
+  const hasRevenueDaily = tableExists('revenue_daily')
   const latestPaid = latestPaidByUser(paymentsRaw)
+  const hasUserPlans = tableExists('user_plans')
+  const plansByUser = new Map()
+  if (hasUserPlans) {
+    for (const row of db.prepare('SELECT telegram_id, plan FROM user_plans ORDER BY rowid').all()) {
+      if (!plansByUser.has(row.telegram_id)) plansByUser.set(row.telegram_id, [])
+      plansByUser.get(row.telegram_id).push(row.plan)
+    }
+  }
 
   const now = new Date()
   const usersAll = usersRaw.map((row) => {
-    const plans = safeJson(row.subscription_plan, [])
+    const plans = hasUserPlans
+      ? plansByUser.get(row.telegram_id) || []
+      : safeJson(row.subscription_plan, [])
     const endDate = parseEnd(row.subscription_end)
     const status = statusFromSubscriptionEnd(endDate, expiringDays, now)
     const price = latestPaid[row.telegram_id]?.amount
@@ -293,24 +352,25 @@ const buildSnapshot = ({ paymentsLimit, expiringDays, includeNonUser }) => {
     jobTitleNonUser: usersAll.filter((u) => String(u.jobTitle).toLowerCase() !== 'user').length,
   }
 
-  const { start: monthStart, end: monthEnd } = getKyivMonthBounds(now)
-  const revenueMonth = paymentsPaidAll.reduce((acc, row) => {
-    const ts = paymentTimestamp(row)
-    if (!ts) return acc
-    if (ts < monthStart || ts >= monthEnd) return acc
-    return acc + Number(row.amount || 0)
-  }, 0)
-  stats.revenueMonth = revenueMonth
-
-  let channels = []
-  if (hasSettings) {
+  stats.revenueMonth = hasRevenueDaily
+    ? revenueMonthFromRollup(now)
+    : revenueMonthFromPayments(hasPayments, now)
+
+  let channelList = []
+  if (hasChannels) {
+    channelList = db
+      .prepare('SELECT channel_id, name FROM channels ORDER BY id')
+      .all()
+      .map((row) => ({ id: row.channel_id, name: row.name }))
+  } else if (hasSettings) {
+    // databases not yet migrated by the bot still keep channels in settings
     const row = db.prepare("SELECT value FROM settings WHERE key = 'channel'").get()
-    const list = safeJson(row?.value, [])
-    channels = list.map((ch) => ({
-      name: ch.name,
-      members: activeUsersAll.filter((u) => Array.isArray(u.plan) && u.plan.includes(ch.name)).length,
-    }))
+    channelList = safeJson(row?.value, [])
   }
+  const channels = channelList.map((ch) => ({
+    name: ch.name,
+    members: activeUsersAll.filter((u) => Array.isArray(u.plan) && u.plan.includes(ch.name)).length,
+  }))
 
   const payments = paymentsRaw.map((row) => ({
     id: row.id,
@@ -328,6 +388,33 @@ const buildSnapshot = ({ paymentsLimit, expiringDays, includeNonUser }) => {
   return { users, payments, channels, stats }
 }
 
+// serialized snapshots keyed by query params; an entry is reused until another
+// connection commits (data_version moves) or the minute changes (statuses are time based)
+const SNAPSHOT_CACHE_SIZE = 16
+const snapshotCache = new Map()
+
+const cachedSnapshot = ({ paymentsLimit, expiringDays, includeNonUser }) => {
+  const key = `${paymentsLimit}:${expiringDays}:${includeNonUser ? 1 : 0}`
+  // data_version is per connection, entries from the old file mean nothing now
+  if (refreshDb()) snapshotCache.clear()
+  const dataVersion = db.pragma('data_version', { simple: true })
+  const minute = Math.floor(Date.now() / 60000)
+  const cached = snapshotCache.get(key)
+  if (cached && cached.dataVersion === dataVersion && cached.minute === minute) {
+    return cached
+  }
+
+  const body = JSON.stringify(buildSnapshot({ paymentsLimit, expiringDays, includeNonUser }))
+  const etag = `"${createHash('sha1').update(body).digest('hex')}"`
+  const entry = { dataVersion, minute, body, etag }
+  snapshotCache.delete(key)
+  snapshotCache.set(key, entry)
+  if (snapshotCache.size > SNAPSHOT_CACHE_SIZE) {
+    snapshotCache.delete(snapshotCache.keys().next().value)
+  }
+  return entry
+}
+
 const authGuard = (req, res, next) => {
   if (!API_TOKEN) return next()
   const auth = req.headers.authorization
@@ -355,8 +442,14 @@ app.get('/api/dashboard', authGuard, (req, res) => {
   const includeNonUser = ['1', 'true', 'yes'].includes(
     String(req.query.include_non_user || '').toLowerCase(),
   )
-  const payload = buildSnapshot({ paymentsLimit, expiringDays, includeNonUser })
-  res.json(payload)
+  const entry = cachedSnapshot({ paymentsLimit, expiringDays, includeNonUser })
+  res.set('ETag', entry.etag)
+  // let clients keep the body but always revalidate it
+  res.set('Cache-Control', 'no-cache')
+  if (req.headers['if-none-match'] === entry.etag) {
+    return res.status(304).end()
+  }
+  return res.type('application/json').send(entry.body)
 })
 
 app.listen(PORT, () => {
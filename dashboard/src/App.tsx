@@ -229,6 +229,30 @@ export default function App() {
   const [loginInput, setLoginInput] = useState('')
   const [passInput, setPassInput] = useState('')
   const [authError, setAuthError] = useState<string | null>(null)
+  // bumped by the bot's live event stream, triggers a silent refetch
+  const [refreshTick, setRefreshTick] = useState(0)
+
+  useEffect(() => {
+    const eventsUrl = import.meta.env.VITE_DASHBOARD_EVENTS_URL
+    if (!auth.authed || !eventsUrl) return
+
+    const url = new URL(eventsUrl, window.location.href)
+    const token = import.meta.env.VITE_DASHBOARD_API_TOKEN
+    // EventSource cannot send an Authorization header
+    if (token) url.searchParams.set('token', token)
+
+    let timer: ReturnType<typeof setTimeout> | undefined
+    const source = new EventSource(url)
+    source.onmessage = () => {
+      // one payment usually commits several events in a row, refetch once for the burst
+      clearTimeout(timer)
+      timer = setTimeout(() => setRefreshTick((tick) => tick + 1), 300)
+    }
+    return () => {
+      clearTimeout(timer)
+      source.close()
+    }
+  }, [auth.authed])
 
   useEffect(() => {
     if (!auth.authed) {
@@ -248,7 +272,7 @@ export default function App() {
 
     const controller = new AbortController()
     const fetchData = async () => {
-      setLoading(true)
+      if (refreshTick === 0) setLoading(true)
       setLoadError(null)
       try {
         const headers: Record<string, string> = { Accept: 'application/json' }
@@ -288,7 +312,7 @@ export default function App() {
 
     fetchData()
     return () => controller.abort()
-  }, [auth.authed])
+  }, [auth.authed, refreshTick])
 
   const visiblePool = useMemo(
     () => data.users.filter((u) => !ADMIN_ROLES.includes((u.jobTitle || '').toLowerCase())),
@@ -1 +1,4 @@
-from .methods import Database
\ No newline at end of file
+from .methods import Database
+from .async_methods import AsyncDatabase
+from .dates import KYIV, parse_subscription_end, payment_day, to_epoch
+from .backup import backup_database, rotate_backups, run_backup
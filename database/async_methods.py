@@ -0,0 +1,189 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from .methods import SETTINGS_TTL_SECONDS, Database
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDatabase:
+    """
+    Awaitable facade over Database with the same method surface.
+
+    Writes run on one dedicated thread that owns the writer connection, reads
+    run on a small pool of threads backed by Database's read-only connection
+    pool, so handlers can `await` queries without stalling the event loop.
+    """
+
+    # get_setting(s) is deliberately missing: the settings cache lives on the writer
+    # connection, whose data_version tells it when another process changed the table
+    READ_METHODS = frozenset({
+        "get_user",
+        "get_user_plans",
+        "get_plan_users",
+        "get_plan_member_counts",
+        "get_users_by_job_title",
+        "list_users",
+        "list_payments",
+        "get_payment_raw",
+        "export_users",
+        "export_payments",
+        "get_revenue_daily",
+        "revenue_daily_drift",
+        "outbox_next_run_at",
+        "get_outbox_counts",
+        "list_outbox",
+        "users_expiring_between",
+        "users_expired_before",
+        "count_users_without_subscription_end",
+        "get_channels",
+        "get_channel_id",
+        "get_dashboard_snapshot",
+        "get_dashboard_snapshot_json",
+        "get_dashboard_changes",
+    })
+
+    def __init__(
+        self,
+        db_file,
+        *,
+        readers: int = 2,
+        journal_mode: str = "wal",
+        group_commit_ms: int = 0,
+        group_commit_max: int = 0,
+        settings_ttl: float = SETTINGS_TTL_SECONDS,
+    ):
+        readers = max(1, readers)
+        self.db_file = db_file
+        self._db = Database(
+            db_file,
+            check_same_thread=False,
+            journal_mode=journal_mode,
+            read_pool_size=readers,
+            group_commit_ms=group_commit_ms,
+            group_commit_max=group_commit_max,
+            settings_ttl=settings_ttl,
+        )
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self._flush_handle = None
+        self._flush_error = None
+        # archive and revenue rebuild must not interleave their batches
+        self._maintenance = asyncio.Lock()
+
+    @property
+    def commits_saved(self) -> int:
+        return self._db.commits_saved
+
+    @staticmethod
+    async def _submit(executor, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+    def __getattr__(self, name):
+        target = getattr(Database, name, None)
+        if name.startswith("_") or not callable(target):
+            raise AttributeError(f"{type(self).__name__} has no attribute {name!r}")
+
+        bound = getattr(self._db, name)
+
+        if name in self.READ_METHODS:
+            async def method(*args, **kwargs):
+                # reads must see writes still queued by group commit, those live on the writer
+                executor = self._writer if self._db.pending_writes else self._readers
+                return await self._submit(executor, bound, *args, **kwargs)
+        else:
+            async def method(*args, **kwargs):
+                self._raise_flush_error()
+                try:
+                    return await self._submit(self._writer, bound, *args, **kwargs)
+                finally:
+                    self._arm_flush()
+
+        functools.update_wrapper(method, target)
+        # cache the wrapper so __getattr__ runs once per method name
+        setattr(self, name, method)
+        return method
+
+    def _arm_flush(self):
+        if self._flush_handle is not None or not self._db.pending_writes:
+            return
+        # count-only mode still needs a timer so the tail of a burst gets committed
+        delay = (self._db.group_commit_ms or 1000) / 1000
+        self._flush_handle = asyncio.get_running_loop().call_later(delay, self._flush_later)
+
+    def _flush_later(self):
+        self._flush_handle = None
+        self._writer.submit(self._db.flush).add_done_callback(self._flush_done)
+
+    def _flush_done(self, future):
+        # nobody awaits the timer flush: keep its failure for the next write to raise
+        error = future.exception()
+        if error is not None:
+            logger.error("Deferred group commit failed: %s", error)
+            self._flush_error = error
+
+    def _raise_flush_error(self):
+        error, self._flush_error = self._flush_error, None
+        if error is not None:
+            raise error
+
+    def add_listener(self, callback):
+        """
+        Call callback(events) on the running event loop after every commit that changed
+        users, payments or channels. Must be called from inside the loop.
+        """
+        loop = asyncio.get_running_loop()
+        self._db.add_listener(lambda events: loop.call_soon_threadsafe(callback, events))
+
+    async def flush(self):
+        """Wait until every queued group-commit write is durable."""
+        self._raise_flush_error()
+        return await self._submit(self._writer, self._db.flush)
+
+    async def run(self, func, /, *args, **kwargs):
+        """Run func(db, *args, **kwargs) on the writer thread, for multi-step work."""
+        self._raise_flush_error()
+        try:
+            return await self._submit(self._writer, func, self._db, *args, **kwargs)
+        finally:
+            self._arm_flush()
+
+    async def run_in_transaction(self, func, /, *args, **kwargs):
+        """Like run(), but every write func makes is committed once, atomically."""
+        def call(db):
+            with db.transaction():
+                return func(db, *args, **kwargs)
+
+        return await self.run(call)
+
+    async def archive_payments(self, archive_file, older_than_days, batch_size=1000):
+        """Database.archive_payments with every batch a separate writer job, so other writes get in between."""
+        moved = 0
+        async with self._maintenance:
+            while True:
+                count = await self.archive_payments_batch(archive_file, older_than_days, batch_size)
+                if not count:
+                    break
+                moved += count
+        if moved:
+            logger.info("Archived %s payments older than %s days to %s", moved, older_than_days, archive_file)
+        return moved
+
+    async def rebuild_revenue_daily(self, archive_file=None):
+        """Database.rebuild_revenue_daily: totals on a reader thread, only the difference on the writer."""
+        async with self._maintenance:
+            await self.flush()
+            counted, drift = await self._submit(self._readers, self._db.revenue_daily_drift, archive_file)
+            await self.apply_revenue_drift(drift)
+        return counted
+
+    def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        self._db.close()
@@ -0,0 +1,124 @@
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+BACKUP_PREFIX = "db-"
+BACKUP_SUFFIX = ".sqlite"
+
+
+# give up on the stepped copy after this many restarts or seconds and copy in one step
+BACKUP_MAX_RESTARTS = 3
+BACKUP_MAX_SECONDS = 600
+
+
+class _BackupStalled(Exception):
+    pass
+
+
+def _stepped_copy(source, dest, pages, sleep, max_restarts, max_seconds):
+    started = time.monotonic()
+    state = {"remaining": None, "restarts": 0}
+
+    def pause(status, remaining, total):
+        if state["remaining"] is not None and remaining > state["remaining"]:
+            # the source changed under us, SQLite went back to the first page
+            state["restarts"] += 1
+        state["remaining"] = remaining
+        if state["restarts"] > max_restarts or time.monotonic() - started > max_seconds:
+            raise _BackupStalled(f"{state['restarts']} restarts in {time.monotonic() - started:.0f}s")
+        if remaining:
+            time.sleep(sleep)
+
+    source.backup(dest, pages=pages, progress=pause, sleep=sleep)
+
+
+def backup_database(
+    source_file,
+    target_file,
+    *,
+    pages=256,
+    sleep=0.05,
+    verify=True,
+    max_restarts=BACKUP_MAX_RESTARTS,
+    max_seconds=BACKUP_MAX_SECONDS,
+) -> Path:
+    """
+    Online copy of source_file into target_file with the SQLite backup API.
+
+    The copy advances `pages` pages per step and pauses `sleep` seconds after
+    each step (backup() itself only sleeps when the source is busy/locked), so
+    the copy does not hog the disk. The source is read-locked only during a
+    step, and a commit from another connection makes SQLite start the copy over
+    at the next step. On a database that keeps changing the stepped copy is
+    abandoned after `max_restarts` restarts or `max_seconds`, and the file is
+    copied in a single step instead (one read transaction, which in WAL mode
+    does not block the writer). The result is written next to the target and
+    renamed over it only after PRAGMA integrity_check passed.
+    """
+    target = Path(target_file)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(f".{target.name}.tmp")
+    tmp.unlink(missing_ok=True)
+
+    try:
+        source = sqlite3.connect(source_file)
+        try:
+            dest = sqlite3.connect(tmp)
+            try:
+                try:
+                    _stepped_copy(source, dest, pages, sleep, max_restarts, max_seconds)
+                except _BackupStalled as e:
+                    logger.warning("Backup of %s keeps restarting (%s), copying in one step", source_file, e)
+                    source.backup(dest, pages=-1)
+                # standalone file: readable without -wal/-shm, also from a read-only mount
+                dest.execute("PRAGMA journal_mode=DELETE")
+                if verify:
+                    result = [row[0] for row in dest.execute("PRAGMA integrity_check")]
+                    if result != ["ok"]:
+                        raise sqlite3.DatabaseError(f"Backup integrity check failed: {'; '.join(result[:5])}")
+            finally:
+                dest.close()
+        finally:
+            source.close()
+        os.replace(tmp, target)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return target
+
+
+def rotate_backups(directory, keep: int) -> list[Path]:
+    """Delete all but the `keep` newest db-*.sqlite files in directory; returns the deleted paths."""
+    backups = sorted(Path(directory).glob(f"{BACKUP_PREFIX}*{BACKUP_SUFFIX}"))
+    stale = backups[:-keep] if keep > 0 else []
+    for path in stale:
+        path.unlink(missing_ok=True)
+    return stale
+
+
+def run_backup(source_file, backup_dir, *, keep=7, replica_file=None, pages=256, sleep=0.05) -> Path:
+    """Take a verified timestamped backup, rotate old ones and refresh the read replica."""
+    started = time.monotonic()
+    name = f"{BACKUP_PREFIX}{time.strftime('%Y%m%d-%H%M%S')}{BACKUP_SUFFIX}"
+    backup = backup_database(source_file, Path(backup_dir, name), pages=pages, sleep=sleep)
+    rotate_backups(backup_dir, keep)
+
+    if replica_file is not None:
+        # swap the whole file so readers see either the old or the new copy
+        replica = Path(replica_file)
+        replica.parent.mkdir(parents=True, exist_ok=True)
+        tmp = replica.with_name(f".{replica.name}.tmp")
+        shutil.copyfile(backup, tmp)
+        os.replace(tmp, replica)
+
+    logger.info(
+        "Database backup %s (%.1f MB) in %.1fs",
+        backup,
+        backup.stat().st_size / 1024 / 1024,
+        time.monotonic() - started,
+    )
+    return backup
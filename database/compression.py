@@ -0,0 +1,28 @@
+import json
+import zlib
+
+# provider payloads are small JSON documents full of repeated keys, level 6 is plenty
+COMPRESS_LEVEL = 6
+
+
+def pack_json(value) -> bytes | None:
+    """Serialize a dict/list (or an already encoded string) and zlib-compress it."""
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        try:
+            value = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        except (TypeError, ValueError):
+            value = str(value)
+    return zlib.compress(value.encode("utf-8"), COMPRESS_LEVEL)
+
+
+def unpack_json(blob):
+    """Inverse of pack_json: the decoded JSON value, or the raw text if it is not JSON."""
+    if blob is None:
+        return None
+    text = zlib.decompress(blob).decode("utf-8")
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
@@ -0,0 +1,85 @@
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+# subscription_end is stored as naive Kyiv local time
+KYIV = ZoneInfo("Europe/Kyiv")
+
+_DATE_ONLY_FORMATS = ("%Y-%m-%d", "%d.%m.%Y")
+_SUBSCRIPTION_END_FORMATS = (
+    "%Y-%m-%d %H:%M:%S.%f",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M",
+    "%Y-%m-%d",
+    "%d.%m.%Y %H:%M:%S",
+    "%d.%m.%Y %H:%M",
+    "%d.%m.%Y",
+)
+
+
+def parse_subscription_end(raw_value) -> datetime | None:
+    """
+    Parse any subscription_end we have ever stored into a naive Kyiv datetime.
+    Date-only values mean the end of that day (23:59).
+    """
+    if not raw_value:
+        return None
+    if isinstance(raw_value, datetime):
+        if raw_value.tzinfo:
+            return raw_value.astimezone(KYIV).replace(tzinfo=None)
+        return raw_value
+
+    value = str(raw_value).strip().replace("T", " ")
+    if not value:
+        return None
+
+    for fmt in _SUBSCRIPTION_END_FORMATS:
+        try:
+            parsed = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if fmt in _DATE_ONLY_FORMATS:
+            parsed = parsed.replace(hour=23, minute=59)
+        return parsed
+
+    # ISO strings with an explicit offset or "Z"
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo:
+        return parsed.astimezone(KYIV).replace(tzinfo=None)
+    return parsed
+
+
+def to_epoch(value) -> int | None:
+    """Epoch seconds for a datetime (naive = Kyiv local), a number or a stored subscription_end."""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    parsed = parse_subscription_end(value)
+    if parsed is None:
+        return None
+    return int(parsed.replace(tzinfo=KYIV).timestamp())
+
+
+def payment_day(paid_at=None, tx_timestamp=None, updated_at=None, created_at=None) -> str:
+    """Kyiv calendar date (YYYY-MM-DD) a paid payment counts towards in revenue_daily."""
+    for raw_value in (paid_at, tx_timestamp):
+        parsed = parse_subscription_end(raw_value)
+        if parsed is not None:
+            return parsed.date().isoformat()
+    # updated_at/created_at are SQLite CURRENT_TIMESTAMP values, i.e. UTC
+    for raw_value in (updated_at, created_at):
+        if not raw_value:
+            continue
+        try:
+            parsed = datetime.fromisoformat(str(raw_value))
+        except ValueError:
+            continue
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return parsed.astimezone(KYIV).date().isoformat()
+    return datetime.now(KYIV).date().isoformat()
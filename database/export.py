@@ -0,0 +1,38 @@
+import csv
+import json
+
+EXPORT_FORMATS = ("csv", "ndjson")
+
+
+def write_csv(rows, fh) -> int:
+    """Write dict rows as CSV with a header taken from the first row; returns the row count."""
+    writer = None
+    count = 0
+    for row in rows:
+        if writer is None:
+            writer = csv.DictWriter(fh, fieldnames=list(row.keys()))
+            writer.writeheader()
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+def write_ndjson(rows, fh) -> int:
+    """Write dict rows as one JSON object per line; returns the row count."""
+    count = 0
+    for row in rows:
+        fh.write(json.dumps(row, ensure_ascii=False, default=str))
+        fh.write("\n")
+        count += 1
+    return count
+
+
+def export_rows(rows, path, fmt="csv") -> int:
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    if fmt == "csv":
+        # BOM so Excel opens Cyrillic names correctly
+        with open(path, "w", encoding="utf-8-sig", newline="") as fh:
+            return write_csv(rows, fh)
+    with open(path, "w", encoding="utf-8") as fh:
+        return write_ndjson(rows, fh)
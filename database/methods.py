@@ -1,98 +1,289 @@
+import hashlib
 import json
+import logging
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from pathlib import Path
+
+from .compression import pack_json, unpack_json
+from .dates import KYIV, parse_subscription_end, payment_day, to_epoch
+from .export import export_rows
+from .migrations import migrate, revenue_totals
+
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_MODES = ("delete", "truncate", "persist", "memory", "wal", "off")
+
+# columns handlers may write through update_user_field(s)
+USER_COLUMNS = frozenset({
+    "user_name",
+    "first_name",
+    "subscription_end",
+    "job_title",
+    "access_granted",
+    "payment",
+    "notified_marks",
+})
+
+# a USDT checkout polls for ~15 minutes; leases older than this belong to dead handlers
+CRYPTO_LEASE_SECONDS = 3600
+
+# page size bounds for list_users / list_payments
+LIST_DEFAULT_LIMIT = 50
+LIST_MAX_LIMIT = 500
+
+# change cursors trail the clock by this much so late commits are picked up next time
+CHANGES_OVERLAP_SECONDS = 5
+
+# settings are re-read at least this often even if no other process touched the file
+SETTINGS_TTL_SECONDS = 30
+OUTBOX_STATUSES = ("pending", "running", "done", "dead")
 
 
 class Database:
-    def __init__(self, db_file, *, check_same_thread=True):
+    def __init__(
+        self,
+        db_file,
+        *,
+        check_same_thread=True,
+        journal_mode="wal",
+        read_pool_size=2,
+        group_commit_ms=0,
+        group_commit_max=0,
+        settings_ttl=SETTINGS_TTL_SECONDS,
+    ):
+        journal_mode = (journal_mode or "wal").lower()
+        if journal_mode not in JOURNAL_MODES:
+            raise ValueError(f"Unsupported journal mode: {journal_mode}")
+
+        self.db_file = db_file
         self.conn = sqlite3.connect(db_file, check_same_thread=check_same_thread)
         self.conn.row_factory = sqlite3.Row
         self.cursor = self.conn.cursor()
-        self._ensure_schema()
+        self._tx_depth = 0
 
-    def _ensure_schema(self):
-        # payments table to store every payment attempt and provider/admin payloads
-        self.cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_id INTEGER NOT NULL,
-                method TEXT NOT NULL,
-                plan TEXT,
-                amount REAL,
-                status TEXT NOT NULL,
-                provider_invoice_id TEXT,
-                pay_url TEXT,
-                wallet_address TEXT,
-                tx_hash TEXT,
-                tx_from TEXT,
-                tx_to TEXT,
-                tx_value REAL,
-                tx_timestamp DATETIME,
-                user_name TEXT,
-                first_name TEXT,
-                admin_id INTEGER,
-                admin_name TEXT,
-                old_subscription_end DATETIME,
-                new_subscription_end DATETIME,
-                payload TEXT,
-                description TEXT,
-                raw_response TEXT,
-                paid_at DATETIME,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            );
-            """
-        )
-        existing_cols = {row["name"] for row in self.cursor.execute("PRAGMA table_info(payments)")}
-        # ensure newly added columns exist even on old databases
-        for col, ddl in [
-            ("tx_hash", "ALTER TABLE payments ADD COLUMN tx_hash TEXT"),
-            ("tx_from", "ALTER TABLE payments ADD COLUMN tx_from TEXT"),
-            ("tx_to", "ALTER TABLE payments ADD COLUMN tx_to TEXT"),
-            ("tx_value", "ALTER TABLE payments ADD COLUMN tx_value REAL"),
-            ("tx_timestamp", "ALTER TABLE payments ADD COLUMN tx_timestamp DATETIME"),
-            ("user_name", "ALTER TABLE payments ADD COLUMN user_name TEXT"),
-            ("first_name", "ALTER TABLE payments ADD COLUMN first_name TEXT"),
-            ("admin_id", "ALTER TABLE payments ADD COLUMN admin_id INTEGER"),
-            ("admin_name", "ALTER TABLE payments ADD COLUMN admin_name TEXT"),
-            ("old_subscription_end", "ALTER TABLE payments ADD COLUMN old_subscription_end DATETIME"),
-            ("new_subscription_end", "ALTER TABLE payments ADD COLUMN new_subscription_end DATETIME"),
-            ("payload", "ALTER TABLE payments ADD COLUMN payload TEXT"),
-            ("description", "ALTER TABLE payments ADD COLUMN description TEXT"),
-            ("raw_response", "ALTER TABLE payments ADD COLUMN raw_response TEXT"),
-            ("paid_at", "ALTER TABLE payments ADD COLUMN paid_at DATETIME"),
-            ("created_at", "ALTER TABLE payments ADD COLUMN created_at DATETIME DEFAULT CURRENT_TIMESTAMP"),
-            ("updated_at", "ALTER TABLE payments ADD COLUMN updated_at DATETIME DEFAULT CURRENT_TIMESTAMP"),
-        ]:
-            if col not in existing_cols:
-                self.cursor.execute(ddl)
+        # group commit: with either limit set, plain writes are committed together
+        # once group_commit_max writes are pending or the oldest is group_commit_ms old
+        self.group_commit_ms = max(0, int(group_commit_ms))
+        self.group_commit_max = max(0, int(group_commit_max))
+        self._pending_writes = 0
+        self._pending_since = 0.0
+        self._writer_thread = None
+        self.commits_saved = 0
 
-        self.cursor.execute(
-            "CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(telegram_id);"
+        # change events are held until the write that produced them is committed
+        self._listeners = []
+        self._pending_events = []
+
+        self.journal_mode = self.cursor.execute(f"PRAGMA journal_mode={journal_mode}").fetchone()[0]
+        self.schema_version = migrate(self.conn)
+        self._sync_crypto_addresses()
+        self.conn.commit()
+
+        # read-only connections for long scans; writes stay serialized on self.conn
+        self._read_pool_size = max(1, int(read_pool_size))
+        self._read_pool = queue.LifoQueue()
+        self._read_conns = []
+        self._read_lock = threading.Lock()
+
+        # channels are tiny and read on every kick/keyboard render, keep them in memory
+        self._channels = None
+        self._channels_gen = 0
+
+        # reader connection id -> (data_version + params key, etag, body)
+        self._snapshot_cache = {}
+
+        # whole settings table, written through by edit_setting/increment_setting and
+        # reloaded after settings_ttl or when another connection commits (data_version)
+        self.settings_ttl = max(0.0, float(settings_ttl))
+        self._settings = None
+        self._settings_expires = 0.0
+        self._settings_data_version = None
+
+    def _open_reader(self):
+        conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    @contextmanager
+    def _reader(self):
+        """Borrow a cursor on a pooled read-only connection."""
+        if (self._pending_writes or self._tx_depth) and threading.get_ident() == self._writer_thread:
+            # uncommitted writes (group commit or an open transaction) are only visible here
+            cursor = self.conn.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+            return
+
+        try:
+            conn = self._read_pool.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._read_lock:
+                if len(self._read_conns) < self._read_pool_size:
+                    conn = self._open_reader()
+                    self._read_conns.append(conn)
+            if conn is None:
+                conn = self._read_pool.get()
+        cursor = conn.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+            # never return a connection with an open read transaction to the pool
+            if conn.in_transaction:
+                conn.rollback()
+            self._read_pool.put(conn)
+
+    def _sync_crypto_addresses(self):
+        """Mirror the address list kept in settings.crypto_address into the pool table."""
+        if not self._table_exists("settings"):
+            return
+        self.cursor.execute("SELECT value FROM settings WHERE key = 'crypto_address'")
+        row = self.cursor.fetchone()
+        if not row:
+            return
+        addresses = [
+            item["address"]
+            for item in self._safe_json_loads(row["value"], [])
+            if isinstance(item, dict) and item.get("address")
+        ]
+        self.cursor.executemany(
+            "INSERT OR IGNORE INTO crypto_addresses (address) VALUES (?)",
+            [(address,) for address in addresses],
         )
+        # drop wallets removed from settings unless a checkout still holds them
+        placeholders = ", ".join("?" for _ in addresses) or "NULL"
         self.cursor.execute(
-            "CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status);"
+            f"""
+            DELETE FROM crypto_addresses
+            WHERE address NOT IN ({placeholders}) AND leased_by IS NULL
+            """,
+            addresses,
         )
-        self.conn.commit()
 
-    def _table_exists(self, table_name: str) -> bool:
-        self.cursor.execute(
+    @property
+    def group_commit(self) -> bool:
+        return bool(self.group_commit_ms or self.group_commit_max)
+
+    @property
+    def pending_writes(self) -> int:
+        return self._pending_writes
+
+    def _commit(self):
+        # inside transaction() the outermost block commits once for everything
+        if self._tx_depth:
+            return
+        if not self.group_commit:
+            self.conn.commit()
+            self._dispatch_events()
+            return
+
+        if not self._pending_writes:
+            self._pending_since = time.monotonic()
+            self._writer_thread = threading.get_ident()
+        self._pending_writes += 1
+        if self.flush_due():
+            self.flush()
+
+    def flush_due(self) -> bool:
+        if not self._pending_writes:
+            return False
+        if self.group_commit_max and self._pending_writes >= self.group_commit_max:
+            return True
+        elapsed_ms = (time.monotonic() - self._pending_since) * 1000
+        return bool(self.group_commit_ms) and elapsed_ms >= self.group_commit_ms
+
+    def flush(self):
+        """
+        Commit writes queued by group commit; returns how many were flushed.
+        If the commit fails the queued writes are rolled back and the error is raised.
+        """
+        pending = self._pending_writes
+        if self._tx_depth or not pending:
+            return 0
+        try:
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            self._pending_writes = 0
+            # nothing of the batch is stored, neither its events nor cached values
+            self._pending_events.clear()
+            self._invalidate_settings()
+            self._invalidate_channels()
+            raise sqlite3.OperationalError(f"Group commit of {pending} write(s) failed, rolled back: {e}") from e
+        self.commits_saved += pending - 1
+        self._pending_writes = 0
+        self._dispatch_events()
+        return pending
+
+    def add_listener(self, callback):
+        """callback(events) runs on the writing thread after every commit that changed something."""
+        self._listeners.append(callback)
+
+    def _emit(self, event_type, **data):
+        if self._listeners:
+            self._pending_events.append({"type": event_type, **data})
+
+    def _dispatch_events(self):
+        if not self._pending_events:
+            return
+        events, self._pending_events = self._pending_events, []
+        for listener in list(self._listeners):
+            try:
+                listener(events)
+            except Exception:
+                logger.exception("Database change listener failed")
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run several writes as one atomic commit:
+
+            with db.transaction():
+                db.update_user_fields(tg_id, payment=0, notified_marks="[]")
+                db.update_payment_entry(payment_id, status="paid")
+
+        Nested blocks join the outer transaction.
+        """
+        if self._tx_depth == 0:
+            self.flush()
+            if self.conn.in_transaction:
+                self.conn.commit()
+            self.cursor.execute("BEGIN IMMEDIATE")
+            self._writer_thread = threading.get_ident()
+        self._tx_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._tx_depth -= 1
+            if self._tx_depth == 0:
+                self.conn.rollback()
+                # caches and events may hold values written inside the rolled back block
+                self._invalidate_settings()
+                self._invalidate_channels()
+                self._pending_events.clear()
+            raise
+        self._tx_depth -= 1
+        if self._tx_depth == 0:
+            self.conn.commit()
+            self._dispatch_events()
+
+    def _table_exists(self, table_name: str, cursor=None) -> bool:
+        cursor = cursor or self.cursor
+        cursor.execute(
             "SELECT name FROM sqlite_master WHERE type='table' AND name = ? LIMIT 1;",
             (table_name,),
         )
-        return self.cursor.fetchone() is not None
-
-    @staticmethod
-    def _jsonify(value):
-        if value is None:
-            return None
-        if isinstance(value, str):
-            return value
-        try:
-            return json.dumps(value, ensure_ascii=False)
-        except Exception:
-            return str(value)
+        return cursor.fetchone() is not None
 
     @staticmethod
     def _safe_json_loads(raw, fallback=None):
@@ -106,48 +297,21 @@ class Database:
     @staticmethod
     def _parse_subscription_end(raw_value):
         """Parse subscription_end and return (datetime or None, normalized string or None)."""
-        if not raw_value:
-            return None, None
-
-        raw = str(raw_value).replace("T", " ")
-        parsed = None
-        for fmt in (
-            "%Y-%m-%d %H:%M:%S.%f",
-            "%Y-%m-%d %H:%M:%S",
-            "%Y-%m-%d",
-            "%d.%m.%Y %H:%M",
-            "%d.%m.%Y",
-        ):
-            try:
-                parsed = datetime.strptime(raw, fmt)
-                # default to end of day when only date is provided
-                if fmt in ("%Y-%m-%d", "%d.%m.%Y"):
-                    parsed = parsed.replace(hour=23, minute=59)
-                break
-            except ValueError:
-                continue
-
+        parsed = parse_subscription_end(raw_value)
         if parsed is None:
             return None, None
-
-        normalized = parsed.strftime("%Y-%m-%d %H:%M:%S.%f")
-        return parsed, normalized
-
-    @staticmethod
-    def _coerce_datetime(raw_value):
-        parsed, _ = Database._parse_subscription_end(raw_value)
-        return parsed
+        return parsed, parsed.strftime("%Y-%m-%d %H:%M:%S.%f")
 
     @staticmethod
-    def _status_for_subscription_end(end_dt, expiring_threshold_days=7, now=None):
-        if end_dt is None:
+    def _status_for_subscription_ts(end_ts, expiring_threshold_days=7, now_ts=None):
+        if end_ts is None:
             return "expired"
 
-        now = now or datetime.now()
-        diff = end_dt - now
-        if diff.total_seconds() <= 0:
+        now_ts = time.time() if now_ts is None else now_ts
+        diff = end_ts - now_ts
+        if diff <= 0:
             return "expired"
-        if diff.total_seconds() <= expiring_threshold_days * 86400:
+        if diff <= expiring_threshold_days * 86400:
             return "expiring"
         return "active"
 
@@ -172,7 +336,6 @@ class Database:
         description=None,
         raw_response=None,
     ):
-        raw = self._jsonify(raw_response)
         self.cursor.execute(
             """
             INSERT INTO payments (
@@ -191,10 +354,9 @@ class Database:
                 old_subscription_end,
                 new_subscription_end,
                 payload,
-                description,
-                raw_response
+                description
             )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
             (
                 telegram_id,
@@ -213,11 +375,15 @@ class Database:
                 new_subscription_end,
                 payload,
                 description,
-                raw,
             ),
         )
-        self.conn.commit()
-        return self.cursor.lastrowid
+        payment_id = self.cursor.lastrowid
+        self._store_raw_response(payment_id, raw_response)
+        if (status or "").lower() == "paid":
+            self._add_revenue(self._paid_payment_row(payment_id), 1)
+        self._emit("payment", id=payment_id, telegram_id=telegram_id, status=status)
+        self._commit()
+        return payment_id
 
     def update_payment_entry(
         self,
@@ -299,275 +465,1179 @@ class Database:
         if paid_at is not None:
             fields.append("paid_at = ?")
             params.append(paid_at)
-        if raw_response is not None:
-            fields.append("raw_response = ?")
-            params.append(self._jsonify(raw_response))
-
         # always bump updated_at to see last change moment
         fields.append("updated_at = CURRENT_TIMESTAMP")
         params.append(payment_id)
 
         query = f"UPDATE payments SET {', '.join(fields)} WHERE id = ?"
-        self.cursor.execute(query, params)
-        self.conn.commit()
+        if status is None:
+            # a paid payment can still change its revenue_daily day (paid_at, tx_timestamp,
+            # or updated_at when neither is set); unpaid ones stay out of it
+            before = self._paid_payment_row(payment_id)
+            self.cursor.execute(query, params)
+            if self.cursor.rowcount:
+                self._store_raw_response(payment_id, raw_response)
+            if before is not None:
+                self._move_revenue(before, self._paid_payment_row(payment_id))
+            self._emit("payment", id=payment_id, status=status)
+            self._commit()
+            return
+
+        # a status change may move the payment in or out of revenue_daily, same transaction
+        with self.transaction():
+            before = self._paid_payment_row(payment_id)
+            self.cursor.execute(query, params)
+            if self.cursor.rowcount:
+                self._store_raw_response(payment_id, raw_response)
+            self._move_revenue(before, self._paid_payment_row(payment_id))
+            self._emit("payment", id=payment_id, status=status)
+
+    def _store_raw_response(self, payment_id, raw_response):
+        # only the latest provider response is kept; polling loops resend the
+        # same invoice every few seconds, an unchanged blob is not rewritten
+        if raw_response is None:
+            return
+        self.cursor.execute(
+            """
+            INSERT INTO payment_raw (payment_id, data) VALUES (?, ?)
+            ON CONFLICT(payment_id) DO UPDATE SET data = excluded.data
+            WHERE data IS NOT excluded.data
+            """,
+            (payment_id, pack_json(raw_response)),
+        )
+
+    def get_payment_raw(self, payment_id):
+        """Decoded provider response stored for a payment, or None."""
+        with self._reader() as cursor:
+            row = cursor.execute("SELECT data FROM payment_raw WHERE payment_id = ?", (payment_id,)).fetchone()
+        return unpack_json(row["data"]) if row else None
+
+    def _paid_payment_row(self, payment_id):
+        row = self.cursor.execute(
+            """
+            SELECT status, method, plan, amount, paid_at, tx_timestamp, updated_at, created_at
+            FROM payments WHERE id = ?
+            """,
+            (payment_id,),
+        ).fetchone()
+        if row is None or (row["status"] or "").lower() != "paid":
+            return None
+        return row
+
+    @staticmethod
+    def _revenue_key(row):
+        day = payment_day(row["paid_at"], row["tx_timestamp"], row["updated_at"], row["created_at"])
+        return day, row["method"] or "", row["plan"] or "", float(row["amount"] or 0)
+
+    def _move_revenue(self, before, after):
+        # before/after are _paid_payment_row results, None when the payment is not paid
+        if before is not None and after is not None and self._revenue_key(before) == self._revenue_key(after):
+            return
+        if before is not None:
+            self._add_revenue(before, -1)
+        if after is not None:
+            self._add_revenue(after, 1)
+
+    def _add_revenue(self, row, sign):
+        day = payment_day(row["paid_at"], row["tx_timestamp"], row["updated_at"], row["created_at"])
+        self.cursor.execute(
+            """
+            INSERT INTO revenue_daily (day, method, plan, payments, amount)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(day, method, plan) DO UPDATE SET
+                payments = payments + excluded.payments,
+                amount = amount + excluded.amount
+            """,
+            (day, row["method"] or "", row["plan"] or "", sign, sign * float(row["amount"] or 0)),
+        )
+        if sign < 0:
+            self.cursor.execute(
+                "DELETE FROM revenue_daily WHERE day = ? AND method = ? AND plan = ? AND payments <= 0",
+                (day, row["method"] or "", row["plan"] or ""),
+            )
+
+    def rebuild_revenue_daily(self, archive_file=None):
+        """
+        Recompute revenue_daily from the payments table; returns how many paid payments it counted.
+
+        Pass the archive_payments file so archived payments are counted too. The totals
+        are computed on a read connection (revenue_daily_drift) and only the difference
+        is written (apply_revenue_drift), so the writer is held for a few rows.
+        """
+        if self._tx_depth:
+            raise RuntimeError("rebuild_revenue_daily cannot run inside transaction()")
+        self.flush()
+        counted, drift = self.revenue_daily_drift(archive_file)
+        self.apply_revenue_drift(drift)
+        return counted
+
+    def revenue_daily_drift(self, archive_file=None):
+        """
+        (counted, rows): recomputed totals minus revenue_daily, both read from one snapshot,
+        as (day, method, plan, payments, amount) deltas. Adding them later stays correct,
+        payments changed in between were already applied to revenue_daily incrementally.
+        """
+        use_archive = archive_file is not None and Path(archive_file).exists()
+        with self._reader() as cursor:
+            conn = cursor.connection
+            if conn is self.conn:
+                raise RuntimeError("Flush pending writes before revenue_daily_drift")
+            if use_archive:
+                cursor.execute("ATTACH DATABASE ? AS archive", (str(archive_file),))
+            try:
+                # one read transaction: payments and revenue_daily from the same snapshot
+                cursor.execute("BEGIN")
+                source = "main.payments"
+                if use_archive and cursor.execute(
+                    "SELECT 1 FROM archive.sqlite_master WHERE type = 'table' AND name = 'payments'"
+                ).fetchone():
+                    columns = "method, plan, amount, status, paid_at, tx_timestamp, updated_at, created_at"
+                    source = (
+                        f"(SELECT {columns} FROM main.payments "
+                        f"UNION ALL SELECT {columns} FROM archive.payments)"
+                    )
+                totals, counted = revenue_totals(cursor, source=source)
+                current = {
+                    (row["day"], row["method"], row["plan"]): (row["payments"], row["amount"])
+                    for row in cursor.execute("SELECT day, method, plan, payments, amount FROM main.revenue_daily")
+                }
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                if use_archive:
+                    cursor.execute("DETACH DATABASE archive")
+
+        drift = []
+        for key in totals.keys() | current.keys():
+            payments, amount = totals.get(key, (0, 0.0))
+            old_payments, old_amount = current.get(key, (0, 0.0))
+            if payments != old_payments or abs(amount - old_amount) > 1e-6:
+                drift.append((*key, payments - old_payments, amount - old_amount))
+        return counted, drift
+
+    def apply_revenue_drift(self, rows):
+        """Add revenue_daily_drift deltas in one short transaction; returns how many rows changed."""
+        with self.transaction():
+            self.cursor.executemany(
+                """
+                INSERT INTO revenue_daily (day, method, plan, payments, amount) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(day, method, plan) DO UPDATE SET
+                    payments = payments + excluded.payments,
+                    amount = amount + excluded.amount
+                """,
+                rows,
+            )
+            self.cursor.execute("DELETE FROM revenue_daily WHERE payments <= 0")
+        if rows:
+            logger.info("revenue_daily corrected in %s rows", len(rows))
+        return len(rows)
+
+    @contextmanager
+    def _attached(self, path, alias):
+        # ATTACH/DETACH are refused inside a transaction
+        if self._tx_depth:
+            raise RuntimeError("Cannot attach a database inside transaction()")
+        self.flush()
+        if self.conn.in_transaction:
+            self.conn.commit()
+        self.cursor.execute(f"ATTACH DATABASE ? AS {alias}", (str(path),))
+        try:
+            yield
+        finally:
+            if self.conn.in_transaction:
+                self.conn.commit()
+            self.cursor.execute(f"DETACH DATABASE {alias}")
+
+    def _archive_table_exists(self, table_name):
+        return self.cursor.execute(
+            "SELECT 1 FROM archive.sqlite_master WHERE type = 'table' AND name = ?",
+            (table_name,),
+        ).fetchone() is not None
+
+    def _prepare_archive_table(self, table_name):
+        """Create archive.<table> shaped like main.<table>; returns the main column list."""
+        columns = [row["name"] for row in self.cursor.execute(f"PRAGMA main.table_info({table_name})")]
+        if not self._archive_table_exists(table_name):
+            self.cursor.execute(f"CREATE TABLE archive.{table_name} AS SELECT * FROM main.{table_name} WHERE 0")
+        else:
+            # columns added to the hot table after the archive was created
+            archived = {row["name"] for row in self.cursor.execute(f"PRAGMA archive.table_info({table_name})")}
+            for column in columns:
+                if column not in archived:
+                    self.cursor.execute(f"ALTER TABLE archive.{table_name} ADD COLUMN {column}")
+        return columns
+
+    def archive_payments(self, archive_file, older_than_days, batch_size=1000):
+        """
+        Move payments created more than `older_than_days` ago, with their
+        payment_raw rows, into the SQLite file `archive_file`; returns how many moved.
+
+        revenue_daily and user_latest_paid keep counting archived payments.
+        Works through archive_payments_batch, one transaction per batch.
+        """
+        moved = 0
+        while True:
+            count = self.archive_payments_batch(archive_file, older_than_days, batch_size)
+            if not count:
+                break
+            moved += count
+        if moved:
+            logger.info("Archived %s payments older than %s days to %s", moved, older_than_days, archive_file)
+        return moved
+
+    def archive_payments_batch(self, archive_file, older_than_days, batch_size=1000):
+        """Move one batch of up to `batch_size` old payments; returns how many moved (0 when done)."""
+        # created_at is CURRENT_TIMESTAMP text (UTC), compare it in the same format
+        cutoff = f"-{int(older_than_days)} days"
+        with self._attached(archive_file, "archive"):
+            with self.transaction():
+                ids = [
+                    row["id"]
+                    for row in self.cursor.execute(
+                        """
+                        SELECT id FROM main.payments
+                        WHERE created_at < datetime('now', ?)
+                        ORDER BY created_at LIMIT ?
+                        """,
+                        (cutoff, batch_size),
+                    )
+                ]
+                if not ids:
+                    return 0
+                payment_columns = ", ".join(self._prepare_archive_table("payments"))
+                raw_columns = ", ".join(self._prepare_archive_table("payment_raw"))
+                self.cursor.execute(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS archive.idx_payments_id ON payments(id)"
+                )
+                self.cursor.execute(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS archive.idx_payment_raw_id ON payment_raw(payment_id)"
+                )
+                marks = ", ".join("?" * len(ids))
+                # WAL commits are atomic per file only: OR IGNORE makes a retry after
+                # a crash between the two files harmless
+                self.cursor.execute(
+                    f"INSERT OR IGNORE INTO archive.payments ({payment_columns}) "
+                    f"SELECT {payment_columns} FROM main.payments WHERE id IN ({marks})",
+                    ids,
+                )
+                self.cursor.execute(
+                    f"INSERT OR IGNORE INTO archive.payment_raw ({raw_columns}) "
+                    f"SELECT {raw_columns} FROM main.payment_raw WHERE payment_id IN ({marks})",
+                    ids,
+                )
+                self.cursor.execute(f"DELETE FROM main.payment_raw WHERE payment_id IN ({marks})", ids)
+                self.cursor.execute(f"DELETE FROM main.payments WHERE id IN ({marks})", ids)
+                self._emit("payment", archived=len(ids))
+        return len(ids)
+
+    def get_revenue_daily(self, since=None, until=None):
+        """revenue_daily rows for Kyiv dates in [since, until) (date or YYYY-MM-DD), oldest first."""
+        conditions = []
+        params = []
+        if since is not None:
+            conditions.append("day >= ?")
+            params.append(str(since))
+        if until is not None:
+            conditions.append("day < ?")
+            params.append(str(until))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._reader() as cursor:
+            cursor.execute(
+                f"SELECT day, method, plan, payments, amount FROM revenue_daily {where} ORDER BY day, method, plan",
+                params,
+            )
+            return [dict(row) for row in cursor.fetchall()]
 
     def add_user(self, tg_id):
         self.cursor.execute(
             "INSERT INTO users (telegram_id) VALUES (?)",
             (tg_id,)
         )
-        self.conn.commit()
+        self._emit("user", telegram_id=tg_id, fields=["telegram_id"])
+        self._commit()
+
+    def _invalidate_settings(self):
+        self._settings = None
+
+    def _load_settings(self):
+        # data_version only moves when a *different* connection commits, our own
+        # writes are already in the cache
+        data_version = self.cursor.execute("PRAGMA data_version").fetchone()[0]
+        if (
+            self._settings is not None
+            and data_version == self._settings_data_version
+            and time.monotonic() < self._settings_expires
+        ):
+            return self._settings
+
+        rows = self.cursor.execute("SELECT key, value FROM settings").fetchall()
+        self._settings = {row["key"]: row["value"] for row in rows}
+        self._settings_data_version = data_version
+        self._settings_expires = time.monotonic() + self.settings_ttl
+        return self._settings
 
     def get_setting(self, key):
-        self.cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
-        row = self.cursor.fetchone()
-        if row:
-            return row["value"]
-        return None
+        return self._load_settings().get(key)
+
+    def get_settings(self, *keys):
+        """Several settings at once, missing keys map to None."""
+        settings = self._load_settings()
+        return {key: settings.get(key) for key in keys}
 
     def edit_setting(self, key, new_value):
         self.cursor.execute(
             "UPDATE settings SET value = ? WHERE key = ?",
             (new_value, key)
         )
-        self.conn.commit()
+        self._commit()
+        if self._settings is not None and key in self._settings:
+            self._settings[key] = new_value
 
+    def increment_setting(self, key, delta=1, *, minimum=None, maximum=None):
+        """
+        Atomically add delta to an integer setting.
+        Returns the new value, or None if the key is missing or the result would leave [minimum, maximum].
+        """
+        conditions = ["key = ?"]
+        params = [int(delta), key]
+        if minimum is not None:
+            conditions.append("CAST(value AS INTEGER) + ? >= ?")
+            params += [int(delta), minimum]
+        if maximum is not None:
+            conditions.append("CAST(value AS INTEGER) + ? <= ?")
+            params += [int(delta), maximum]
+
+        rows = self.cursor.execute(
+            f"""
+            UPDATE settings SET value = CAST(value AS INTEGER) + ?
+            WHERE {" AND ".join(conditions)}
+            RETURNING value
+            """,
+            params,
+        ).fetchall()
+        self._commit()
+        if not rows:
+            return None
+        new_value = int(rows[0]["value"])
+        if self._settings is not None:
+            self._settings[key] = str(new_value)
+        return new_value
 
     def update_user_field(self, telegram_id, column, value):
-        query = f"UPDATE users SET {column} = ? WHERE telegram_id = ?"
-        self.cursor.execute(query, (value, telegram_id))
-        self.conn.commit()
+        self.update_user_fields(telegram_id, **{column: value})
 
-    def add_subscription_plan(self, telegram_id, new_plan):
-        self.cursor.execute(
-            "SELECT subscription_plan FROM users WHERE telegram_id = ?",
-            (telegram_id,)
-        )
-        row = self.cursor.fetchone()
-        current = json.loads(row["subscription_plan"] or "[]")
+    def update_user_fields(self, telegram_id, /, **columns):
+        """Update several whitelisted users columns with one statement and one commit."""
+        unknown = set(columns) - USER_COLUMNS
+        if unknown:
+            raise ValueError(f"Unknown users column(s): {', '.join(sorted(unknown))}")
+        if not columns:
+            return
+        if "subscription_end" in columns:
+            # keep the indexed epoch column in step with the text value
+            columns["subscription_end_ts"] = to_epoch(columns["subscription_end"])
 
-        if new_plan not in current:
-            current.append(new_plan)
+        assignments = ", ".join(f"{column} = ?" for column in columns)
+        query = f"UPDATE users SET {assignments} WHERE telegram_id = ?"
+        self.cursor.execute(query, (*columns.values(), telegram_id))
+        self._emit("user", telegram_id=telegram_id, fields=sorted(columns))
+        self._commit()
 
+    def add_subscription_plan(self, telegram_id, new_plan):
         self.cursor.execute(
-            "UPDATE users SET subscription_plan = ? WHERE telegram_id = ?",
-            (json.dumps(current), telegram_id)
+            "INSERT OR IGNORE INTO user_plans (telegram_id, plan) VALUES (?, ?)",
+            (telegram_id, new_plan)
         )
-        self.conn.commit()
+        if self.cursor.rowcount:
+            self._emit("user", telegram_id=telegram_id, fields=["plan"])
+        self._commit()
 
     def remove_subscription_plan(self, telegram_id, plan_to_remove):
         self.cursor.execute(
-            "SELECT subscription_plan FROM users WHERE telegram_id = ?",
-            (telegram_id,)
+            "DELETE FROM user_plans WHERE telegram_id = ? AND plan = ?",
+            (telegram_id, plan_to_remove)
         )
-        row = self.cursor.fetchone()
-        current = json.loads(row["subscription_plan"] or "[]")
+        if self.cursor.rowcount:
+            self._emit("user", telegram_id=telegram_id, fields=["plan"])
+        self._commit()
 
-        updated = [plan for plan in current if plan != plan_to_remove]
+    def get_user_plans(self, telegram_id):
+        with self._reader() as cursor:
+            cursor.execute(
+                "SELECT plan FROM user_plans WHERE telegram_id = ? ORDER BY rowid",
+                (telegram_id,)
+            )
+            return [row["plan"] for row in cursor.fetchall()]
 
-        self.cursor.execute(
-            "UPDATE users SET subscription_plan = ? WHERE telegram_id = ?",
-            (json.dumps(updated), telegram_id)
-        )
-        self.conn.commit()
+    def get_plan_users(self, plan):
+        """Telegram ids of everyone holding plan (e.g. for a bulk kick)."""
+        with self._reader() as cursor:
+            cursor.execute("SELECT telegram_id FROM user_plans WHERE plan = ?", (plan,))
+            return [row["telegram_id"] for row in cursor.fetchall()]
 
-    def get_user_plans(self, telegram_id):
-        self.cursor.execute(
-            "SELECT subscription_plan FROM users WHERE telegram_id = ?",
-            (telegram_id,)
+    @staticmethod
+    def _plan_member_counts(cursor, now_ts):
+        # whole days after today come from the trigger-maintained buckets,
+        # the rest of today is counted exactly through the subscription_end_ts index
+        today = int(now_ts // 86400)
+        counts = {}
+        cursor.execute(
+            "SELECT plan, SUM(members) AS members FROM plan_expiry_days WHERE day > ? GROUP BY plan",
+            (today,),
         )
-        row = self.cursor.fetchone()
-        if row:
-            return json.loads(row["subscription_plan"] or "[]")
-        return []
+        for row in cursor.fetchall():
+            counts[row["plan"]] = row["members"]
+        cursor.execute(
+            """
+            SELECT up.plan AS plan, COUNT(*) AS members
+            FROM users u
+            JOIN user_plans up ON up.telegram_id = u.telegram_id
+            WHERE u.subscription_end_ts > ? AND u.subscription_end_ts < ?
+            GROUP BY up.plan
+            """,
+            (now_ts, (today + 1) * 86400),
+        )
+        for row in cursor.fetchall():
+            counts[row["plan"]] = counts.get(row["plan"], 0) + row["members"]
+        return {plan: members for plan, members in counts.items() if members}
+
+    @staticmethod
+    def _user_status_counts(cursor, now_ts, expiring_threshold_days=7):
+        """Per-status and per-job_title user counts from the user_expiry_days buckets."""
+        buckets = cursor.execute("SELECT job_title, day, users FROM user_expiry_days").fetchall()
+
+        def count_ending_by(moment_ts):
+            day = int(moment_ts // 86400)
+            before = sum(row["users"] for row in buckets if 0 <= row["day"] < day)
+            cursor.execute(
+                "SELECT COUNT(*) FROM users WHERE subscription_end_ts >= ? AND subscription_end_ts <= ?",
+                (day * 86400, moment_ts),
+            )
+            return before + cursor.fetchone()[0]
+
+        total = sum(row["users"] for row in buckets)
+        no_end = sum(row["users"] for row in buckets if row["day"] < 0)
+        job_title_user = sum(row["users"] for row in buckets if row["job_title"].lower() == "user")
+        ended = count_ending_by(now_ts)
+        ending_soon = count_ending_by(now_ts + expiring_threshold_days * 86400)
+        return {
+            "total": total,
+            "active": total - no_end - ending_soon,
+            "expiring": ending_soon - ended,
+            "expired": no_end + ended,
+            "jobTitleUser": job_title_user,
+            "jobTitleNonUser": total - job_title_user,
+        }
+
+    def get_plan_member_counts(self, now=None):
+        """Active (not expired) members per plan name."""
+        now_ts = to_epoch(now) if now is not None else time.time()
+        with self._reader() as cursor:
+            return self._plan_member_counts(cursor, now_ts)
 
     def get_user(self, tg_id):
         query = "SELECT * FROM users WHERE telegram_id = ?;"
-        self.cursor.execute(query, (tg_id,))
-        result = self.cursor.fetchone()
+        with self._reader() as cursor:
+            cursor.execute(query, (tg_id,))
+            result = cursor.fetchone()
         return dict(result) if result else None
 
+    def users_expiring_between(self, start, end, *, job_title="user", without_mark=None):
+        """
+        Users whose subscription ends in (start, end], soonest first.
+        start/end are datetimes (naive = Kyiv) or epoch seconds; start=None means no lower bound.
+        without_mark skips users whose notified_marks already contain that mark.
+        """
+        conditions = ["subscription_end_ts <= ?"]
+        params = [to_epoch(end)]
+        if start is not None:
+            conditions.append("subscription_end_ts > ?")
+            params.append(to_epoch(start))
+        if job_title is not None:
+            conditions.append("job_title = ?")
+            params.append(job_title)
+        if without_mark is not None:
+            conditions.append("(notified_marks IS NULL OR notified_marks NOT LIKE ?)")
+            params.append(f'%"{without_mark}"%')
+
+        query = f"""
+            SELECT * FROM users
+            WHERE {' AND '.join(conditions)}
+            ORDER BY subscription_end_ts
+        """
+        with self._reader() as cursor:
+            cursor.execute(query, params)
+            return [dict(row) for row in cursor.fetchall()]
+
+    def users_expired_before(self, moment, *, job_title="user"):
+        return self.users_expiring_between(None, moment, job_title=job_title)
+
+    def count_users_without_subscription_end(self, *, job_title="user"):
+        with self._reader() as cursor:
+            cursor.execute(
+                "SELECT COUNT(*) FROM users WHERE subscription_end_ts IS NULL AND job_title = ?",
+                (job_title,),
+            )
+            return cursor.fetchone()[0]
+
     def get_users_by_job_title(self, job_title):
         query = "SELECT * FROM users WHERE job_title = ?;"
-        self.cursor.execute(query, (job_title,))
-        return [dict(row) for row in self.cursor.fetchall()]
+        with self._reader() as cursor:
+            cursor.execute(query, (job_title,))
+            return [dict(row) for row in cursor.fetchall()]
 
-    def add_channel(self, name, channel_id):
-        self.cursor.execute("SELECT value FROM settings WHERE key = 'channel'")
-        row = self.cursor.fetchone()
+    @staticmethod
+    def _list_limit(limit):
+        return min(max(int(limit or LIST_DEFAULT_LIMIT), 1), LIST_MAX_LIMIT)
 
-        channels = []
-        if row:
-            channels = json.loads(row['value'])
+    @staticmethod
+    def _user_filters(status, plan, job_title, expiring_threshold_days):
+        conditions = []
+        params = []
+        if status is not None:
+            now_ts = time.time()
+            soon_ts = now_ts + expiring_threshold_days * 86400
+            if status == "expired":
+                conditions.append("(u.subscription_end_ts IS NULL OR u.subscription_end_ts <= ?)")
+                params.append(now_ts)
+            elif status == "expiring":
+                conditions.append("u.subscription_end_ts > ? AND u.subscription_end_ts <= ?")
+                params += [now_ts, soon_ts]
+            elif status == "active":
+                conditions.append("u.subscription_end_ts > ?")
+                params.append(soon_ts)
+            else:
+                raise ValueError(f"Unknown user status: {status}")
+        if plan is not None:
+            conditions.append(
+                "EXISTS (SELECT 1 FROM user_plans up WHERE up.telegram_id = u.telegram_id AND up.plan = ?)"
+            )
+            params.append(plan)
+        if job_title is not None:
+            conditions.append("u.job_title = ?")
+            params.append(job_title)
+        return conditions, params
 
-        channels.append({'name': name, 'id': channel_id})
-        json_value = json.dumps(channels)
+    def list_users(
+        self,
+        *,
+        status=None,
+        plan=None,
+        job_title=None,
+        search=None,
+        after=None,
+        limit=LIST_DEFAULT_LIMIT,
+        expiring_threshold_days=7,
+    ):
+        """
+        One page of users plus the key to pass as `after` for the next page (None on the last one).
 
-        self.cursor.execute("""
-            INSERT INTO settings (key, value)
-            VALUES ('channel', ?)
-            ON CONFLICT(key) DO UPDATE SET value = excluded.value
-        """, (json_value,))
-        self.conn.commit()
+        Pages are keyed on users.id, or on (user_name, id) when search is given, a
+        user_name prefix (leading "@" ignored) served by idx_users_user_name.
+        status is "active", "expiring" or "expired", same rules as the dashboard.
+        """
+        limit = self._list_limit(limit)
+        conditions, params = self._user_filters(status, plan, job_title, expiring_threshold_days)
 
-    def remove_channel_by_id(self, channel_id):
-        self.cursor.execute("SELECT value FROM settings WHERE key = 'channel'")
-        row = self.cursor.fetchone()
+        search = (search or "").strip().lstrip("@")
+        if search:
+            # a range on the NOCASE index instead of LIKE, so the prefix can contain % or _
+            conditions.append("u.user_name COLLATE NOCASE >= ? AND u.user_name COLLATE NOCASE < ?")
+            params += [search, search + "\U0010ffff"]
+            if after is not None:
+                after_name, after_id = after
+                conditions.append("(u.user_name COLLATE NOCASE, u.id) > (?, ?)")
+                params += [after_name, after_id]
+            order_by = "u.user_name COLLATE NOCASE, u.id"
+        else:
+            if after is not None:
+                conditions.append("u.id > ?")
+                params.append(after)
+            order_by = "u.id"
 
-        if not row:
-            return
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._reader() as cursor:
+            cursor.execute(
+                f"SELECT u.* FROM users u {where} ORDER BY {order_by} LIMIT ?",
+                (*params, limit + 1),
+            )
+            rows = [dict(row) for row in cursor.fetchall()]
 
-        channels = json.loads(row['value'])
-        filtered = [ch for ch in channels if ch['id'] != channel_id]
-        json_value = json.dumps(filtered)
+        next_after = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_after = (last["user_name"], last["id"]) if search else last["id"]
+        return {"users": rows, "next_after": next_after}
 
-        self.cursor.execute("""
-            UPDATE settings SET value = ?
-            WHERE key = 'channel'
-        """, (json_value,))
-        self.conn.commit()
+    @staticmethod
+    def _payment_filters(status, method, telegram_id):
+        conditions = []
+        params = []
+        if status is not None:
+            conditions.append("status = ?")
+            params.append(status)
+        if method is not None:
+            conditions.append("method = ?")
+            params.append(method)
+        if telegram_id is not None:
+            conditions.append("telegram_id = ?")
+            params.append(telegram_id)
+        return conditions, params
 
-    def get_channels(self):
-        self.cursor.execute("SELECT value FROM settings WHERE key = 'channel'")
-        row = self.cursor.fetchone()
-        if row:
-            try:
-                return json.loads(row['value'])
-            except json.JSONDecodeError:
-                return []
-        return []
-    
-    def get_free_crypto_address(self):
-        self.cursor.execute("SELECT value FROM settings WHERE key = 'crypto_address'")
-        row = self.cursor.fetchone()
-        addresses = json.loads(row["value"])
+    def list_payments(self, *, status=None, method=None, telegram_id=None, after=None, limit=LIST_DEFAULT_LIMIT):
+        """
+        One page of payments, newest first, plus the id to pass as `after` for the next page.
+        Each filter rides an index whose implicit rowid suffix gives the order for free.
+        """
+        limit = self._list_limit(limit)
+        conditions, params = self._payment_filters(status, method, telegram_id)
+        if after is not None:
+            conditions.append("id < ?")
+            params.append(after)
 
-        for item in addresses:
-            if not item["used"]:
-                return item["address"]
-        return None
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._reader() as cursor:
+            cursor.execute(
+                f"SELECT * FROM payments {where} ORDER BY id DESC LIMIT ?",
+                (*params, limit + 1),
+            )
+            rows = [dict(row) for row in cursor.fetchall()]
 
-    def mark_address_as_used(self, address_to_mark):
-        self.cursor.execute("SELECT value FROM settings WHERE key = 'crypto_address'")
-        row = self.cursor.fetchone()
-        addresses = json.loads(row["value"])
+        next_after = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_after = rows[-1]["id"]
+        return {"payments": rows, "next_after": next_after}
 
-        for item in addresses:
-            if item["address"] == address_to_mark:
-                item["used"] = True
-                break
+    def iter_users(self, *, status=None, plan=None, job_title=None, expiring_threshold_days=7, batch_size=500):
+        """
+        Every matching user as a dict, in id order, read `batch_size` rows at a time.
+        Holds one pooled reader until the generator is exhausted or closed.
+        """
+        conditions, params = self._user_filters(status, plan, job_title, expiring_threshold_days)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._reader() as cursor:
+            cursor.execute(f"SELECT u.* FROM users u {where} ORDER BY u.id", params)
+            while rows := cursor.fetchmany(batch_size):
+                for row in rows:
+                    yield dict(row)
+
+    def iter_payments(
+        self,
+        *,
+        status=None,
+        method=None,
+        telegram_id=None,
+        since=None,
+        until=None,
+        batch_size=500,
+    ):
+        """
+        Every matching payment as a dict, oldest first, read `batch_size` rows at a time.
+        since/until bound created_at (UTC, 'YYYY-MM-DD[ HH:MM:SS]'), until is exclusive.
+        """
+        conditions, params = self._payment_filters(status, method, telegram_id)
+        if since is not None:
+            conditions.append("created_at >= ?")
+            params.append(str(since))
+        if until is not None:
+            conditions.append("created_at < ?")
+            params.append(str(until))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._reader() as cursor:
+            # payloads live in payment_raw, the legacy column is always empty
+            cursor.execute(f"SELECT * FROM payments {where} ORDER BY id", params)
+            while rows := cursor.fetchmany(batch_size):
+                for row in rows:
+                    item = dict(row)
+                    item.pop("raw_response", None)
+                    yield item
 
+    def export_users(self, path, fmt="csv", **filters) -> int:
+        """Stream iter_users(**filters) into a CSV or NDJSON file; returns the row count."""
+        return export_rows(self.iter_users(**filters), path, fmt)
+
+    def export_payments(self, path, fmt="csv", **filters) -> int:
+        """Stream iter_payments(**filters) into a CSV or NDJSON file; returns the row count."""
+        return export_rows(self.iter_payments(**filters), path, fmt)
+
+    def enqueue_outbox(self, kind, payload, *, delay=0.0, dedupe_key=None):
+        """
+        Queue a side effect for the outbox worker; returns the job id, or None when a
+        pending/running job with the same dedupe_key already exists.
+        Inside transaction() the job commits (or rolls back) with the other writes.
+        """
         self.cursor.execute(
-            "UPDATE settings SET value = ? WHERE key = 'crypto_address'",
-            (json.dumps(addresses),)
+            "INSERT OR IGNORE INTO outbox (kind, payload, run_at, dedupe_key) VALUES (?, ?, ?, ?)",
+            (kind, json.dumps(payload, ensure_ascii=False, default=str), time.time() + delay, dedupe_key),
         )
-        self.conn.commit()
+        job_id = self.cursor.lastrowid if self.cursor.rowcount else None
+        if job_id is not None:
+            self._emit("outbox", id=job_id, kind=kind)
+        self._commit()
+        return job_id
 
-    def unmark_address_as_used(self, address_to_unmark):
-        self.cursor.execute("SELECT value FROM settings WHERE key = 'crypto_address'")
-        row = self.cursor.fetchone()
-        if not row:
-            return
+    def claim_outbox(self, limit, lease_seconds):
+        """
+        Lease up to `limit` due jobs to the caller: status becomes running and attempts
+        grows by one. Jobs of a worker that died come back once their lease expires.
+        """
+        if limit <= 0:
+            return []
+        now = time.time()
+        with self.transaction():
+            rows = self.cursor.execute(
+                """
+                UPDATE outbox
+                SET status = 'running', attempts = attempts + 1, locked_until = ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id IN (
+                    SELECT id FROM outbox
+                    WHERE (status = 'pending' AND run_at <= ?)
+                       OR (status = 'running' AND locked_until <= ?)
+                    ORDER BY run_at
+                    LIMIT ?
+                )
+                RETURNING id, kind, payload, attempts
+                """,
+                (now + lease_seconds, now, now, limit),
+            ).fetchall()
+        jobs = [dict(row) for row in rows]
+        for job in jobs:
+            job["payload"] = self._safe_json_loads(job["payload"], {})
+        return jobs
 
-        addresses = json.loads(row["value"])
+    def complete_outbox(self, job_id, follow_up=()):
+        """Mark a job done and queue its (kind, payload) follow-ups in the same commit."""
+        with self.transaction():
+            self.cursor.execute(
+                """
+                UPDATE outbox SET status = 'done', locked_until = NULL, last_error = NULL,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+                """,
+                (job_id,),
+            )
+            for kind, payload in follow_up:
+                self.enqueue_outbox(kind, payload)
 
-        for item in addresses:
-            if item["address"] == address_to_unmark:
-                item["used"] = False
-                break
+    def save_outbox_payload(self, job_id, payload):
+        """Persist a running job's payload (progress a retry must see); committed right away."""
+        with self.transaction():
+            self.cursor.execute(
+                "UPDATE outbox SET payload = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ? AND status = 'running'",
+                (json.dumps(payload, ensure_ascii=False, default=str), job_id),
+            )
 
+    def fail_outbox(self, job_id, error, *, retry_in=None):
+        """Put a failed job back for another try in `retry_in` seconds, or dead-letter it (retry_in=None)."""
+        if retry_in is None:
+            self.cursor.execute(
+                """
+                UPDATE outbox SET status = 'dead', locked_until = NULL, last_error = ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+                """,
+                (error, job_id),
+            )
+        else:
+            self.cursor.execute(
+                """
+                UPDATE outbox SET status = 'pending', run_at = ?, locked_until = NULL, last_error = ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+                """,
+                (time.time() + retry_in, error, job_id),
+            )
+        self._commit()
+
+    def requeue_outbox(self, job_id=None):
+        """
+        Send dead jobs (one, or all when job_id is None) back to pending.
+
+        A dead job whose dedupe_key is already taken by a live job (or by a newer
+        dead one requeued in the same call) stays dead, the live copy does the work.
+        Returns (requeued, skipped).
+        """
+        query = "SELECT id, dedupe_key FROM outbox WHERE status = 'dead'"
+        params = []
+        if job_id is not None:
+            query += " AND id = ?"
+            params.append(job_id)
+        dead = self.cursor.execute(query + " ORDER BY id DESC", params).fetchall()
+        taken = {
+            row[0]
+            for row in self.cursor.execute(
+                "SELECT dedupe_key FROM outbox WHERE status IN ('pending', 'running') AND dedupe_key IS NOT NULL"
+            )
+        }
+        ids = []
+        for dead_id, dedupe_key in dead:
+            if dedupe_key is not None:
+                if dedupe_key in taken:
+                    continue
+                taken.add(dedupe_key)
+            ids.append(dead_id)
+        now = time.time()
+        self.cursor.executemany(
+            "UPDATE outbox SET status = 'pending', attempts = 0, run_at = ?, updated_at = CURRENT_TIMESTAMP "
+            "WHERE id = ?",
+            [(now, dead_id) for dead_id in ids],
+        )
+        if ids:
+            self._emit("outbox", requeued=len(ids))
+        self._commit()
+        return len(ids), len(dead) - len(ids)
+
+    def prune_outbox(self, older_than_days=7):
+        """Delete done jobs last touched more than `older_than_days` ago."""
         self.cursor.execute(
-            "UPDATE settings SET value = ? WHERE key = 'crypto_address'",
-            (json.dumps(addresses),)
+            "DELETE FROM outbox WHERE status = 'done' AND updated_at < datetime('now', ?)",
+            (f"-{int(older_than_days)} days",),
         )
-        self.conn.commit()
+        count = self.cursor.rowcount
+        self._commit()
+        return count
+
+    def outbox_next_run_at(self):
+        """Earliest epoch at which a pending job is due or a running lease expires, None if idle."""
+        with self._reader() as cursor:
+            row = cursor.execute(
+                """
+                SELECT MIN(at) FROM (
+                    SELECT MIN(run_at) AS at FROM outbox WHERE status = 'pending'
+                    UNION ALL
+                    SELECT MIN(locked_until) FROM outbox WHERE status = 'running'
+                )
+                """
+            ).fetchone()
+        return row[0]
+
+    def get_outbox_counts(self):
+        with self._reader() as cursor:
+            rows = cursor.execute("SELECT status, COUNT(*) AS n FROM outbox GROUP BY status").fetchall()
+        counts = dict.fromkeys(OUTBOX_STATUSES, 0)
+        counts.update({row["status"]: row["n"] for row in rows})
+        return counts
+
+    def list_outbox(self, *, status="dead", limit=LIST_DEFAULT_LIMIT):
+        with self._reader() as cursor:
+            rows = cursor.execute(
+                """
+                SELECT id, kind, payload, status, attempts, last_error, updated_at
+                FROM outbox WHERE status = ? ORDER BY id DESC LIMIT ?
+                """,
+                (status, self._list_limit(limit)),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def _invalidate_channels(self):
+        self._channels_gen += 1
+        self._channels = None
+
+    def _load_channels(self):
+        cached = self._channels
+        if cached is not None:
+            return cached
+
+        generation = self._channels_gen
+        with self._reader() as cursor:
+            rows = cursor.execute("SELECT channel_id, name FROM channels ORDER BY id").fetchall()
+        channels = [{"name": row["name"], "id": row["channel_id"]} for row in rows]
+        by_name = {}
+        for ch in channels:
+            # first match wins, same as the old list scan
+            by_name.setdefault(ch["name"], ch["id"])
+        cached = (channels, by_name)
+        # a concurrent add/remove invalidated while we were reading, don't cache stale rows
+        if generation == self._channels_gen:
+            self._channels = cached
+        return cached
+
+    def add_channel(self, name, channel_id):
+        self.cursor.execute(
+            """
+            INSERT INTO channels (channel_id, name)
+            VALUES (?, ?)
+            ON CONFLICT(channel_id) DO UPDATE SET name = excluded.name
+            """,
+            (channel_id, name),
+        )
+        self._emit("channel", id=channel_id)
+        self._commit()
+        self._invalidate_channels()
+
+    def remove_channel_by_id(self, channel_id):
+        self.cursor.execute("DELETE FROM channels WHERE channel_id = ?", (channel_id,))
+        self._emit("channel", id=channel_id)
+        self._commit()
+        self._invalidate_channels()
+
+    def get_channels(self):
+        channels, _ = self._load_channels()
+        return [dict(ch) for ch in channels]
 
-    def get_dashboard_snapshot(self, *, payments_limit: int = 120, expiring_threshold_days: int = 7):
+    def get_channel_id(self, name):
+        _, by_name = self._load_channels()
+        return by_name.get(name)
+
+    def lease_crypto_address(self, telegram_id, *, lease_seconds=CRYPTO_LEASE_SECONDS):
         """
-        Aggregate dashboard-friendly payload with users, payments and channels.
+        Atomically lease a free wallet (or one whose lease expired) to telegram_id.
+        Returns the address or None when the whole pool is busy.
         """
-        now = datetime.now()
+        now = int(time.time())
+        self.cursor.execute(
+            """
+            UPDATE crypto_addresses
+            SET leased_by = ?, leased_at = ?, lease_expires_at = ?
+            WHERE address = (
+                SELECT address FROM crypto_addresses
+                WHERE lease_expires_at IS NULL OR lease_expires_at <= ?
+                ORDER BY lease_expires_at
+                LIMIT 1
+            )
+            RETURNING address
+            """,
+            (telegram_id, now, now + int(lease_seconds), now),
+        )
+        rows = self.cursor.fetchall()
+        self._commit()
+        row = rows[0] if rows else None
+        return row["address"] if row else None
 
-        users_raw = []
-        if self._table_exists("users"):
-            users_raw = [dict(row) for row in self.cursor.execute("SELECT * FROM users")]
+    def release_crypto_address(self, address, telegram_id=None):
+        """Return a wallet to the pool; with telegram_id only that holder's lease is released."""
+        query = """
+            UPDATE crypto_addresses
+            SET leased_by = NULL, leased_at = NULL, lease_expires_at = NULL
+            WHERE address = ?
+        """
+        params = [address]
+        if telegram_id is not None:
+            query += " AND leased_by = ?"
+            params.append(telegram_id)
+        self.cursor.execute(query, params)
+        self._commit()
 
-        payments_raw = []
-        if self._table_exists("payments"):
-            payments_raw = [
+    def get_dashboard_snapshot(
+        self,
+        *,
+        payments_limit: int = 120,
+        expiring_threshold_days: int = 7,
+        include_users: bool = True,
+    ):
+        """
+        Aggregate dashboard-friendly payload with users, payments, channels and stats.
+        Stats and channel counts come from the aggregate tables; pass include_users=False
+        to skip the per-user list, the only part that still grows with the user base.
+        """
+        with self._reader() as cursor:
+            return self._dashboard_snapshot(
+                cursor, time.time(), payments_limit, expiring_threshold_days, include_users
+            )
+
+    def get_dashboard_snapshot_json(
+        self,
+        *,
+        payments_limit: int = 120,
+        expiring_threshold_days: int = 7,
+        include_users: bool = True,
+    ):
+        """
+        (etag, JSON body) of get_dashboard_snapshot. The body is rebuilt only when another
+        connection committed (PRAGMA data_version) or the minute changed, statuses depend on time.
+        """
+        now_ts = time.time()
+        params = (int(payments_limit), expiring_threshold_days, bool(include_users), int(now_ts // 60))
+        with self._reader() as cursor:
+            conn = cursor.connection
+            # the writer connection serves uncommitted writes and its data_version ignores them
+            cacheable = conn is not self.conn
+            if cacheable:
+                key = (cursor.execute("PRAGMA data_version").fetchone()[0], *params)
+                cached = self._snapshot_cache.get(id(conn))
+                if cached is not None and cached[0] == key:
+                    return cached[1], cached[2]
+            snapshot = self._dashboard_snapshot(
+                cursor, now_ts, payments_limit, expiring_threshold_days, include_users
+            )
+
+        body = json.dumps(snapshot, ensure_ascii=False, separators=(",", ":"), default=str)
+        etag = '"' + hashlib.sha1(body.encode("utf-8")).hexdigest() + '"'
+        if cacheable:
+            self._snapshot_cache[id(conn)] = (key, etag, body)
+        return etag, body
+
+    def _dashboard_snapshot(self, cursor, now_ts, payments_limit, expiring_threshold_days, include_users):
+        users_raw = []
+        user_plans = {}
+        # one read transaction so every part comes from the same snapshot
+        if not cursor.connection.in_transaction:
+            cursor.execute("BEGIN")
+        stats = self._user_status_counts(cursor, now_ts, expiring_threshold_days)
+        month_start = datetime.fromtimestamp(now_ts, KYIV).date().replace(day=1)
+        stats["revenueMonth"] = cursor.execute(
+            "SELECT COALESCE(SUM(amount), 0) FROM revenue_daily WHERE day >= ?",
+            (month_start.isoformat(),),
+        ).fetchone()[0]
+        member_counts = self._plan_member_counts(cursor, now_ts)
+        if include_users:
+            users_raw = [
                 dict(row)
-                for row in self.cursor.execute(
-                    "SELECT * FROM payments ORDER BY created_at DESC LIMIT ?",
-                    (int(payments_limit),),
+                for row in cursor.execute(
+                    """
+                    SELECT u.*, lp.amount AS plan_price
+                    FROM users u
+                    LEFT JOIN user_latest_paid lp ON lp.telegram_id = u.telegram_id
+                    """
                 )
             ]
+            for row in cursor.execute("SELECT telegram_id, plan FROM user_plans ORDER BY rowid"):
+                user_plans.setdefault(row["telegram_id"], []).append(row["plan"])
 
-        latest_paid = {}
-        for row in payments_raw:
-            status = (row.get("status") or "").lower()
-            if status != "paid":
-                continue
-            ts = self._coerce_datetime(
-                row.get("paid_at")
-                or row.get("tx_timestamp")
-                or row.get("updated_at")
-                or row.get("created_at")
-            ) or datetime.min
-            uid = row.get("telegram_id")
-            if uid is None:
-                continue
-            prev = latest_paid.get(uid)
-            if prev is None or ts > prev["ts"]:
-                latest_paid[uid] = {"ts": ts, "amount": float(row.get("amount") or 0)}
-
-        users = []
-        for row in users_raw:
-            plans = self._safe_json_loads(row.get("subscription_plan"), [])
-            parsed_end, normalized_end = self._parse_subscription_end(row.get("subscription_end"))
-            status = self._status_for_subscription_end(parsed_end, expiring_threshold_days, now)
-            plan_price = latest_paid.get(row.get("telegram_id"), {}).get("amount")
-            users.append(
-                {
-                    "telegramId": row.get("telegram_id"),
-                    "userName": row.get("user_name") or "",
-                    "firstName": row.get("first_name"),
-                    "plan": plans or [],
-                    "subscriptionEnd": normalized_end,
-                    "status": status,
-                    "jobTitle": row.get("job_title") or "user",
-                    "planPrice": plan_price,
-                }
+        payments_raw = [
+            dict(row)
+            for row in cursor.execute(
+                "SELECT * FROM payments ORDER BY created_at DESC LIMIT ?",
+                (int(payments_limit),),
             )
+        ]
+        # reuse the cursor: a second pooled reader could deadlock a pool of one
+        if self._channels is not None:
+            channel_list = self._channels[0]
+        else:
+            channel_list = cursor.execute("SELECT name FROM channels ORDER BY id").fetchall()
 
-        channels_src = self.get_channels() if self._table_exists("settings") else []
-        active_users = [u for u in users if u["status"] != "expired"]
+        users = [
+            self._dashboard_user(
+                row, user_plans.get(row["telegram_id"], []), now_ts, expiring_threshold_days
+            )
+            for row in users_raw
+        ]
         channels = [
-            {
-                "name": ch["name"],
-                "members": sum(1 for u in active_users if ch["name"] in (u.get("plan") or [])),
-            }
-            for ch in channels_src
+            {"name": ch["name"], "members": member_counts.get(ch["name"], 0)}
+            for ch in channel_list
         ]
+        payments = [self._dashboard_payment(row) for row in payments_raw]
 
-        payments = []
-        for row in payments_raw:
-            payments.append(
-                {
-                    "id": row.get("id"),
-                    "telegramId": row.get("telegram_id"),
-                    "userName": row.get("user_name") or str(row.get("telegram_id")),
-                    "amount": float(row.get("amount") or 0),
-                    "status": row.get("status"),
-                    "paidAt": row.get("paid_at"),
-                    "plan": row.get("plan"),
-                    "method": row.get("method"),
-                    "walletAddress": row.get("wallet_address"),
-                    "walletFrom": row.get("tx_from"),
-                }
-            )
+        return {"users": users, "payments": payments, "channels": channels, "stats": stats}
 
-        return {"users": users, "payments": payments, "channels": channels}
+    @classmethod
+    def _dashboard_user(cls, row, plans, now_ts, expiring_threshold_days):
+        _, normalized_end = cls._parse_subscription_end(row.get("subscription_end"))
+        plan_price = row.get("plan_price")
+        return {
+            "telegramId": row.get("telegram_id"),
+            "userName": row.get("user_name") or "",
+            "firstName": row.get("first_name"),
+            "plan": plans or [],
+            "subscriptionEnd": normalized_end,
+            "status": cls._status_for_subscription_ts(
+                row.get("subscription_end_ts"), expiring_threshold_days, now_ts
+            ),
+            "jobTitle": row.get("job_title") or "user",
+            "planPrice": float(plan_price) if plan_price is not None else None,
+        }
+
+    @staticmethod
+    def _dashboard_payment(row):
+        return {
+            "id": row.get("id"),
+            "telegramId": row.get("telegram_id"),
+            "userName": row.get("user_name") or str(row.get("telegram_id")),
+            "amount": float(row.get("amount") or 0),
+            "status": row.get("status"),
+            "paidAt": row.get("paid_at"),
+            "plan": row.get("plan"),
+            "method": row.get("method"),
+            "walletAddress": row.get("wallet_address"),
+            "walletFrom": row.get("tx_from"),
+        }
+
+    def get_dashboard_changes(self, since_cursor=None, *, expiring_threshold_days: int = 7):
+        """
+        Users and payments inserted or updated since since_cursor (None = everything),
+        in the same shape as get_dashboard_snapshot, plus the cursor for the next call.
+
+        The cursor is inclusive and trails the clock by CHANGES_OVERLAP_SECONDS, so rows
+        stamped just before a late commit (group commit, long transaction) are not lost;
+        clients upsert by telegramId / id and simply see those rows twice.
+        """
+        users_since, payments_since = None, None
+        if since_cursor:
+            users_part, _, payments_part = str(since_cursor).partition("|")
+            users_since, payments_since = users_part or None, payments_part or None
+
+        now_ts = time.time()
+        overlap = f"-{CHANGES_OVERLAP_SECONDS} seconds"
+        with self._reader() as cursor:
+            if not cursor.connection.in_transaction:
+                cursor.execute("BEGIN")
+            users_floor, payments_floor = cursor.execute(
+                "SELECT strftime('%Y-%m-%d %H:%M:%f', 'now', ?), datetime('now', ?)",
+                (overlap, overlap),
+            ).fetchone()
+
+            users_raw = [
+                dict(row)
+                for row in cursor.execute(
+                    """
+                    SELECT u.*, lp.amount AS plan_price
+                    FROM users u
+                    LEFT JOIN user_latest_paid lp ON lp.telegram_id = u.telegram_id
+                    WHERE u.updated_at >= COALESCE(?, '')
+                    ORDER BY u.updated_at
+                    """,
+                    (users_since,),
+                )
+            ]
+            user_plans = {}
+            if users_raw:
+                ids = [row["telegram_id"] for row in users_raw]
+                placeholders = ", ".join("?" for _ in ids)
+                for row in cursor.execute(
+                    f"SELECT telegram_id, plan FROM user_plans WHERE telegram_id IN ({placeholders}) ORDER BY rowid",
+                    ids,
+                ):
+                    user_plans.setdefault(row["telegram_id"], []).append(row["plan"])
+
+            payments_raw = [
+                dict(row)
+                for row in cursor.execute(
+                    """
+                    SELECT * FROM payments
+                    WHERE updated_at >= COALESCE(?, '')
+                    ORDER BY updated_at, id
+                    """,
+                    (payments_since,),
+                )
+            ]
+
+        def next_position(since, rows, floor):
+            latest = max([since or ""] + [row["updated_at"] or "" for row in rows])
+            return min(latest, floor) if latest else floor
+
+        return {
+            "users": [
+                self._dashboard_user(
+                    row, user_plans.get(row["telegram_id"], []), now_ts, expiring_threshold_days
+                )
+                for row in users_raw
+            ],
+            "payments": [self._dashboard_payment(row) for row in payments_raw],
+            "cursor": "|".join((
+                next_position(users_since, users_raw, users_floor),
+                next_position(payments_since, payments_raw, payments_floor),
+            )),
+        }
 
     def close(self):
+        self.flush()
+        with self._read_lock:
+            for conn in self._read_conns:
+                conn.close()
+            self._read_conns.clear()
         self.cursor.close()
         self.conn.close()
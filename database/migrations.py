@@ -0,0 +1,647 @@
+"""
+Numbered schema migrations.
+
+Each migration runs once, inside its own transaction, and is recorded in the
+schema_version table. Migrations are written to be safe on databases that
+already got (part of) the change from the old ad-hoc _ensure_schema.
+"""
+import json
+import logging
+from collections import namedtuple
+
+from .compression import pack_json
+from .dates import payment_day, to_epoch
+
+logger = logging.getLogger(__name__)
+
+Migration = namedtuple("Migration", "version description apply")
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def register(func):
+        if MIGRATIONS and version <= MIGRATIONS[-1].version:
+            raise ValueError(f"Migration {version} is out of order")
+        MIGRATIONS.append(Migration(version, description, func))
+        return func
+    return register
+
+
+def _table_exists(cursor, table_name):
+    cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name = ? LIMIT 1;",
+        (table_name,),
+    )
+    return cursor.fetchone() is not None
+
+
+def _columns(cursor, table_name):
+    return {row[1] for row in cursor.execute(f"PRAGMA table_info({table_name})")}
+
+
+def _json_list(raw):
+    try:
+        value = json.loads(raw) if raw else []
+    except (TypeError, ValueError):
+        return []
+    return value if isinstance(value, list) else []
+
+
+@migration(1, "users and settings tables")
+def _base_tables(cursor):
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL UNIQUE,
+            user_name TEXT,
+            first_name TEXT,
+            subscription_plan TEXT DEFAULT '[]',
+            subscription_end DATETIME,
+            job_title TEXT DEFAULT 'user',
+            access_granted INTEGER DEFAULT 0,
+            payment INTEGER DEFAULT 0,
+            notified_marks TEXT DEFAULT '[]'
+        );
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        """
+    )
+
+
+@migration(2, "payments table")
+def _payments(cursor):
+    # payments table to store every payment attempt and provider/admin payloads
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            plan TEXT,
+            amount REAL,
+            status TEXT NOT NULL,
+            provider_invoice_id TEXT,
+            pay_url TEXT,
+            wallet_address TEXT,
+            tx_hash TEXT,
+            tx_from TEXT,
+            tx_to TEXT,
+            tx_value REAL,
+            tx_timestamp DATETIME,
+            user_name TEXT,
+            first_name TEXT,
+            admin_id INTEGER,
+            admin_name TEXT,
+            old_subscription_end DATETIME,
+            new_subscription_end DATETIME,
+            payload TEXT,
+            description TEXT,
+            raw_response TEXT,
+            paid_at DATETIME,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+    existing_cols = _columns(cursor, "payments")
+    # columns added over time, old databases may miss some of them
+    for col, ddl in [
+        ("tx_hash", "ALTER TABLE payments ADD COLUMN tx_hash TEXT"),
+        ("tx_from", "ALTER TABLE payments ADD COLUMN tx_from TEXT"),
+        ("tx_to", "ALTER TABLE payments ADD COLUMN tx_to TEXT"),
+        ("tx_value", "ALTER TABLE payments ADD COLUMN tx_value REAL"),
+        ("tx_timestamp", "ALTER TABLE payments ADD COLUMN tx_timestamp DATETIME"),
+        ("user_name", "ALTER TABLE payments ADD COLUMN user_name TEXT"),
+        ("first_name", "ALTER TABLE payments ADD COLUMN first_name TEXT"),
+        ("admin_id", "ALTER TABLE payments ADD COLUMN admin_id INTEGER"),
+        ("admin_name", "ALTER TABLE payments ADD COLUMN admin_name TEXT"),
+        ("old_subscription_end", "ALTER TABLE payments ADD COLUMN old_subscription_end DATETIME"),
+        ("new_subscription_end", "ALTER TABLE payments ADD COLUMN new_subscription_end DATETIME"),
+        ("payload", "ALTER TABLE payments ADD COLUMN payload TEXT"),
+        ("description", "ALTER TABLE payments ADD COLUMN description TEXT"),
+        ("raw_response", "ALTER TABLE payments ADD COLUMN raw_response TEXT"),
+        ("paid_at", "ALTER TABLE payments ADD COLUMN paid_at DATETIME"),
+        ("created_at", "ALTER TABLE payments ADD COLUMN created_at DATETIME DEFAULT CURRENT_TIMESTAMP"),
+        ("updated_at", "ALTER TABLE payments ADD COLUMN updated_at DATETIME DEFAULT CURRENT_TIMESTAMP"),
+    ]:
+        if col not in existing_cols:
+            cursor.execute(ddl)
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(telegram_id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status);")
+
+
+@migration(3, "crypto address pool")
+def _crypto_addresses(cursor):
+    # wallet pool for USDT checkouts, leased atomically instead of JSON flags in settings
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS crypto_addresses (
+            address TEXT PRIMARY KEY,
+            leased_by INTEGER,
+            leased_at INTEGER,
+            lease_expires_at INTEGER
+        );
+        """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_crypto_addresses_expires ON crypto_addresses(lease_expires_at);"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_crypto_addresses_leased_by ON crypto_addresses(leased_by);"
+    )
+
+
+@migration(4, "channels table")
+def _channels(cursor):
+    # channels used to live as a JSON list in settings.channel
+    channels_existed = _table_exists(cursor, "channels")
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS channels (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel_id INTEGER NOT NULL UNIQUE,
+            name TEXT NOT NULL
+        );
+        """
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_channels_name ON channels(name);")
+    if channels_existed:
+        return
+
+    row = cursor.execute("SELECT value FROM settings WHERE key = 'channel'").fetchone()
+    cursor.executemany(
+        "INSERT OR IGNORE INTO channels (channel_id, name) VALUES (?, ?)",
+        [
+            (ch["id"], ch.get("name") or "")
+            for ch in _json_list(row[0] if row else None)
+            if isinstance(ch, dict) and ch.get("id") is not None
+        ],
+    )
+
+
+@migration(5, "user_plans membership table")
+def _user_plans(cursor):
+    # user <-> plan membership, replaces the users.subscription_plan JSON list
+    user_plans_existed = _table_exists(cursor, "user_plans")
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_plans (
+            telegram_id INTEGER NOT NULL,
+            plan TEXT NOT NULL,
+            added_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (telegram_id, plan)
+        );
+        """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_user_plans_plan ON user_plans(plan, telegram_id);"
+    )
+    if user_plans_existed:
+        return
+
+    rows = cursor.execute(
+        "SELECT telegram_id, subscription_plan FROM users WHERE subscription_plan IS NOT NULL"
+    ).fetchall()
+    cursor.executemany(
+        "INSERT OR IGNORE INTO user_plans (telegram_id, plan) VALUES (?, ?)",
+        [
+            (telegram_id, plan)
+            for telegram_id, raw in rows
+            for plan in _json_list(raw)
+            if isinstance(plan, str) and plan
+        ],
+    )
+
+
+@migration(6, "users.subscription_end_ts")
+def _subscription_end_ts(cursor):
+    """Typed epoch copy of users.subscription_end, indexed for expiry range queries."""
+    if "subscription_end_ts" not in _columns(cursor, "users"):
+        cursor.execute("ALTER TABLE users ADD COLUMN subscription_end_ts INTEGER")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_subscription_end_ts ON users(subscription_end_ts);"
+    )
+    rows = cursor.execute(
+        """
+        SELECT telegram_id, subscription_end FROM users
+        WHERE subscription_end_ts IS NULL AND subscription_end IS NOT NULL
+        """
+    ).fetchall()
+    cursor.executemany(
+        "UPDATE users SET subscription_end_ts = ? WHERE telegram_id = ?",
+        [(to_epoch(subscription_end), telegram_id) for telegram_id, subscription_end in rows],
+    )
+
+
+# UTC day bucket of an epoch column, users without an end date go to day -1
+def _day(column):
+    return f"CAST({column} / 86400 AS INTEGER)"
+
+
+_PAID_AT_JD = (
+    "COALESCE(julianday(paid_at), julianday(tx_timestamp), "
+    "julianday(updated_at), julianday(created_at), 0)"
+)
+
+
+def _recompute_latest_paid(*telegram_ids):
+    ids = ", ".join(telegram_ids)
+    return f"""
+        DELETE FROM user_latest_paid WHERE telegram_id IN ({ids});
+        INSERT INTO user_latest_paid (telegram_id, payment_id, paid_jd, amount)
+        SELECT telegram_id, id, MAX({_PAID_AT_JD}), amount
+        FROM payments
+        WHERE telegram_id IN ({ids}) AND lower(status) = 'paid'
+        GROUP BY telegram_id;
+    """
+
+
+@migration(7, "dashboard aggregate tables")
+def _dashboard_aggregates(cursor):
+    """
+    Counters kept in step with users/user_plans/payments by triggers, so the
+    dashboard reads O(days + plans) rows instead of scanning every user.
+    """
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_expiry_days (
+            job_title TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            users INTEGER NOT NULL,
+            PRIMARY KEY (job_title, day)
+        ) WITHOUT ROWID;
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS plan_expiry_days (
+            plan TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            members INTEGER NOT NULL,
+            PRIMARY KEY (plan, day)
+        ) WITHOUT ROWID;
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_latest_paid (
+            telegram_id INTEGER PRIMARY KEY,
+            payment_id INTEGER NOT NULL,
+            paid_jd REAL NOT NULL,
+            amount REAL
+        );
+        """
+    )
+
+    new_day = _day("NEW.subscription_end_ts")
+    old_day = _day("OLD.subscription_end_ts")
+    triggers = f"""
+        CREATE TRIGGER IF NOT EXISTS trg_users_agg_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO user_expiry_days (job_title, day, users)
+            VALUES (COALESCE(NEW.job_title, 'user'), COALESCE({new_day}, -1), 1)
+            ON CONFLICT(job_title, day) DO UPDATE SET users = users + 1;
+            INSERT INTO plan_expiry_days (plan, day, members)
+            SELECT plan, {new_day}, 1 FROM user_plans
+            WHERE telegram_id = NEW.telegram_id AND NEW.subscription_end_ts IS NOT NULL
+            ON CONFLICT(plan, day) DO UPDATE SET members = members + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_users_agg_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE user_expiry_days SET users = users - 1
+            WHERE job_title = COALESCE(OLD.job_title, 'user') AND day = COALESCE({old_day}, -1);
+            UPDATE plan_expiry_days SET members = members - 1
+            WHERE day = {old_day}
+              AND plan IN (SELECT plan FROM user_plans WHERE telegram_id = OLD.telegram_id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_users_agg_update
+        AFTER UPDATE OF subscription_end_ts, job_title ON users
+        WHEN OLD.subscription_end_ts IS NOT NEW.subscription_end_ts
+          OR COALESCE(OLD.job_title, 'user') IS NOT COALESCE(NEW.job_title, 'user')
+        BEGIN
+            UPDATE user_expiry_days SET users = users - 1
+            WHERE job_title = COALESCE(OLD.job_title, 'user') AND day = COALESCE({old_day}, -1);
+            INSERT INTO user_expiry_days (job_title, day, users)
+            VALUES (COALESCE(NEW.job_title, 'user'), COALESCE({new_day}, -1), 1)
+            ON CONFLICT(job_title, day) DO UPDATE SET users = users + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_users_agg_plans_update
+        AFTER UPDATE OF subscription_end_ts ON users
+        WHEN {old_day} IS NOT {new_day}
+        BEGIN
+            UPDATE plan_expiry_days SET members = members - 1
+            WHERE day = {old_day}
+              AND plan IN (SELECT plan FROM user_plans WHERE telegram_id = OLD.telegram_id);
+            INSERT INTO plan_expiry_days (plan, day, members)
+            SELECT plan, {new_day}, 1 FROM user_plans
+            WHERE telegram_id = NEW.telegram_id AND NEW.subscription_end_ts IS NOT NULL
+            ON CONFLICT(plan, day) DO UPDATE SET members = members + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_user_plans_agg_insert AFTER INSERT ON user_plans
+        BEGIN
+            INSERT INTO plan_expiry_days (plan, day, members)
+            SELECT NEW.plan, {_day("subscription_end_ts")}, 1 FROM users
+            WHERE telegram_id = NEW.telegram_id AND subscription_end_ts IS NOT NULL
+            ON CONFLICT(plan, day) DO UPDATE SET members = members + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_user_plans_agg_delete AFTER DELETE ON user_plans
+        BEGIN
+            UPDATE plan_expiry_days SET members = members - 1
+            WHERE plan = OLD.plan
+              AND day IN (
+                  SELECT {_day("subscription_end_ts")} FROM users
+                  WHERE telegram_id = OLD.telegram_id AND subscription_end_ts IS NOT NULL
+              );
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_payments_latest_paid_insert AFTER INSERT ON payments
+        WHEN lower(NEW.status) = 'paid'
+        BEGIN
+            {_recompute_latest_paid("NEW.telegram_id")}
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_payments_latest_paid_update
+        AFTER UPDATE OF telegram_id, status, amount, paid_at, tx_timestamp, updated_at ON payments
+        WHEN lower(OLD.status) = 'paid' OR lower(NEW.status) = 'paid'
+        BEGIN
+            {_recompute_latest_paid("OLD.telegram_id", "NEW.telegram_id")}
+        END;
+    """
+    for statement in triggers.split("END;"):
+        if statement.strip():
+            cursor.execute(statement + "END;")
+
+    # rebuild from the current rows
+    cursor.execute("DELETE FROM user_expiry_days")
+    cursor.execute(
+        f"""
+        INSERT INTO user_expiry_days (job_title, day, users)
+        SELECT COALESCE(job_title, 'user'), COALESCE({_day("subscription_end_ts")}, -1), COUNT(*)
+        FROM users
+        GROUP BY 1, 2
+        """
+    )
+    cursor.execute("DELETE FROM plan_expiry_days")
+    cursor.execute(
+        f"""
+        INSERT INTO plan_expiry_days (plan, day, members)
+        SELECT up.plan, {_day("u.subscription_end_ts")}, COUNT(*)
+        FROM user_plans up
+        JOIN users u ON u.telegram_id = up.telegram_id
+        WHERE u.subscription_end_ts IS NOT NULL
+        GROUP BY 1, 2
+        """
+    )
+    cursor.execute("DELETE FROM user_latest_paid")
+    cursor.execute(
+        f"""
+        INSERT INTO user_latest_paid (telegram_id, payment_id, paid_jd, amount)
+        SELECT telegram_id, id, MAX({_PAID_AT_JD}), amount
+        FROM payments
+        WHERE telegram_id IS NOT NULL AND lower(status) = 'paid'
+        GROUP BY telegram_id
+        """
+    )
+
+
+# millisecond UTC text, sorts the same way as payments.updated_at
+NOW_MS = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+
+@migration(8, "users.updated_at change tracking")
+def _users_updated_at(cursor):
+    if "updated_at" not in _columns(cursor, "users"):
+        # ADD COLUMN cannot take a non-constant default, the triggers below fill it
+        cursor.execute("ALTER TABLE users ADD COLUMN updated_at TEXT")
+    cursor.execute(f"UPDATE users SET updated_at = {NOW_MS} WHERE updated_at IS NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_updated_at ON users(updated_at);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_updated_at ON payments(updated_at);")
+
+    triggers = f"""
+        CREATE TRIGGER IF NOT EXISTS trg_users_touch_insert AFTER INSERT ON users
+        WHEN NEW.updated_at IS NULL
+        BEGIN
+            UPDATE users SET updated_at = {NOW_MS} WHERE rowid = NEW.rowid;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_users_touch_update AFTER UPDATE ON users
+        WHEN NEW.updated_at IS OLD.updated_at
+        BEGIN
+            UPDATE users SET updated_at = {NOW_MS} WHERE rowid = NEW.rowid;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_user_plans_touch_insert AFTER INSERT ON user_plans
+        BEGIN
+            UPDATE users SET updated_at = {NOW_MS} WHERE telegram_id = NEW.telegram_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_user_plans_touch_delete AFTER DELETE ON user_plans
+        BEGIN
+            UPDATE users SET updated_at = {NOW_MS} WHERE telegram_id = OLD.telegram_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_user_latest_paid_touch AFTER INSERT ON user_latest_paid
+        BEGIN
+            UPDATE users SET updated_at = {NOW_MS} WHERE telegram_id = NEW.telegram_id;
+        END;
+    """
+    for statement in triggers.split("END;"):
+        if statement.strip():
+            cursor.execute(statement + "END;")
+
+
+@migration(9, "indexes for paginated user/payment listings")
+def _listing_indexes(cursor):
+    # prefix search on user_name, ASCII case-insensitive like Telegram usernames
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_user_name ON users(user_name COLLATE NOCASE);"
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_method ON payments(method);")
+
+
+def revenue_totals(cursor, batch_size=1000, source="payments"):
+    """
+    ({(day, method, plan): (payments, amount)}, counted) over every paid payment.
+
+    `source` is the table (or parenthesised subquery) to read payments from.
+    """
+    totals = {}
+    counted = 0
+    cursor.execute(
+        f"""
+        SELECT method, plan, amount, paid_at, tx_timestamp, updated_at, created_at
+        FROM {source} WHERE lower(status) = 'paid'
+        """
+    )
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for method, plan, amount, paid_at, tx_timestamp, updated_at, created_at in rows:
+            key = (payment_day(paid_at, tx_timestamp, updated_at, created_at), method or "", plan or "")
+            payments, total = totals.get(key, (0, 0.0))
+            totals[key] = (payments + 1, total + float(amount or 0))
+            counted += 1
+    return totals, counted
+
+
+def fill_revenue_daily(cursor, batch_size=1000, source="payments") -> int:
+    """Recompute revenue_daily from every paid payment; returns how many payments were counted."""
+    totals, counted = revenue_totals(cursor, batch_size, source)
+    cursor.execute("DELETE FROM revenue_daily")
+    cursor.executemany(
+        "INSERT INTO revenue_daily (day, method, plan, payments, amount) VALUES (?, ?, ?, ?, ?)",
+        [(*key, payments, total) for key, (payments, total) in totals.items()],
+    )
+    return counted
+
+
+@migration(10, "revenue_daily rollup")
+def _revenue_daily(cursor):
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS revenue_daily (
+            day TEXT NOT NULL,
+            method TEXT NOT NULL,
+            plan TEXT NOT NULL,
+            payments INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            PRIMARY KEY (day, method, plan)
+        ) WITHOUT ROWID;
+        """
+    )
+    fill_revenue_daily(cursor)
+
+
+@migration(11, "compressed payment_raw side table")
+def _payment_raw(cursor, batch_size=500):
+    """
+    Provider payloads move out of payments.raw_response into payment_raw, one
+    zlib-compressed row per payment, so SELECT * on payments stays narrow.
+    """
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS payment_raw (
+            payment_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL
+        );
+        """
+    )
+    # archive_payments picks rows by age
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_created_at ON payments(created_at);")
+
+    writer = cursor.connection.cursor()
+    try:
+        cursor.execute("SELECT id, raw_response FROM payments WHERE raw_response IS NOT NULL")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            writer.executemany(
+                "INSERT OR REPLACE INTO payment_raw (payment_id, data) VALUES (?, ?)",
+                [(payment_id, pack_json(raw)) for payment_id, raw in rows],
+            )
+        # the column stays for old code paths, but is no longer filled
+        writer.execute("UPDATE payments SET raw_response = NULL WHERE raw_response IS NOT NULL")
+    finally:
+        writer.close()
+
+
+@migration(12, "outbox table for Telegram side effects")
+def _outbox(cursor):
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_at REAL NOT NULL,
+            locked_until REAL,
+            dedupe_key TEXT,
+            last_error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status_run_at ON outbox(status, run_at);")
+    # one live job per key; finished jobs don't block the same key from being queued again
+    cursor.execute(
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_outbox_dedupe_live ON outbox(dedupe_key)
+        WHERE dedupe_key IS NOT NULL AND status IN ('pending', 'running');
+        """
+    )
+
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def current_version(cursor) -> int:
+    if not _table_exists(cursor, "schema_version"):
+        return 0
+    row = cursor.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate(conn) -> int:
+    """Apply pending migrations and return the resulting schema version."""
+    cursor = conn.cursor()
+    try:
+        version = current_version(cursor)
+        if version >= LATEST_VERSION:
+            # already current: two tiny reads and no writes on every start
+            return version
+
+        if conn.in_transaction:
+            conn.commit()
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+        conn.commit()
+
+        for item in MIGRATIONS:
+            if item.version <= version:
+                continue
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                # another process may have applied it while we waited for the lock
+                if current_version(cursor) >= item.version:
+                    conn.rollback()
+                    continue
+                item.apply(cursor)
+                cursor.execute(
+                    "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                    (item.version, item.description),
+                )
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            logger.info("Applied migration %s: %s", item.version, item.description)
+            version = item.version
+        return version
+    finally:
+        cursor.close()
@@ -1,15 +1,18 @@
 import json
 import logging
+import os
 import re
+import tempfile
+from html import escape
 from datetime import datetime, timedelta, timezone
 
 from aiogram import Router, Bot
 from aiogram.exceptions import TelegramBadRequest
-from aiogram.types import Message, ChatMemberAdministrator, ChatMemberOwner
+from aiogram.types import Message, ChatMemberAdministrator, ChatMemberOwner, FSInputFile
 from aiogram.filters import Command, CommandObject
 
 from filter import UserAdmin
-from misc import BDB, get_text, normalize_subscription_end, get_channel_id_from_list
+from misc import BDB, PAYMENTS_ARCHIVE_FILE, PROFILES, get_text, kick_user, message_job, normalize_subscription_end, get_channel_id_from_list
 from keyboards import start_buttons_kb
 
 router = Router()
@@ -27,7 +30,10 @@ async def cmd_admin(message: Message):
         "<code>/remove_tp &lt;telegram_id&gt;</code> - Видалити посаду tp у користувача\n"
         "<code>/kick &lt;telegram_id&gt;</code> - Вигнати користувача з усіх каналів\n"
         "<code>/restore &lt;telegram_id&gt;</code> - Відновити доступ користувачу\n"
-        "<code>/add_time &lt;telegram_id&gt; &lt;дата/тривалість&gt;</code>\n\n"
+        "<code>/add_time &lt;telegram_id&gt; &lt;дата/тривалість&gt;</code>\n"
+        "/rebuild_revenue - Перерахувати щоденну виручку з усіх платежів (разом з архівом)\n"
+        "<code>/export &lt;payments|users&gt; [csv|ndjson]</code> - Вивантажити таблицю файлом\n"
+        "/outbox - Черга повідомлень/кіків, <code>/outbox_retry [id]</code> - повторити невдалі\n\n"
         "📌 Бот для получения ID канала: @username_to_id_bot"
     )
     await message.answer(text, parse_mode="HTML")
@@ -61,13 +67,13 @@ async def cmd_add_channel(message: Message, bot: Bot):
         await message.answer("❌ Не вдалося отримати інформацію про канал. Перевір ID і додай мене в канал.")
         return
 
-    BDB.add_channel(name=title, channel_id=channel_id)
+    await BDB.add_channel(name=title, channel_id=channel_id)
     await message.answer(f"✅ Канал <code>{channel_id}</code> додано!", parse_mode="HTML")
 
 
 @router.message(Command("channels"), UserAdmin())
 async def cmd_channels(message: Message):
-    channels = BDB.get_channels()
+    channels = await BDB.get_channels()
 
     if not channels:
         await message.answer("📭 Список каналів порожній.")
@@ -92,10 +98,15 @@ async def cmd_remove_channel(message: Message):
 
     channel_id = int(parts[1])
 
-    BDB.remove_channel_by_id(channel_id)
+    await BDB.remove_channel_by_id(channel_id)
     await message.answer(f"🗑 Канал <code>{channel_id}</code> видалено.", parse_mode="HTML")
 
 
+def _add_plan(db, telegram_id: int, plan: str, plan_message: dict):
+    db.add_subscription_plan(telegram_id, plan)
+    db.enqueue_outbox("message", plan_message)
+
+
 @router.message(Command("add_plan"), UserAdmin())
 async def cmd_add_plan(message: Message, bot: Bot):
     parts = message.text.split(maxsplit=2)
@@ -106,10 +117,14 @@ async def cmd_add_plan(message: Message, bot: Bot):
         )
         return
 
-    telegram_id = parts[1]
+    try:
+        telegram_id = int(parts[1])
+    except ValueError:
+        await message.answer("❌ Telegram ID має бути числом.")
+        return
     plan = parts[2]
 
-    channels  = BDB.get_channels()
+    channels  = await BDB.get_channels()
 
     if not channels :
         await message.answer("⚠️ У таблиці settings відсутній список доступних планів.")
@@ -123,10 +138,10 @@ async def cmd_add_plan(message: Message, bot: Bot):
     invite_link = await bot.create_chat_invite_link(chat_id=channel["id"],
                                                     member_limit=1,
                                                     expire_date=datetime.now() + timedelta(days=1))
-    BDB.add_subscription_plan(telegram_id, plan)
-    user = await bot.get_chat(telegram_id)
-    await bot.send_message(chat_id=telegram_id, text=get_text("ADD_NEW_PLAN").format(name=user.first_name,
-                                                                                     link=invite_link.invite_link))
+    name = await PROFILES.first_name(bot, telegram_id) or "Друже"
+    # план і повідомлення з посиланням комітяться разом, відправляє outbox
+    plan_message = message_job(telegram_id, get_text("ADD_NEW_PLAN").format(name=name, link=invite_link.invite_link))
+    await BDB.run_in_transaction(_add_plan, telegram_id, plan, plan_message)
     await message.answer(f"✅ Користувачу <code>{telegram_id}</code> додано план <b>{plan}</b>.", parse_mode="HTML")
 
 
@@ -139,12 +154,12 @@ async def add_tp_cmd(message: Message):
 
     telegram_id = parts[1]
 
-    user = BDB.get_user(telegram_id)
+    user = await BDB.get_user(telegram_id)
     if not user:
         await message.answer("❌ Користувача не знайдено.")
         return
 
-    BDB.update_user_field(telegram_id, "job_title", "tp")
+    await BDB.update_user_field(telegram_id, "job_title", "tp")
     await message.answer(f"✅ Користувачу {telegram_id} призначено посаду <b>tp</b>.", parse_mode="HTML")
 
 
@@ -157,50 +172,18 @@ async def remove_tp_cmd(message: Message):
 
     telegram_id = parts[1]
 
-    user = BDB.get_user(telegram_id)
+    user = await BDB.get_user(telegram_id)
     if not user:
         await message.answer("❌ Користувача не знайдено.")
         return
 
-    BDB.update_user_field(telegram_id, "job_title", "user")
+    await BDB.update_user_field(telegram_id, "job_title", "user")
     await message.answer(f"🗑 Посаду користувача {telegram_id} видалено.", parse_mode="HTML")
 
 
-async def _kick_user_from_channels(bot: Bot, tg_id: int):
-    channels = BDB.get_channels()
-    kicked = 0
-    skipped_admin = 0
-    failed = 0
-    already_left = 0
-
-    for ch in channels:
-        channel_id = ch.get("id")
-        if channel_id is None:
-            continue
-        try:
-            member = await bot.get_chat_member(chat_id=channel_id, user_id=tg_id)
-            status = member.status
-            if status in ("left", "kicked"):
-                already_left += 1
-                continue
-            if status in ("administrator", "creator"):
-                skipped_admin += 1
-                continue
-            await bot.ban_chat_member(chat_id=channel_id, user_id=tg_id)
-            await bot.unban_chat_member(chat_id=channel_id, user_id=tg_id)
-            kicked += 1
-        except Exception:
-            failed += 1
-
-    all_cleared = failed == 0 and skipped_admin == 0
-    return {
-        "total": len(channels),
-        "kicked": kicked,
-        "skipped_admin": skipped_admin,
-        "failed": failed,
-        "already_left": already_left,
-        "all_cleared": all_cleared,
-    }
+def _revoke_access(db, telegram_id: int):
+    db.update_user_fields(telegram_id, access_granted=0, notified_marks="[]")
+    db.enqueue_outbox("message", message_job(telegram_id, get_text("KICK")))
 
 
 @router.message(Command("kick"), UserAdmin())
@@ -220,20 +203,15 @@ async def cmd_kick_user(message: Message, bot: Bot):
         await message.answer("❌ Telegram ID має бути числом.")
         return
 
-    if not BDB.get_channels():
+    if not await BDB.get_channels():
         await message.answer("⚠️ Немає доданих каналів.")
         return
 
-    result = await _kick_user_from_channels(bot, telegram_id)
+    result = await kick_user(bot, telegram_id)
 
-    user = BDB.get_user(telegram_id)
+    user = await BDB.get_user(telegram_id)
     if result["all_cleared"] and user:
-        BDB.update_user_field(telegram_id, "access_granted", 0)
-        BDB.update_user_field(telegram_id, "notified_marks", "[]")
-        try:
-            await bot.send_message(chat_id=telegram_id, text=get_text("KICK"))
-        except Exception:
-            pass
+        await BDB.run_in_transaction(_revoke_access, telegram_id)
 
     summary = (
         f"Канали: {result['total']}\n"
@@ -258,6 +236,11 @@ async def cmd_kick_user(message: Message, bot: Bot):
     )
 
 
+def _restore_access(db, telegram_id: int, access_message: dict, **fields):
+    db.update_user_fields(telegram_id, **fields)
+    db.enqueue_outbox("message", access_message)
+
+
 @router.message(Command("restore"), UserAdmin())
 async def cmd_restore_user(message: Message, bot: Bot):
     parts = message.text.strip().split(maxsplit=1)
@@ -275,12 +258,12 @@ async def cmd_restore_user(message: Message, bot: Bot):
         await message.answer("❌ Telegram ID має бути числом.")
         return
 
-    user = BDB.get_user(telegram_id)
+    user = await BDB.get_user(telegram_id)
     if not user:
         await message.answer("❌ Користувача не знайдено.")
         return
 
-    plans = list(dict.fromkeys(BDB.get_user_plans(telegram_id)))
+    plans = list(dict.fromkeys(await BDB.get_user_plans(telegram_id)))
     if not plans:
         await message.answer("⚠️ У користувача немає планів. Спочатку додай план через /add_plan.")
         return
@@ -291,7 +274,7 @@ async def cmd_restore_user(message: Message, bot: Bot):
     unban_failed = []
     link_failed = []
     for index, plan in enumerate(plans, start=1):
-        channel_id = get_channel_id_from_list(plan)
+        channel_id = await get_channel_id_from_list(plan)
         if not channel_id:
             missing.append(plan)
             continue
@@ -345,14 +328,19 @@ async def cmd_restore_user(message: Message, bot: Bot):
         return
 
     new_end = datetime.now() + timedelta(days=5)
-    BDB.update_user_field(telegram_id, "subscription_end", normalize_subscription_end(new_end))
-    BDB.update_user_field(telegram_id, "access_granted", 1)
-    BDB.update_user_field(telegram_id, "notified_marks", "[]")
-
-    await bot.send_message(
-        chat_id=telegram_id,
-        text=get_text("ACCESS_IS_AVAILABLE").format(links="\n".join(invite_links)),
-        reply_markup=start_buttons_kb,
+    # доступ і повідомлення з посиланнями комітяться разом, відправляє outbox
+    access_message = message_job(
+        telegram_id,
+        get_text("ACCESS_IS_AVAILABLE").format(links="\n".join(invite_links)),
+        start_buttons_kb,
+    )
+    await BDB.run_in_transaction(
+        _restore_access,
+        telegram_id,
+        access_message,
+        subscription_end=normalize_subscription_end(new_end),
+        access_granted=1,
+        notified_marks="[]",
     )
 
     details = []
@@ -425,7 +413,7 @@ async def cmd_add_time(message: Message):
     until_raw = parts[2]
 
     # Перевіримо, що користувач існує
-    user = BDB.get_user(telegram_id)
+    user = await BDB.get_user(telegram_id)
     if not user:
         await message.answer("❌ Користувача не знайдено.")
         return
@@ -443,7 +431,7 @@ async def cmd_add_time(message: Message):
 
     # Зберігаємо в ISO (без таймзони) з мікросекундами для єдності формату.
     normalized_end = normalize_subscription_end(until_dt)
-    BDB.update_user_field(
+    await BDB.update_user_field(
         telegram_id,
         "subscription_end",
         normalized_end
@@ -452,7 +440,7 @@ async def cmd_add_time(message: Message):
     # Лог зміни часу від адміна
     try:
         admin_name = message.from_user.username or message.from_user.first_name
-        BDB.create_payment_entry(
+        await BDB.create_payment_entry(
             telegram_id=int(telegram_id),
             method="admin_add_time",
             amount=0,
@@ -478,3 +466,66 @@ async def cmd_add_time(message: Message):
         f"✅ Користувачу <code>{telegram_id}</code> встановлено термін до <b>{until_dt:%d.%m.%Y %H:%M}</b>.",
         parse_mode="HTML",
     )
+
+
+@router.message(Command("rebuild_revenue"), UserAdmin())
+async def cmd_rebuild_revenue(message: Message):
+    counted = await BDB.rebuild_revenue_daily(PAYMENTS_ARCHIVE_FILE)
+    logger.info("revenue_daily rebuilt by %s: payments=%s", message.from_user.id, counted)
+    await message.answer(f"✅ Виручку перераховано. Оплачених платежів: {counted}")
+
+
+@router.message(Command("export"), UserAdmin())
+async def cmd_export(message: Message, command: CommandObject):
+    args = (command.args or "").split()
+    table = args[0].lower() if args else ""
+    fmt = args[1].lower() if len(args) > 1 else "csv"
+    exporters = {"payments": BDB.export_payments, "users": BDB.export_users}
+    if table not in exporters or fmt not in ("csv", "ndjson"):
+        await message.answer(
+            "⚠️ Формат: <code>/export &lt;payments|users&gt; [csv|ndjson]</code>",
+            parse_mode="HTML",
+        )
+        return
+
+    filename = f"{table}_{datetime.now().strftime('%Y%m%d_%H%M')}.{fmt}"
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        # rows are streamed straight into the file on a db reader thread
+        count = await exporters[table](path, fmt)
+        await message.answer_document(FSInputFile(path, filename=filename), caption=f"📄 {table}: {count}")
+    finally:
+        os.unlink(path)
+    logger.info("Export %s (%s) by %s: rows=%s", table, fmt, message.from_user.id, count)
+
+
+@router.message(Command("outbox"), UserAdmin())
+async def cmd_outbox(message: Message):
+    counts = await BDB.get_outbox_counts()
+    lines = [
+        f"В черзі: {counts['pending']}",
+        f"Виконується: {counts['running']}",
+        f"Виконано: {counts['done']}",
+        f"Невдалі: {counts['dead']}",
+    ]
+    dead = await BDB.list_outbox(status="dead", limit=10)
+    if dead:
+        lines.append("")
+        for job in dead:
+            error = (job["last_error"] or "")[:120]
+            lines.append(f"#{job['id']} {job['kind']} ({job['attempts']}): <code>{escape(error)}</code>")
+    await message.answer("\n".join(lines), parse_mode="HTML")
+
+
+@router.message(Command("outbox_retry"), UserAdmin())
+async def cmd_outbox_retry(message: Message, command: CommandObject):
+    arg = (command.args or "").strip()
+    if arg and not arg.isdigit():
+        await message.answer("⚠️ Формат: <code>/outbox_retry [id]</code>", parse_mode="HTML")
+        return
+    requeued, skipped = await BDB.requeue_outbox(int(arg) if arg else None)
+    text = f"🔁 Повернуто в чергу: {requeued}"
+    if skipped:
+        text += f"\n⏭ Пропущено (вже є активна копія): {skipped}"
+    await message.answer(text)
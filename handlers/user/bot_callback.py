@@ -10,7 +10,7 @@ from aiogram.types import CallbackQuery, InlineKeyboardMarkup
 from aiogram.fsm.context import FSMContext
 
 from misc import create_invoice, check_invoice, BDB, get_text, get_channel_id_from_list, check_payment_received, \
-    CRYPTO_ADDRESS, parse_subscription_end, normalize_subscription_end, USDT_ADDRESS
+    CRYPTO_ADDRESS, parse_subscription_end, normalize_subscription_end, USDT_ADDRESS, message_job
 from keyboards import payment_cb_kb, options_payment_kb, method_payment_kb, start_buttons_kb, cancel_kb, \
     confirm_cancel_kb, plan_selection_keyboard
 
@@ -29,21 +29,44 @@ date_ = {
 }
 
 
-def _clear_admin_notified(tg_id: int | str):
-    user = BDB.get_user(tg_id)
+def _marks_without_admin_notified(user: dict | None) -> str | None:
+    """notified_marks JSON with "admin_notified" dropped, or None if nothing to change."""
     if not user:
-        return
+        return None
     raw = user.get("notified_marks") or "[]"
     try:
         arr = json.loads(raw)
         if not isinstance(arr, list):
-            return
+            return None
     except Exception:
-        return
+        return None
     if "admin_notified" not in arr:
-        return
-    arr = [x for x in arr if x != "admin_notified"]
-    BDB.update_user_field(tg_id, "notified_marks", json.dumps(arr))
+        return None
+    return json.dumps([x for x in arr if x != "admin_notified"])
+
+
+def _grant_access(db, tg_id, selected_plans: list[str], access_message: dict, **fields):
+    db.update_user_fields(tg_id, **fields)
+    for plan in selected_plans:
+        db.add_subscription_plan(tg_id, plan)
+    db.enqueue_outbox("message", access_message)
+
+
+def _credit_payment(db, tg_id, payment_id, months: int, user_fields: dict, **payment_fields) -> datetime:
+    """Extend the subscription by `months` and mark the payment paid in one transaction; returns the new end."""
+    # читаємо термін всередині транзакції, щоб паралельне продовження не загубилось
+    user = db.get_user(tg_id)
+    current_end = parse_subscription_end(user.get("subscription_end") if user else None) or datetime.now()
+    subscription_end = current_end + relativedelta(months=months)
+    db.update_user_fields(
+        tg_id,
+        subscription_end=normalize_subscription_end(subscription_end),
+        notified_marks="[]",
+        **user_fields,
+    )
+    if payment_id:
+        db.update_payment_entry(payment_id, status="paid", **payment_fields)
+    return subscription_end
 
 @router.callback_query(F.data.startswith("toggle_plan:"))
 async def toggle_plan_callback(callback: CallbackQuery, state: FSMContext):
@@ -60,7 +83,7 @@ async def toggle_plan_callback(callback: CallbackQuery, state: FSMContext):
     await state.update_data(selected_plans=selected)
 
     await callback.message.edit_reply_markup(
-        reply_markup=plan_selection_keyboard(int(tg_id), selected, data.get("selected_date"))
+        reply_markup=await plan_selection_keyboard(int(tg_id), selected, data.get("selected_date"))
     )
     await callback.answer()
 
@@ -78,7 +101,7 @@ async def toggle_date_callback(callback: CallbackQuery, state: FSMContext):
     await state.update_data(selected_date=date)
 
     await callback.message.edit_reply_markup(
-        reply_markup=plan_selection_keyboard(int(tg_id), selected, date)
+        reply_markup=await plan_selection_keyboard(int(tg_id), selected, date)
     )
     await callback.answer()
 
@@ -96,30 +119,31 @@ async def confirm_plans_callback(callback: CallbackQuery, state: FSMContext, bot
     new_end = datetime.now() + relativedelta(months=months)
 
 
-    BDB.update_user_field(user_id, "subscription_end", normalize_subscription_end(new_end))
-
     plans_text = "\n".join(selected)
     await callback.message.answer(f"Вибрано плани:\n{plans_text}")
 
     # Логіка для підтвердження планів
-
-    BDB.update_user_field(user_id, "access_granted", 1)
-    _clear_admin_notified(user_id)
-
-    
     expire_time = datetime.now() + timedelta(days=1)
 
     invite_links = []
     for index, plan in enumerate(selected):
-        plan_id = get_channel_id_from_list(plan)
+        plan_id = await get_channel_id_from_list(plan)
 
         invite_link = await bot.create_chat_invite_link(chat_id=plan_id, member_limit=1, expire_date=expire_time)
         invite_links.append(f"{index+1} посилання - <a href='{invite_link.invite_link}'>{plan}</a>")
-        BDB.add_subscription_plan(user_id, plan)
 
-    await bot.send_message(text=get_text("ACCESS_IS_AVAILABLE").format(links="\n".join(invite_links)),
-                           chat_id=user_id,
-                           reply_markup=start_buttons_kb)
+    # термін, доступ, мітки і плани записуються одним комітом
+    fields = {"subscription_end": normalize_subscription_end(new_end), "access_granted": 1}
+    marks = _marks_without_admin_notified(await BDB.get_user(user_id))
+    if marks is not None:
+        fields["notified_marks"] = marks
+    # доступ і повідомлення з посиланнями комітяться разом, відправляє outbox
+    access_message = message_job(
+        int(user_id),
+        get_text("ACCESS_IS_AVAILABLE").format(links="\n".join(invite_links)),
+        start_buttons_kb,
+    )
+    await BDB.run_in_transaction(_grant_access, user_id, selected, access_message, **fields)
     
     await state.clear()
     await callback.answer("Плани підтверджено.")
@@ -128,7 +152,7 @@ async def confirm_plans_callback(callback: CallbackQuery, state: FSMContext, bot
 @router.callback_query(F.data == "check_subscription")
 async def check_subscription_call(callback_query: CallbackQuery):
     user_id = callback_query.from_user.id
-    user = BDB.get_user(user_id)
+    user = await BDB.get_user(user_id)
 
     sub_end = parse_subscription_end(user.get("subscription_end"))
     end_text = sub_end.strftime("%d.%m.%Y") if sub_end else (user.get("subscription_end") or "unknown")
@@ -148,17 +172,17 @@ async def my_orders_call(callback_query: CallbackQuery, state: FSMContext):
     await state.update_data(method_payment="payment_cryptobot")
 
     user_id = callback_query.from_user.id
-    user = BDB.get_user(user_id)
+    user = await BDB.get_user(user_id)
     user_name = user.get("user_name") or callback_query.from_user.username
     first_name = user.get("first_name") or callback_query.from_user.first_name
-    BDB.update_user_field(user_id, "payment", 1)
+    await BDB.update_user_field(user_id, "payment", 1)
 
     invoice = create_invoice(
         amount=int(amount),
         payload=str(user['id'])
     )
 
-    payment_id = BDB.create_payment_entry(
+    payment_id = await BDB.create_payment_entry(
         telegram_id=user_id,
         method="cryptobot",
         amount=int(amount),
@@ -179,64 +203,52 @@ async def my_orders_call(callback_query: CallbackQuery, state: FSMContext):
                                         reply_markup=payment_cb_kb(invoice["pay_url"], invoice["invoice_id"]),
     )
     payment_finished = False
+    status = None
     try:
         for _ in range(180):
             invoice_data = check_invoice(int(invoice["invoice_id"]))
             status = invoice_data.get("status")
 
-            if payment_id:
-                BDB.update_payment_entry(
-                    payment_id,
-                    status=status,
-                    paid_at=invoice_data.get("paid_at"),
-                    raw_response=invoice_data,
-                )
-
-            user = BDB.get_user(user_id)
-            if user and user.get("payment") == 0:
-                if payment_id:
-                    BDB.update_payment_entry(payment_id, status="canceled")
-                payment_finished = True
-                return
+            # "paid" пише тільки _credit_payment, разом з продовженням підписки
+            if payment_id and status != "paid":
+                await BDB.update_payment_entry(payment_id, status=status, raw_response=invoice_data)
 
             if status == "paid":
-                user = BDB.get_user(user_id)
-
-                current_end = parse_subscription_end(user.get("subscription_end")) or datetime.now()
-                subscription_end = current_end + relativedelta(months=plans[plan])
-
-                BDB.update_user_field(
+                subscription_end = await BDB.run_in_transaction(
+                    _credit_payment,
                     user_id,
-                    "subscription_end",
-                    normalize_subscription_end(subscription_end)
+                    payment_id,
+                    plans[plan],
+                    {"payment": 0},
+                    paid_at=invoice_data.get("paid_at"),
+                    raw_response=invoice_data,
                 )
                 await callback_query.message.answer(
                     text=get_text("SUBSCRIPTION_EXTENDED").format(date=subscription_end.strftime("%d.%m.%Y")))
-                BDB.update_user_field(user_id, "payment", 0)
-                BDB.update_user_field(user_id, "notified_marks", "[]")
                 try:
                     await callback_query.message.delete()
                 except Exception as e:
                     pass
+                payment_finished = True
+                return
+
+            user = await BDB.get_user(user_id)
+            if user and user.get("payment") == 0:
                 if payment_id:
-                    BDB.update_payment_entry(
-                        payment_id,
-                        status="paid",
-                        paid_at=invoice_data.get("paid_at"),
-                        raw_response=invoice_data,
-                    )
+                    await BDB.update_payment_entry(payment_id, status="canceled")
                 payment_finished = True
                 return
             await sleep(10)
         await callback_query.message.answer(text="Упс... Оплату не побачив.")
         await callback_query.message.delete()
         if payment_id:
-            BDB.update_payment_entry(payment_id, status="timeout")
+            await BDB.update_payment_entry(payment_id, status="timeout")
         payment_finished = True
     finally:
-        BDB.update_user_field(user_id, "payment", 0)
-        if payment_id and not payment_finished:
-            BDB.update_payment_entry(payment_id, status="canceled")
+        await BDB.update_user_field(user_id, "payment", 0)
+        # оплачений інвойс, який не вдалося зарахувати, лишається pending з raw_response від провайдера
+        if payment_id and not payment_finished and status != "paid":
+            await BDB.update_payment_entry(payment_id, status="canceled")
     
     
 @router.callback_query(F.data == "payment_usdt")
@@ -252,7 +264,7 @@ async def payment_usdt_call(callback_query: CallbackQuery, state: FSMContext):
         return
     user_id = callback_query.from_user.id
     
-    user = BDB.get_user(user_id)
+    user = await BDB.get_user(user_id)
     if user.get("payment") == 1:
         await callback_query.message.answer("Оплата вже обробляється. Дочекайтесь, будь ласка.")
         return
@@ -265,14 +277,15 @@ async def payment_usdt_call(callback_query: CallbackQuery, state: FSMContext):
     steal_max_count = 0
 
     if plan == "one_month":
-        steal_enabled = (BDB.get_setting("steal_payment") or "").lower() == "true"
+        steal = await BDB.get_settings("steal_payment", "steal_value", "steal_count", "steal_max_count")
+        steal_enabled = (steal["steal_payment"] or "").lower() == "true"
         try:
-            steal_value = int(BDB.get_setting("steal_value") or 0)
+            steal_value = int(steal["steal_value"] or 0)
         except (TypeError, ValueError):
             steal_value = 0
         try:
-            steal_count = int(BDB.get_setting("steal_count") or 0)
-            steal_max_count = int(BDB.get_setting("steal_max_count") or 0)
+            steal_count = int(steal["steal_count"] or 0)
+            steal_max_count = int(steal["steal_max_count"] or 0)
         except (TypeError, ValueError):
             steal_count = 0
             steal_max_count = 0
@@ -286,23 +299,22 @@ async def payment_usdt_call(callback_query: CallbackQuery, state: FSMContext):
         )
 
         if use_steal_address:
-            BDB.edit_setting("steal_payment", "false")
+            await BDB.edit_setting("steal_payment", "false")
 
     if use_steal_address:
         address = USDT_ADDRESS
     else:
-        address = BDB.get_free_crypto_address()
+        address = await BDB.lease_crypto_address(user_id)
         if not address:
             await callback_query.message.answer("Всі адреси зайняті. Спробуй пізніше.")
             return
-        BDB.mark_address_as_used(address)
 
-    BDB.update_user_field(user_id, "payment", 1)
+    await BDB.update_user_field(user_id, "payment", 1)
 
     start_time = datetime.now()
     user_name = user.get("user_name") or callback_query.from_user.username
     first_name = user.get("first_name") or callback_query.from_user.first_name
-    payment_id = BDB.create_payment_entry(
+    payment_id = await BDB.create_payment_entry(
         telegram_id=user_id,
         method="usdt_trc20",
         amount=amount_value,
@@ -322,22 +334,24 @@ async def payment_usdt_call(callback_query: CallbackQuery, state: FSMContext):
     payment_finished = False
     try:
         for _ in range(90):
-            user = BDB.get_user(user_id)
+            user = await BDB.get_user(user_id)
             result_payment =  await check_payment_received(address, amount_value, start_time)
             
-            if user["payment"] == 0:
-                if payment_id:
-                    BDB.update_payment_entry(payment_id, status="canceled")
-                payment_finished = True
-                return
-            
+            # оплата, що прийшла разом зі скасуванням, все одно зараховується
             if result_payment:
-                current_end = parse_subscription_end(user.get("subscription_end")) or datetime.now()
-                subscription_end = current_end + relativedelta(months=plans[plan])
-                BDB.update_user_field(
+                subscription_end = await BDB.run_in_transaction(
+                    _credit_payment,
                     user_id,
-                    "subscription_end",
-                    normalize_subscription_end(subscription_end)
+                    payment_id,
+                    plans[plan],
+                    {},
+                    tx_hash=result_payment.get("tx_id"),
+                    tx_from=result_payment.get("from"),
+                    tx_to=result_payment.get("to"),
+                    tx_value=result_payment.get("value"),
+                    tx_timestamp=result_payment.get("block_timestamp").isoformat() if result_payment.get("block_timestamp") else None,
+                    paid_at=result_payment.get("block_timestamp").isoformat() if result_payment.get("block_timestamp") else None,
+                    raw_response=result_payment,
                 )
                 await callback_query.message.answer(text=get_text("SUBSCRIPTION_EXTENDED").format(date=subscription_end.strftime("%d.%m.%Y")))
                 
@@ -346,56 +360,46 @@ async def payment_usdt_call(callback_query: CallbackQuery, state: FSMContext):
                 except Exception as e:
                     pass
                 
-                BDB.update_user_field(user_id, "notified_marks", "[]")
-                if payment_id:
-                    BDB.update_payment_entry(
-                        payment_id,
-                        status="paid",
-                        tx_hash=result_payment.get("tx_id"),
-                        tx_from=result_payment.get("from"),
-                        tx_to=result_payment.get("to"),
-                        tx_value=result_payment.get("value"),
-                        tx_timestamp=result_payment.get("block_timestamp").isoformat() if result_payment.get("block_timestamp") else None,
-                        paid_at=result_payment.get("block_timestamp").isoformat() if result_payment.get("block_timestamp") else None,
-                        raw_response=result_payment,
-                    )
-                
                 payment_finished = True
                 if use_steal_address:
-                    BDB.edit_setting("steal_count", str(0))
-                    remaining = max(steal_value - amount_value, 0)
-                    BDB.edit_setting("steal_value", str(remaining))
+                    await BDB.edit_setting("steal_count", str(0))
+                    if await BDB.increment_setting("steal_value", -amount_value, minimum=0) is None:
+                        await BDB.edit_setting("steal_value", str(0))
                 elif plan == "one_month":
                     try:
-                        steal_count = int(BDB.get_setting("steal_count") or 0)
-                        steal_max_count = int(BDB.get_setting("steal_max_count") or 0)
+                        steal_max_count = int(await BDB.get_setting("steal_max_count") or 0)
                     except (TypeError, ValueError):
-                        steal_count = 0
                         steal_max_count = 0
-                    if steal_count < steal_max_count:
-                        BDB.edit_setting("steal_count", str(steal_count+1))
+                    # лічильник росте лише до steal_max_count, без read-then-write гонки
+                    await BDB.increment_setting("steal_count", maximum=steal_max_count)
+                return
+
+            if user["payment"] == 0:
+                if payment_id:
+                    await BDB.update_payment_entry(payment_id, status="canceled")
+                payment_finished = True
                 return
             
             await sleep(10)
         await callback_query.message.answer(text="Упс... Оплату не побачив.")
         await callback_query.message.delete()
         if payment_id:
-            BDB.update_payment_entry(payment_id, status="timeout")
+            await BDB.update_payment_entry(payment_id, status="timeout")
         payment_finished = True
     finally:
-        BDB.update_user_field(user_id, "payment", 0)
+        await BDB.update_user_field(user_id, "payment", 0)
         if use_steal_address:
-            BDB.edit_setting("steal_payment", "true")
+            await BDB.edit_setting("steal_payment", "true")
         if address and not use_steal_address and address != CRYPTO_ADDRESS:
-            BDB.unmark_address_as_used(address)
+            await BDB.release_crypto_address(address, user_id)
         if payment_id and not payment_finished:
-            BDB.update_payment_entry(payment_id, status="canceled")
+            await BDB.update_payment_entry(payment_id, status="canceled")
 
 
 @router.callback_query(F.data == "payment")
 async def payment_call(callback_query: CallbackQuery):
     user_id = callback_query.from_user.id
-    payment = BDB.get_user(user_id)["payment"]
+    payment = (await BDB.get_user(user_id))["payment"]
     if payment == 1:
         await callback_query.message.answer(text="Спочатку закінчи зі старою оплатою.")
         return
@@ -412,8 +416,8 @@ async def cancel_confirm_call(callback_query: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     payment_id = data.get("payment_id")
     if payment_id:
-        BDB.update_payment_entry(payment_id, status="canceled")
-    BDB.update_user_field(callback_query.from_user.id, "payment", 0)
+        await BDB.update_payment_entry(payment_id, status="canceled")
+    await BDB.update_user_field(callback_query.from_user.id, "payment", 0)
     await callback_query.message.answer(text="Оплату відхилено.")
     await callback_query.message.delete()
 
@@ -4,7 +4,7 @@ from aiogram.types import Message
 
 import json
 
-from misc import BDB, get_text, parse_subscription_end
+from misc import BDB, PROFILES, get_text, message_job, parse_subscription_end
 from keyboards import start_buttons_kb, plan_selection_keyboard
 
 router = Router()
@@ -20,9 +20,10 @@ def _load_marks(user: dict) -> set[str]:
         pass
     return set()
 
-def _save_marks(tg_id: int | str, marks: set[str]):
-    from misc import BDB
-    BDB.update_user_field(tg_id, "notified_marks", json.dumps(sorted(list(marks))))
+def _notify_admins(db, tg_id: int, marks: str, jobs: list[dict]):
+    db.update_user_field(tg_id, "notified_marks", marks)
+    for job in jobs:
+        db.enqueue_outbox("message", job)
 
 
 
@@ -31,26 +32,31 @@ def _save_marks(tg_id: int | str, marks: set[str]):
 async def cmd_start(message: Message, bot: Bot):
     user_id = message.from_user.id
 
-    user = BDB.get_user(user_id)
+    user = await BDB.get_user(user_id)
 
     if user is None:
-        BDB.add_user(user_id)
-        user = BDB.get_user(user_id)
+        await BDB.add_user(user_id)
+        user = await BDB.get_user(user_id)
 
     user_name = message.from_user.username if message.from_user.username else message.from_user.first_name
 
-    BDB.update_user_field(user_id, "user_name", message.from_user.username)
-    BDB.update_user_field(user_id, "first_name", message.from_user.first_name)
+    # the middleware skipped the names while the row did not exist yet
+    await PROFILES.observe(user_id, message.from_user.first_name, message.from_user.username)
 
     if user["access_granted"] == 0:
         marks = _load_marks(user)
         if "admin_notified" not in marks:
-            for i in BDB.get_users_by_job_title("admin"):
-                await bot.send_message(chat_id=i["telegram_id"],
-                                       text=f"<a href='{message.from_user.url}'>@{user_name}</a> пытается зайти в бота. ID: {message.from_user.id}",
-                                       reply_markup=plan_selection_keyboard(user_id))
+            admins = await BDB.get_users_by_job_title("admin")
+            text = f"<a href='{message.from_user.url}'>@{user_name}</a> пытается зайти в бота. ID: {message.from_user.id}"
+            keyboard = await plan_selection_keyboard(user_id)
             marks.add("admin_notified")
-            _save_marks(user_id, marks)
+            # мітка і повідомлення адмінам комітяться разом, розсилає outbox
+            await BDB.run_in_transaction(
+                _notify_admins,
+                user_id,
+                json.dumps(sorted(list(marks))),
+                [message_job(admin["telegram_id"], text, keyboard) for admin in admins],
+            )
         await message.answer(text=get_text('NO_ACCESS'))
     elif user["access_granted"] == 1:
         sub_end = parse_subscription_end(user.get("subscription_end"))
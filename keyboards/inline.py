@@ -17,10 +17,10 @@ start_buttons_kb = InlineKeyboardMarkup(
     ]
 )
 
-def plan_selection_keyboard(tg_id: int, selected: list[str] = [], selected_date = None) -> InlineKeyboardMarkup:
+async def plan_selection_keyboard(tg_id: int, selected: list[str] = [], selected_date = None) -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
 
-    for plan in BDB.get_channels():
+    for plan in await BDB.get_channels():
         name = plan["name"]
         checked = "✅" if name in selected else "❌"
         kb.button(text=f"{checked} {name}", callback_data=f"toggle_plan:{tg_id}:{name}")
@@ -13,7 +13,12 @@ from aiogram.fsm.storage.memory import MemoryStorage
 from handlers.user import bot_callback, bot_messages, start_command
 from handlers.admin import command
 
-from misc import TOKEN, BDB
+from database import run_backup
+from misc import (TOKEN, BDB, EVENTS, EVENTS_HOST, EVENTS_PORT, DASHBOARD_API_TOKEN, DASHBOARD_CORS_ORIGINS,
+                  DASHBOARD_SNAPSHOT_PATH, PAYMENTS_ARCHIVE_DAYS, PAYMENTS_ARCHIVE_FILE, DB_BACKUP_DIR,
+                  DB_BACKUP_INTERVAL_HOURS, DB_BACKUP_KEEP, DB_BACKUP_PAGES, DB_BACKUP_SLEEP_MS, DB_REPLICA_PATH,
+                  OUTBOX_WORKERS, PROFILES, db_file, OutboxWorker, ProfileMiddleware, SnapshotPublisher,
+                  start_event_server)
 from reminder import reminder_payment, kick_expired_once
 
 class PrefixFormatter(logging.Formatter):
@@ -69,22 +74,70 @@ def _asyncio_exception_handler(loop, context):
     msg = context.get("message")
     logging.getLogger(__name__).error("Asyncio exception: %s", msg, exc_info=err)
 
-async def _reminder_runner(bot: Bot):
+async def _reminder_runner():
     try:
-        await reminder_payment(bot)
+        await reminder_payment()
     except Exception:
         logging.getLogger(__name__).exception("Reminder task crashed")
 
-async def _startup_kick_runner(bot: Bot):
+async def _startup_kick_runner():
     try:
-        await kick_expired_once(bot)
+        await kick_expired_once()
     except Exception:
         logging.getLogger(__name__).exception("Startup kick sweep crashed")
 
+async def _outbox_runner(worker: OutboxWorker):
+    try:
+        await worker.run()
+    except Exception:
+        logging.getLogger(__name__).exception("Outbox worker crashed")
+
+def _data_events_only(callback):
+    # outbox jobs are internal bookkeeping, the dashboard only follows data changes
+    def listener(events):
+        events = [event for event in events if event.get("type") != "outbox"]
+        if events:
+            callback(events)
+    return listener
+
+async def _snapshot_publisher_runner(publisher: SnapshotPublisher):
+    try:
+        await publisher.run()
+    except Exception:
+        logging.getLogger(__name__).exception("Snapshot publisher crashed")
+
+async def _payments_archive_runner(interval: float = 24 * 3600):
+    while True:
+        try:
+            await BDB.archive_payments(PAYMENTS_ARCHIVE_FILE, PAYMENTS_ARCHIVE_DAYS)
+        except Exception:
+            logging.getLogger(__name__).exception("Payments archive job failed")
+        await asyncio.sleep(interval)
+
+async def _backup_runner():
+    while True:
+        try:
+            # own connection on a worker thread, the db writer/reader threads stay free
+            await asyncio.to_thread(
+                run_backup,
+                db_file,
+                DB_BACKUP_DIR,
+                keep=DB_BACKUP_KEEP,
+                replica_file=DB_REPLICA_PATH,
+                pages=DB_BACKUP_PAGES,
+                sleep=DB_BACKUP_SLEEP_MS / 1000,
+            )
+        except Exception:
+            logging.getLogger(__name__).exception("Database backup failed")
+        await asyncio.sleep(DB_BACKUP_INTERVAL_HOURS * 3600)
+
 async def main():
     bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode='HTML'))
     dp = Dispatcher(storage=MemoryStorage())
 
+    # names of every sender go to users.first_name/user_name and the in-memory cache
+    dp.update.outer_middleware(ProfileMiddleware(PROFILES))
+
     dp.include_routers(
         start_command.router,
         command.router,
@@ -94,10 +147,38 @@ async def main():
 
     loop = asyncio.get_running_loop()
     loop.set_exception_handler(_asyncio_exception_handler)
-    asyncio.create_task(_reminder_runner(bot))
-    asyncio.create_task(_startup_kick_runner(bot))
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    outbox = OutboxWorker(BDB, bot, workers=OUTBOX_WORKERS)
+    BDB.add_listener(outbox.notify)
+    asyncio.create_task(_outbox_runner(outbox))
+    asyncio.create_task(_reminder_runner())
+    asyncio.create_task(_startup_kick_runner())
+    if PAYMENTS_ARCHIVE_DAYS > 0:
+        asyncio.create_task(_payments_archive_runner())
+    if DB_BACKUP_INTERVAL_HOURS > 0:
+        asyncio.create_task(_backup_runner())
+
+    # every committed users/payments/channels change goes to the dashboard stream
+    BDB.add_listener(_data_events_only(EVENTS.publish))
+    if DASHBOARD_SNAPSHOT_PATH:
+        publisher = SnapshotPublisher(BDB, DASHBOARD_SNAPSHOT_PATH)
+        BDB.add_listener(_data_events_only(publisher.notify))
+        asyncio.create_task(_snapshot_publisher_runner(publisher))
+    events_runner = None
+    if EVENTS_PORT:
+        events_runner = await start_event_server(
+            EVENTS,
+            EVENTS_HOST,
+            EVENTS_PORT,
+            token=DASHBOARD_API_TOKEN,
+            allow_origins=DASHBOARD_CORS_ORIGINS,
+        )
+
+    try:
+        await bot.delete_webhook(drop_pending_updates=True)
+        await dp.start_polling(bot)
+    finally:
+        if events_runner is not None:
+            await events_runner.cleanup()
 
 if __name__ == '__main__':
     print("[+] BOT STARTING")
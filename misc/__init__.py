@@ -1,2 +1,12 @@
-from .config import (TOKEN, BDB, BASE_DIR, CRYPTO_BOT_API, NOTIFY_DELAYS, CRYPTO_ADDRESS, TRON_API_KEY, USDT_ADDRESS)
+from .config import (TOKEN, BDB, BASE_DIR, CRYPTO_BOT_API, NOTIFY_DELAYS, CRYPTO_ADDRESS, TRON_API_KEY, USDT_ADDRESS,
+                     EVENTS_HOST, EVENTS_PORT, DASHBOARD_API_TOKEN, DASHBOARD_CORS_ORIGINS, DASHBOARD_SNAPSHOT_PATH,
+                     PAYMENTS_ARCHIVE_DAYS, PAYMENTS_ARCHIVE_FILE, DB_BACKUP_DIR, DB_BACKUP_INTERVAL_HOURS,
+                     DB_BACKUP_KEEP, DB_BACKUP_PAGES, DB_BACKUP_SLEEP_MS, DB_REPLICA_PATH, db_file,
+                     OUTBOX_WORKERS)
 from .util import create_invoice, check_invoice, get_text, get_channel_id_from_list, check_payment_received, parse_subscription_end, normalize_subscription_end
+from .events import EVENTS, start_event_server
+from .publisher import SnapshotPublisher
+from .delivery import DELIVERY, DeliveryEngine, TokenBucket
+from .kick import kick_user
+from .outbox import OutboxWorker, PermanentError, checkpoint, message_job, outbox_handler
+from .profiles import PROFILES, ProfileCache, ProfileMiddleware
@@ -1,5 +1,5 @@
 from pathlib import Path
-from database import Database
+from database import AsyncDatabase
 from dotenv import load_dotenv
 
 import os
@@ -17,6 +17,54 @@ USDT_ADDRESS = os.getenv("USDT_ADDRESS")
 
 NOTIFY_DELAYS = [5, 3, 2, 1, 0.5]
 
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "wal")
+DB_READERS = int(os.getenv("DB_READERS", "2"))
+# group commit is off unless one of the limits is set
+DB_GROUP_COMMIT_MS = int(os.getenv("DB_GROUP_COMMIT_MS", "0"))
+DB_GROUP_COMMIT_MAX = int(os.getenv("DB_GROUP_COMMIT_MAX", "0"))
+DB_SETTINGS_TTL = float(os.getenv("DB_SETTINGS_TTL", "30"))
+
+# live change stream for the dashboard (Server-Sent Events), 0 disables it
+EVENTS_HOST = os.getenv("EVENTS_HOST", "127.0.0.1")
+EVENTS_PORT = int(os.getenv("EVENTS_PORT", "8001"))
+DASHBOARD_API_TOKEN = (os.getenv("DASHBOARD_API_TOKEN") or "").strip()
+DASHBOARD_CORS_ORIGINS = [
+    origin.strip() for origin in os.getenv("DASHBOARD_CORS_ORIGINS", "*").split(",") if origin.strip()
+]
+
+# Bot API delivery: calls per second, seconds between messages to one chat
+DELIVERY_RATE = float(os.getenv("DELIVERY_RATE", "25"))
+DELIVERY_CHAT_INTERVAL = float(os.getenv("DELIVERY_CHAT_INTERVAL", "1"))
+
+# parallel workers draining the outbox table (messages/kicks queued with DB changes)
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+
+# JSON snapshot for static dashboard builds, set DASHBOARD_SNAPSHOT_PATH= (empty) to disable
+_snapshot_path = os.getenv("DASHBOARD_SNAPSHOT_PATH", str(Path(BASE_DIR, "dashboard", "src", "data", "runtimeData.json")))
+DASHBOARD_SNAPSHOT_PATH = Path(BASE_DIR, _snapshot_path) if _snapshot_path.strip() else None
+
 db_file = Path(BASE_DIR, "misc", 'db.sqlite')
 
-BDB = Database(db_file)
+# online backups of db_file: every DB_BACKUP_INTERVAL_HOURS (0 disables), DB_BACKUP_KEEP newest kept
+DB_BACKUP_DIR = Path(BASE_DIR, os.getenv("DB_BACKUP_DIR", str(Path("misc", "backups"))))
+DB_BACKUP_INTERVAL_HOURS = float(os.getenv("DB_BACKUP_INTERVAL_HOURS", "6"))
+DB_BACKUP_KEEP = int(os.getenv("DB_BACKUP_KEEP", "7"))
+DB_BACKUP_PAGES = int(os.getenv("DB_BACKUP_PAGES", "256"))
+DB_BACKUP_SLEEP_MS = int(os.getenv("DB_BACKUP_SLEEP_MS", "50"))
+# read-only copy refreshed after each backup, point the dashboard's DASHBOARD_DB_PATH at it
+_replica_path = (os.getenv("DB_REPLICA_PATH") or "").strip()
+DB_REPLICA_PATH = Path(BASE_DIR, _replica_path) if _replica_path else None
+
+# off by default (0); set e.g. 180 to move older payments to the cold archive file once a day.
+# archived rows leave the payments table, so lists and exports only see the recent ones
+PAYMENTS_ARCHIVE_DAYS = int(os.getenv("PAYMENTS_ARCHIVE_DAYS", "0"))
+PAYMENTS_ARCHIVE_FILE = Path(BASE_DIR, os.getenv("PAYMENTS_ARCHIVE_FILE", str(Path("misc", "payments_archive.sqlite"))))
+
+BDB = AsyncDatabase(
+    db_file,
+    readers=DB_READERS,
+    journal_mode=DB_JOURNAL_MODE,
+    group_commit_ms=DB_GROUP_COMMIT_MS,
+    group_commit_max=DB_GROUP_COMMIT_MAX,
+    settings_ttl=DB_SETTINGS_TTL,
+)
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from .config import DELIVERY_CHAT_INTERVAL, DELIVERY_RATE
+
+logger = logging.getLogger(__name__)
+
+# flood waits beyond this many attempts are reported to the caller
+MAX_RETRIES = 3
+
+
+class TokenBucket:
+    """Async token bucket: `rate` calls per second with bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        # FIFO: callers get tokens in arrival order
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Hand out nothing for `seconds`, used when Telegram asks us to back off."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class DeliveryEngine:
+    """
+    Keeps Bot API calls within limits.
+
+    Every call goes through call(), which takes a token from the global bucket, keeps
+    `chat_interval` seconds between messages to the same chat and retries after
+    TelegramRetryAfter (pausing the whole bucket for the requested time). How many
+    jobs run at once is up to the caller (OutboxWorker workers, kick_user concurrency).
+    """
+
+    def __init__(
+        self,
+        *,
+        rate: float = 25.0,
+        chat_interval: float = 1.0,
+        max_retries: int = MAX_RETRIES,
+    ):
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate)
+        self._chat_next: dict[int, float] = {}
+
+    async def _pace(self, chat_id: int):
+        now = time.monotonic()
+        if len(self._chat_next) > 10_000:
+            self._chat_next = {chat: slot for chat, slot in self._chat_next.items() if slot > now}
+        # reserve the next slot for this chat before sleeping, so parallel callers queue up
+        slot = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = slot + self.chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def call(self, func, *args, pace: int | None = None, **kwargs):
+        """
+        await func(*args, **kwargs) within the limits. Pass pace=<chat id> for messages,
+        so they are also spaced per recipient; admin calls (ban/unban) only use the bucket.
+        """
+        attempt = 0
+        while True:
+            if pace is not None:
+                await self._pace(pace)
+            await self.bucket.acquire()
+            try:
+                return await func(*args, **kwargs)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                logger.warning("Flood wait %ss (chat=%s attempt=%s)", e.retry_after, pace, attempt)
+                self.bucket.pause(e.retry_after)
+
+
+DELIVERY = DeliveryEngine(
+    rate=DELIVERY_RATE,
+    chat_interval=DELIVERY_CHAT_INTERVAL,
+)
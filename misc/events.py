@@ -0,0 +1,115 @@
+import asyncio
+import json
+import logging
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# a client that falls this many batches behind is told to reload everything
+SUBSCRIBER_QUEUE_SIZE = 100
+KEEPALIVE_SECONDS = 15
+
+
+class EventBus:
+    """
+    In-process fan-out of change events to live subscribers (the SSE endpoint).
+
+    Events are small dicts with a "type" key: "user", "payment" and "channel"
+    come from Database commits, "kick" from the kick flows.
+    """
+
+    def __init__(self, queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers: set[asyncio.Queue] = set()
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    def publish(self, events: list[dict]):
+        """Deliver one batch of events (one commit) to every subscriber, never blocks."""
+        if not events:
+            return
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(events)
+            except asyncio.QueueFull:
+                # slow consumer: drop its backlog, it has to refetch anyway
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait([{"type": "resync"}])
+
+    def publish_one(self, event_type: str, **data):
+        self.publish([{"type": event_type, **data}])
+
+
+EVENTS = EventBus()
+
+
+def _format_sse(event: dict) -> bytes:
+    return f"data: {json.dumps(event, ensure_ascii=False, default=str)}\n\n".encode("utf-8")
+
+
+def create_event_app(bus: EventBus, *, token: str = "", allow_origins=("*",)) -> web.Application:
+    allow_origin = "*" if "*" in allow_origins else None
+
+    async def events_handler(request: web.Request) -> web.StreamResponse:
+        # EventSource cannot send headers, so the token may also come as ?token=
+        if token:
+            auth = request.headers.get("Authorization", "")
+            candidate = auth[7:] if auth.lower().startswith("bearer ") else ""
+            candidate = candidate or request.query.get("token", "")
+            if candidate.strip() != token:
+                return web.json_response({"error": "Unauthorized"}, status=401)
+
+        origin = allow_origin
+        if origin is None and request.headers.get("Origin") in allow_origins:
+            origin = request.headers["Origin"]
+
+        response = web.StreamResponse(
+            headers={
+                "Content-Type": "text/event-stream",
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no",
+                **({"Access-Control-Allow-Origin": origin} if origin else {}),
+            }
+        )
+        await response.prepare(request)
+
+        queue = bus.subscribe()
+        try:
+            await response.write(b"retry: 3000\n\n")
+            while True:
+                try:
+                    events = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    await response.write(b": ping\n\n")
+                    continue
+                await response.write(b"".join(_format_sse(event) for event in events))
+        except ConnectionResetError:
+            pass
+        finally:
+            bus.unsubscribe(queue)
+        return response
+
+    async def health_handler(_request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok"})
+
+    app = web.Application()
+    app.router.add_get("/events", events_handler)
+    app.router.add_get("/health", health_handler)
+    return app
+
+
+async def start_event_server(bus: EventBus, host: str, port: int, **options) -> web.AppRunner:
+    """Serve GET /events as Server-Sent Events; stop with `await runner.cleanup()`."""
+    runner = web.AppRunner(create_event_app(bus, **options))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Event stream listening at http://%s:%s/events", host, port)
+    return runner
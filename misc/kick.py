@@ -0,0 +1,93 @@
+import asyncio
+import logging
+
+from .config import BDB
+from .delivery import DELIVERY
+from .events import EVENTS
+
+logger = logging.getLogger(__name__)
+
+# channels handled at once for one user, and the time budget for the membership lookup
+KICK_CONCURRENCY = 5
+KICK_TIMEOUT_SECONDS = 15
+
+
+async def _remove_from_channel(bot, channel_id: int, tg_id: int, *, banned: bool):
+    if not banned:
+        await DELIVERY.call(bot.ban_chat_member, chat_id=channel_id, user_id=tg_id)
+    # without the unban the user could never rejoin after paying
+    await DELIVERY.call(bot.unban_chat_member, chat_id=channel_id, user_id=tg_id)
+
+
+async def _kick_from_channel(bot, channel_id: int, tg_id: int, timeout: float, own_bans, on_ban) -> str:
+    member = await asyncio.wait_for(
+        DELIVERY.call(bot.get_chat_member, chat_id=channel_id, user_id=tg_id),
+        timeout,
+    )
+    if member.status == "left":
+        return "already_left"
+    if member.status in ("administrator", "creator"):
+        return "skipped_admin"
+    if member.status == "kicked":
+        if channel_id not in own_bans:
+            # banned by a channel admin (or a finished kick), not ours to lift
+            return "already_left"
+        # our ban from an interrupted earlier attempt: finish it with the unban
+        await asyncio.shield(_remove_from_channel(bot, channel_id, tg_id, banned=True))
+        return "kicked"
+    if on_ban is not None:
+        await on_ban(channel_id)
+    # no timeout and shielded from cancellation: stopping between ban and unban
+    # would leave the user banned for good
+    await asyncio.shield(_remove_from_channel(bot, channel_id, tg_id, banned=False))
+    return "kicked"
+
+
+async def kick_user(
+    bot,
+    tg_id: int,
+    *,
+    channels: list[dict] | None = None,
+    concurrency: int = KICK_CONCURRENCY,
+    timeout: float = KICK_TIMEOUT_SECONDS,
+    own_bans=(),
+    on_ban=None,
+) -> dict:
+    """
+    Remove a user from every channel (ban + unban, so they can rejoin after paying),
+    working on up to `concurrency` channels in parallel.
+
+    A user already banned ("kicked") is left alone unless the channel is in
+    `own_bans`, the channels an earlier interrupted run banned; `on_ban(channel_id)`
+    is awaited before each ban so the caller can record it durably.
+
+    Returns counts of total/kicked/already_left/skipped_admin/failed plus
+    all_cleared, which is True only when nothing failed and no channel had
+    the user as admin.
+    """
+    if channels is None:
+        channels = await BDB.get_channels()
+    channel_ids = [ch.get("id") for ch in channels if ch.get("id") is not None]
+    limit = asyncio.Semaphore(max(1, concurrency))
+
+    async def one(channel_id):
+        async with limit:
+            try:
+                outcome = await _kick_from_channel(bot, channel_id, tg_id, timeout, own_bans, on_ban)
+            except Exception as e:
+                logger.error("Kick failed: user=%s channel=%s error=%r", tg_id, channel_id, e)
+                return "failed"
+        logger.info("Kick %s: user=%s channel=%s", outcome, tg_id, channel_id)
+        return outcome
+
+    outcomes = await asyncio.gather(*(one(channel_id) for channel_id in channel_ids))
+    result = {
+        "total": len(channels),
+        "kicked": outcomes.count("kicked"),
+        "already_left": outcomes.count("already_left"),
+        "skipped_admin": outcomes.count("skipped_admin"),
+        "failed": outcomes.count("failed"),
+    }
+    result["all_cleared"] = result["failed"] == 0 and result["skipped_admin"] == 0
+    EVENTS.publish_one("kick", telegram_id=tg_id, ok=result["all_cleared"], kicked=result["kicked"])
+    return result
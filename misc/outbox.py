@@ -0,0 +1,181 @@
+import asyncio
+import contextvars
+import logging
+import random
+import time
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+from .delivery import DELIVERY
+from .events import EVENTS
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 8
+BACKOFF_BASE_SECONDS = 5
+BACKOFF_MAX_SECONDS = 3600
+# a job still running after this long is considered lost and handed out again
+LEASE_SECONDS = 600
+POLL_SECONDS = 30
+MIN_POLL_SECONDS = 0.5
+PRUNE_EVERY_SECONDS = 3600
+
+# kind -> async handler(bot, payload) returning follow-up (kind, payload) jobs or None
+HANDLERS = {}
+
+# (db, job id) of the job running in the current task, for checkpoint()
+_current_job = contextvars.ContextVar("outbox_job", default=None)
+
+
+class PermanentError(Exception):
+    """Raised by a handler when retrying cannot help; the job is dead-lettered at once."""
+
+
+def outbox_handler(kind: str):
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+async def checkpoint(payload: dict):
+    """
+    Save the running job's (mutated) payload before a step that must not be
+    repeated blindly; a retry of the job gets the saved payload. No-op outside a job.
+    """
+    current = _current_job.get()
+    if current is not None:
+        db, job_id = current
+        await db.save_outbox_payload(job_id, payload)
+
+
+def message_job(chat_id: int, text: str, reply_markup=None) -> dict:
+    """Payload for the "message" job; reply_markup is any aiogram markup object."""
+    payload = {"chat_id": chat_id, "text": text}
+    if reply_markup is not None:
+        payload["markup"] = {
+            "type": type(reply_markup).__name__,
+            "data": reply_markup.model_dump(mode="json", exclude_none=True),
+        }
+    return payload
+
+
+def _load_markup(raw: dict | None):
+    if not raw:
+        return None
+    return getattr(types, raw["type"]).model_validate(raw["data"])
+
+
+@outbox_handler("message")
+async def _send_message_job(bot, payload: dict):
+    await DELIVERY.call(
+        bot.send_message,
+        chat_id=payload["chat_id"],
+        text=payload["text"],
+        reply_markup=_load_markup(payload.get("markup")),
+        pace=payload["chat_id"],
+    )
+
+
+def _backoff(attempts: int) -> float:
+    delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** (attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+
+class OutboxWorker:
+    """
+    Drains the outbox table with up to `workers` jobs in flight.
+
+    Jobs are leased in the database before they run and marked done right after,
+    so a restart resumes unfinished work; a crash between the Telegram call and
+    the done mark is the only window in which a job can run twice. Failures are
+    retried with exponential backoff and dead-lettered after `max_attempts`.
+    """
+
+    def __init__(self, db, bot, *, workers: int = 4, max_attempts: int = MAX_ATTEMPTS):
+        self.db = db
+        self.bot = bot
+        self.workers = max(1, workers)
+        self.max_attempts = max_attempts
+        self._running: set[asyncio.Task] = set()
+        self._active_ids: set[int] = set()
+        self._wake = asyncio.Event()
+
+    def notify(self, events: list[dict]):
+        """BDB listener: wake up as soon as a queued job is committed."""
+        if any(event.get("type") == "outbox" for event in events):
+            self._wake.set()
+
+    def _job_finished(self, task: asyncio.Task):
+        self._running.discard(task)
+        self._wake.set()
+
+    async def _execute(self, job: dict):
+        job_id = job["id"]
+        self._active_ids.add(job_id)
+        _current_job.set((self.db, job_id))
+        try:
+            await self._attempt(job)
+        finally:
+            self._active_ids.discard(job_id)
+
+    async def _attempt(self, job: dict):
+        job_id, kind, attempts = job["id"], job["kind"], job["attempts"]
+        try:
+            handler = HANDLERS.get(kind)
+            if handler is None:
+                raise PermanentError(f"No handler for outbox job kind {kind!r}")
+            follow_up = await handler(self.bot, job["payload"])
+        except (PermanentError, TelegramForbiddenError, TelegramBadRequest) as e:
+            # blocked bot, deleted chat, bad request: the same call would fail again
+            await self._dead(job_id, kind, repr(e))
+        except Exception as e:
+            if attempts >= self.max_attempts:
+                await self._dead(job_id, kind, repr(e))
+                return
+            retry_in = _backoff(attempts)
+            logger.warning("Outbox job %s (%s) failed, retry %s in %.0fs: %r", job_id, kind, attempts, retry_in, e)
+            await self.db.fail_outbox(job_id, repr(e), retry_in=retry_in)
+        else:
+            await self.db.complete_outbox(job_id, follow_up or ())
+
+    async def _dead(self, job_id: int, kind: str, error: str):
+        logger.error("Outbox job %s (%s) dead-lettered: %s", job_id, kind, error)
+        await self.db.fail_outbox(job_id, error)
+        EVENTS.publish_one("outbox_dead", id=job_id, kind=kind, error=error)
+
+    async def run(self):
+        prune_at = time.monotonic()
+        while True:
+            self._wake.clear()
+            free = self.workers - len(self._running)
+            if free <= 0:
+                # every slot taken, the next finished job wakes us; no point polling the table
+                await self._wake.wait()
+                continue
+
+            jobs = await self.db.claim_outbox(free, LEASE_SECONDS)
+            for job in jobs:
+                if job["id"] in self._active_ids:
+                    # our own job outlived its lease, it is still running here
+                    continue
+                task = asyncio.create_task(self._execute(job))
+                self._running.add(task)
+                task.add_done_callback(self._job_finished)
+            if len(self._running) >= self.workers:
+                continue
+
+            if time.monotonic() >= prune_at:
+                await self.db.prune_outbox()
+                prune_at = time.monotonic() + PRUNE_EVERY_SECONDS
+
+            timeout = POLL_SECONDS
+            next_run_at = await self.db.outbox_next_run_at()
+            if next_run_at is not None:
+                # a due job we could not claim (e.g. our own expired lease) must not turn this into a busy loop
+                timeout = min(timeout, max(MIN_POLL_SECONDS, next_run_at - time.time()))
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,109 @@
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+
+from .config import BDB
+from .delivery import DELIVERY
+
+logger = logging.getLogger(__name__)
+
+PROFILE_CACHE_SIZE = 10_000
+# how long a sender without a users row is not looked up again
+UNREGISTERED_TTL_SECONDS = 60
+
+
+class ProfileCache:
+    """
+    Bounded LRU of telegram_id -> (first_name, user_name).
+
+    Names seen on incoming updates or fetched with get_chat are written back
+    to users.first_name/user_name, so a name costs one Bot API call at most
+    and a repeat lookup costs nothing.
+    """
+
+    def __init__(self, db, maxsize: int = PROFILE_CACHE_SIZE):
+        self.db = db
+        self.maxsize = maxsize
+        self._items: OrderedDict[int, tuple[str | None, str | None]] = OrderedDict()
+        # telegram_id -> monotonic time until which the missing users row is trusted
+        self._unregistered: OrderedDict[int, float] = OrderedDict()
+
+    def _get(self, tg_id: int):
+        profile = self._items.get(tg_id)
+        if profile is not None:
+            self._items.move_to_end(tg_id)
+        return profile
+
+    def _put(self, tg_id: int, first_name: str | None, user_name: str | None):
+        self._items[tg_id] = (first_name, user_name)
+        self._items.move_to_end(tg_id)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    async def _store(self, tg_id: int, first_name: str | None, user_name: str | None, db_user: dict | None):
+        self._put(tg_id, first_name, user_name)
+        if db_user is not None and (db_user.get("first_name"), db_user.get("user_name")) != (first_name, user_name):
+            await self.db.update_user_fields(tg_id, first_name=first_name, user_name=user_name)
+
+    async def observe(self, tg_id: int, first_name: str | None, user_name: str | None):
+        """Record the names Telegram just showed us; writes to the DB only when they changed."""
+        if self._get(tg_id) == (first_name, user_name):
+            return
+        now = time.monotonic()
+        if self._unregistered.get(tg_id, 0.0) > now:
+            return
+        db_user = await self.db.get_user(tg_id)
+        if db_user is None:
+            # not registered yet (/start adds the row), look again after a short while
+            self._unregistered[tg_id] = now + UNREGISTERED_TTL_SECONDS
+            self._unregistered.move_to_end(tg_id)
+            while len(self._unregistered) > self.maxsize:
+                self._unregistered.popitem(last=False)
+            return
+        self._unregistered.pop(tg_id, None)
+        await self._store(tg_id, first_name, user_name, db_user)
+
+    async def first_name(self, bot, tg_id: int, user: dict | None = None) -> str | None:
+        """
+        First name for a message greeting: LRU, then the users row (pass it in when
+        already loaded), then get_chat as the last resort. None if Telegram refuses.
+        """
+        tg_id = int(tg_id)
+        profile = self._get(tg_id)
+        if profile is not None and profile[0]:
+            return profile[0]
+
+        if user is None:
+            user = await self.db.get_user(tg_id)
+        if user and user.get("first_name"):
+            self._put(tg_id, user["first_name"], user.get("user_name"))
+            return user["first_name"]
+
+        try:
+            chat = await DELIVERY.call(bot.get_chat, tg_id)
+        except Exception as e:
+            logger.warning("get_chat failed: user=%s error=%s", tg_id, e)
+            return None
+        await self._store(tg_id, chat.first_name, chat.username, user)
+        return chat.first_name
+
+
+class ProfileMiddleware(BaseMiddleware):
+    """Outer update middleware feeding every sender's names into the ProfileCache."""
+
+    def __init__(self, cache: ProfileCache):
+        self.cache = cache
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None and not user.is_bot:
+            try:
+                await self.cache.observe(user.id, user.first_name, user.username)
+            except Exception:
+                logger.exception("Profile update failed: user=%s", user.id)
+        return await handler(event, data)
+
+
+PROFILES = ProfileCache(BDB)
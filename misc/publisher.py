@@ -0,0 +1,93 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotPublisher:
+    """
+    Keeps a JSON copy of get_dashboard_snapshot on disk for static dashboard builds.
+
+    notify() is wired to database change events; bursts are debounced into one
+    publish, and a periodic republish keeps time-based statuses fresh. Nothing is
+    read while no change event arrived and the minute (statuses depend on time)
+    is the same. Otherwise the snapshot is streamed into a temp file next to the
+    target and renamed over it, so readers never see a half-written snapshot,
+    and it is only replaced when the content actually changed.
+    """
+
+    def __init__(self, db, path, *, debounce: float = 1.0, interval: float = 60.0, **snapshot_options):
+        self.db = db
+        self.path = Path(path)
+        self.debounce = debounce
+        self.interval = interval
+        self.snapshot_options = snapshot_options
+        self._encoder = json.JSONEncoder(ensure_ascii=False, indent=2, default=str)
+        self._last_digest = None
+        # bumped by every change event; with the minute it says whether a rebuild can differ
+        self._generation = 0
+        self._published_key = None
+        self._wake = asyncio.Event()
+
+    def notify(self, _events=None):
+        self._generation += 1
+        self._wake.set()
+
+    async def run(self):
+        while True:
+            try:
+                await self.publish_once()
+            except Exception:
+                logger.exception("Snapshot publish failed: %s", self.path)
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+                # let the rest of the burst land before reading
+                await asyncio.sleep(self.debounce)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def publish_once(self) -> bool:
+        """Write the current snapshot; returns False when the file was already up to date."""
+        key = (self._generation, int(time.time() // 60))
+        if key == self._published_key:
+            return False
+        snapshot = await self.db.get_dashboard_snapshot(**self.snapshot_options)
+        loop = asyncio.get_running_loop()
+        written = await loop.run_in_executor(None, self._write, snapshot)
+        self._published_key = key
+        return written
+
+    def _write(self, snapshot) -> bool:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha1()
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{self.path.name}.", suffix=".tmp", dir=self.path.parent)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                for chunk in self._encoder.iterencode(snapshot):
+                    fh.write(chunk)
+                    digest.update(chunk.encode("utf-8"))
+                if digest.hexdigest() == self._last_digest:
+                    return False
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp_path, self.path)
+            tmp_path = None
+        finally:
+            if tmp_path is not None:
+                os.unlink(tmp_path)
+
+        self._last_digest = digest.hexdigest()
+        logger.info(
+            "Snapshot published: %s (users=%s payments=%s)",
+            self.path,
+            len(snapshot.get("users", [])),
+            len(snapshot.get("payments", [])),
+        )
+        return True
@@ -3,6 +3,7 @@ from pathlib import Path
 from datetime import datetime 
 import requests
 
+from database import parse_subscription_end as _parse_subscription_end
 from misc import CRYPTO_BOT_API, BASE_DIR, BDB, TRON_API_KEY
 
 API_URL = "https://pay.crypt.bot/api/"
@@ -29,28 +30,8 @@ def create_invoice(amount: float, payload: str, description: str = 'Альфре
 
 
 def parse_subscription_end(raw_value, *, return_string: bool = False):
-    """Parse subscription_end regardless of presence of microseconds."""
-    if not raw_value:
-        return (None, None) if return_string else None
-    if isinstance(raw_value, datetime):
-        parsed = raw_value
-    else:
-        value = str(raw_value).replace("T", " ")
-
-        parsed = None
-        for fmt in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"):
-            try:
-                parsed = datetime.strptime(value, fmt)
-                break
-            except ValueError:
-                continue
-
-        if parsed is None:
-            try:
-                parsed = datetime.fromisoformat(value)
-            except ValueError:
-                parsed = None
-
+    """Parse subscription_end in any stored format (see database.dates)."""
+    parsed = _parse_subscription_end(raw_value)
     if parsed is None:
         return (None, None) if return_string else None
 
@@ -89,13 +70,8 @@ def get_text(text):
     return data.get(text)
 
 
-def get_channel_id_from_list(name: str):
-    channels = BDB.get_channels()
-
-    for channel in channels:
-        if channel['name'] == name:
-            return channel['id']
-    return None
+async def get_channel_id_from_list(name: str):
+    return await BDB.get_channel_id(name)
 
 
 async def check_payment_received(wallet, min_amount, start_time: datetime):
@@ -1,16 +1,17 @@
 import asyncio
+import heapq
 import json
 import logging
-from datetime import datetime, timedelta
-from zoneinfo import ZoneInfo
+import time
+from datetime import datetime
 
 from aiogram import Bot
 
+from database import KYIV              # <<— ключова таймзона
 from keyboards import payment_kb
-from misc import BDB, get_text, normalize_subscription_end
+from misc import BDB, DELIVERY, PROFILES, checkpoint, get_text, kick_user, message_job, outbox_handler
 
 TOKEN = "YOUR_TOKEN_HERE"
-KYIV = ZoneInfo("Europe/Kyiv")        # <<— ключова таймзона
 
 logger = logging.getLogger(__name__)
 
@@ -23,62 +24,14 @@ STAGES = [
     (0.0, "KICK", "expired"),
 ]
 
+# мінімальна пауза між двома спробами для одного користувача (догонялка етапів, ретрай кіку)
 CHECK_INTERVAL_SECONDS = 60
-
-def _parse_dt_kyiv(s: str | datetime) -> datetime | None:
-    """
-    Парсимо datetime зі строк БД як локальний КИЇВСЬКИЙ час (aware, Europe/Kyiv).
-    Підтримуємо:
-      - ISO з "T" / "Z"
-      - без мікросекунд
-      - без секунд
-      - лише дату (ставимо 23:59)
-    """
-    if not s:
-        return None
-    if isinstance(s, datetime):
-        if s.tzinfo:
-            return s.astimezone(KYIV)
-        return s.replace(tzinfo=KYIV)
-
-    value = str(s).strip()
-    if not value:
-        return None
-
-    value = value.replace("T", " ")
-    if value.endswith("Z"):
-        value = value[:-1] + "+00:00"
-
-    try:
-        dt = datetime.fromisoformat(value)
-        if dt.tzinfo:
-            return dt.astimezone(KYIV)
-        if (" " not in value) and (":" not in value):
-            dt = dt.replace(hour=23, minute=59)
-        return dt.replace(tzinfo=KYIV)
-    except ValueError:
-        pass
-
-    date_only = {"%Y-%m-%d", "%d.%m.%Y"}
-    formats = (
-        "%Y-%m-%d %H:%M:%S.%f",
-        "%Y-%m-%d %H:%M:%S",
-        "%Y-%m-%d %H:%M",
-        "%Y-%m-%d",
-        "%d.%m.%Y %H:%M:%S",
-        "%d.%m.%Y %H:%M",
-        "%d.%m.%Y",
-    )
-    for fmt in formats:
-        try:
-            dt = datetime.strptime(value, fmt)
-            if fmt in date_only:
-                dt = dt.replace(hour=23, minute=59)
-            return dt.replace(tzinfo=KYIV)
-        except ValueError:
-            continue
-
-    return None
+# повне перезавантаження черги на випадок змін, що пройшли повз події
+RESYNC_SECONDS = 6 * 3600
+# верхня межа вибірки при побудові черги
+SCHEDULE_HORIZON_SECONDS = 100 * 365 * 86400
+# поля користувача, після зміни яких дедлайн треба перерахувати
+SCHEDULE_FIELDS = frozenset({"telegram_id", "subscription_end", "subscription_end_ts", "notified_marks", "job_title"})
 
 def _load_marks(user: dict) -> set[str]:
     raw = user.get("notified_marks") or "[]"
@@ -90,156 +43,257 @@ def _load_marks(user: dict) -> set[str]:
         pass
     return set()
 
-def _save_marks(tg_id: int | str, marks: set[str]):
-    BDB.update_user_field(tg_id, "notified_marks", json.dumps(sorted(list(marks), key=lambda x: (x=="expired", x))))
+def _next_deadline(user: dict | None) -> float | None:
+    """Epoch moment of the user's next unsent stage, None if nothing is left to send."""
+    if not user or user.get("job_title") != "user" or user.get("subscription_end_ts") is None:
+        return None
+    marks = _load_marks(user)
+    if "expired" in marks:
+        return None
+    # send_warning_once sends the first unmarked stage whose threshold has passed
+    for stage_days, _, mark in STAGES:
+        if mark not in marks:
+            return user["subscription_end_ts"] - stage_days * 86400
+    return None
 
-def _rollback_subscription(user: dict, *, days: int = 5, reason: str = "") -> None:
-    tg_id = user.get("telegram_id")
-    now = datetime.now(KYIV)
-    current_end = _parse_dt_kyiv(user.get("subscription_end"))
-    if current_end and current_end > now:
-        logger.info(
-            "Skip rollback: user=%s current_end=%s reason=%s",
-            tg_id,
-            current_end.isoformat(),
-            reason or "kick_failed",
-        )
-        return
-
-    new_end = now + timedelta(days=days)
-    normalized = normalize_subscription_end(new_end)
-    BDB.update_user_field(tg_id, "subscription_end", normalized)
-    BDB.update_user_field(tg_id, "notified_marks", "[]")
-    logger.warning(
-        "Rollback subscription: user=%s new_end=%s reason=%s",
-        tg_id,
-        normalized,
-        reason or "kick_failed",
-    )
+def _dump_marks(marks: set[str]) -> str:
+    return json.dumps(sorted(list(marks), key=lambda x: (x=="expired", x)))
 
-async def _send_stage_message(bot: Bot, user: dict, stage_key: str, mark: str) -> bool:
-    tg_id = user["telegram_id"]
-    try:
-        user_name = user.get("first_name") or (await bot.get_chat(tg_id)).first_name
-    except Exception:
-        user_name = "Друже"
-
-    if mark == "expired":
-        text = get_text(stage_key)
-        channels = BDB.get_channels()
-        kick_ok = True
-        if not channels:
-            logger.warning("No channels configured to kick user %s", tg_id)
-        for ch in channels:
-            channel_id = ch["id"]
-            try:
-                await bot.ban_chat_member(chat_id=channel_id, user_id=tg_id)
-                await bot.unban_chat_member(chat_id=channel_id, user_id=tg_id)
-                logger.info("Kick success: user=%s channel=%s", tg_id, channel_id)
-            except Exception as e:
-                kick_ok = False
-                logger.error("Kick failed: user=%s channel=%s error=%s", tg_id, channel_id, e)
-        try:
-            await bot.send_message(chat_id=tg_id, text=text)
-            logger.info("Kick message sent: user=%s", tg_id)
-        except Exception as e:
-            logger.error("Kick message failed: user=%s error=%s", tg_id, e)
-        return kick_ok
+def _stage_days(stage_key: str) -> float:
+    return next(days for days, key, _ in STAGES if key == stage_key)
 
-    try:
-        text = get_text(stage_key).format(name=user_name)
-    except Exception:
-        text = "Нагадування: завершується доступ."
-    try:
-        await bot.send_message(chat_id=tg_id, text=text, reply_markup=payment_kb)
-        logger.info("Warning sent: user=%s mark=%s", tg_id, mark)
-    except Exception as e:
-        logger.error("Warning send failed: user=%s mark=%s error=%s", tg_id, mark, e)
-    return True
+def _queue_stage(db, tg_id: int, marks: str, kind: str, payload: dict, dedupe_key: str):
+    # мітка і задача в outbox комітяться разом: без дублів і без втрат після рестарту
+    db.update_user_field(tg_id, "notified_marks", marks)
+    db.enqueue_outbox(kind, payload, dedupe_key=dedupe_key)
 
-async def send_warning_once(bot: Bot, user: dict, days_left: float):
+async def send_warning_once(user: dict, days_left: float):
     marks = _load_marks(user)
     for stage_days, stage_key, mark in STAGES:
         if days_left <= stage_days and (mark not in marks):
-            should_mark = await _send_stage_message(bot, user, stage_key, mark)
-            if should_mark:
-                marks.add(mark)
-                _save_marks(user["telegram_id"], marks)
+            marks.add(mark)
+            tg_id = user["telegram_id"]
+            if mark == "expired":
+                kind, dedupe_key = "kick", f"kick:{tg_id}"
             else:
-                logger.warning("Skip marking expired for user=%s due to kick failure", user["telegram_id"])
-                if mark == "expired":
-                    _rollback_subscription(user, days=5, reason="kick_failed")
+                kind, dedupe_key = "reminder", f"reminder:{tg_id}:{mark}"
+            payload = {"telegram_id": tg_id, "stage_key": stage_key, "notify": True}
+            await BDB.run_in_transaction(_queue_stage, tg_id, _dump_marks(marks), kind, payload, dedupe_key)
+            logger.info("Stage queued: user=%s mark=%s", user["telegram_id"], mark)
             break
 
-async def reminder_payment(bot: Bot):
-    while True:
-        now = datetime.now(KYIV)  # <<— поточний час саме Києва
+@outbox_handler("reminder")
+async def _reminder_job(bot: Bot, payload: dict):
+    tg_id = payload["telegram_id"]
+    stage_key = payload["stage_key"]
+    user = await BDB.get_user(tg_id)
+    end_ts = user.get("subscription_end_ts") if user else None
+    # renewed while the job waited: the warning is no longer true
+    if end_ts is None or end_ts - time.time() > _stage_days(stage_key) * 86400:
+        logger.info("Warning dropped: user=%s stage=%s", tg_id, stage_key)
+        return None
 
-        for user in BDB.get_users_by_job_title("user"):
-            sub_end_raw = user.get("subscription_end")
-            sub_end = _parse_dt_kyiv(sub_end_raw)
-            if not sub_end:
-                continue
+    user_name = await PROFILES.first_name(bot, tg_id, user) or "Друже"
+    try:
+        text = get_text(stage_key).format(name=user_name)
+    except Exception:
+        text = "Нагадування: завершується доступ."
+    await DELIVERY.call(bot.send_message, chat_id=tg_id, text=text, reply_markup=payment_kb, pace=tg_id)
+    logger.info("Warning sent: user=%s stage=%s", tg_id, stage_key)
+    return None
 
-            # різниця у таймзоні Києва (DST враховується автоматично)
-            seconds_left = (sub_end - now).total_seconds()
-            days_left = seconds_left / 86400.0
+@outbox_handler("kick")
+async def _kick_job(bot: Bot, payload: dict):
+    tg_id = payload["telegram_id"]
+    user = await BDB.get_user(tg_id)
+    end_ts = user.get("subscription_end_ts") if user else None
+    if end_ts is not None and end_ts > time.time():
+        logger.info("Kick dropped, subscription renewed: user=%s", tg_id)
+        return None
 
+    channels = await BDB.get_channels()
+    if not channels:
+        logger.warning("No channels configured to kick user %s", tg_id)
+    # channels this job has banned in, saved before each ban: a retry may only lift those bans
+    own_bans = payload.setdefault("own_bans", [])
+
+    async def remember_ban(channel_id):
+        own_bans.append(channel_id)
+        await checkpoint(payload)
+
+    result = await kick_user(bot, tg_id, channels=channels, own_bans=own_bans, on_ban=remember_ban)
+    if result["failed"]:
+        # retried with backoff by the outbox, dead-lettered in the end
+        raise RuntimeError(f"Kick incomplete for user {tg_id}: {result}")
+    if result["skipped_admin"]:
+        # nothing to retry (admins cannot be kicked), but the user still gets the notice;
+        # the "kick" event with ok=False already reached the dashboard
+        logger.warning("Kick partial, user %s is admin in %s channel(s)", tg_id, result["skipped_admin"])
+
+    if payload.get("notify") or result["kicked"]:
+        return [("message", message_job(tg_id, get_text(payload.get("stage_key") or "KICK")))]
+    return None
+
+class ExpiryScheduler:
+    """
+    Min-heap of every user's next stage deadline (see STAGES).
+
+    Built once from the database, then kept current from BDB change events, so
+    the loop sleeps until the earliest deadline instead of rescanning users.
+    Heap entries are (due_ts, telegram_id); one that no longer matches
+    self._due is stale and skipped.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[float, int]] = []
+        self._due: dict[int, float] = {}
+        # telegram_id -> epoch before which the user must not fire again
+        self._hold: dict[int, float] = {}
+        self._dirty: set[int] = set()
+        self._wake = asyncio.Event()
+
+    def notify(self, events: list[dict]):
+        """BDB listener: recompute deadlines of users whose dates or marks changed."""
+        for event in events:
+            if event.get("type") == "user" and SCHEDULE_FIELDS.intersection(event.get("fields") or ()):
+                self._dirty.add(event["telegram_id"])
+        if self._dirty:
+            self._wake.set()
+
+    def _schedule(self, tg_id: int, due_ts: float | None):
+        if due_ts is None:
+            self._due.pop(tg_id, None)
+            self._hold.pop(tg_id, None)
+            return
+        due_ts = max(due_ts, self._hold.get(tg_id, 0.0))
+        if self._due.get(tg_id) == due_ts:
+            return
+        self._due[tg_id] = due_ts
+        heapq.heappush(self._heap, (due_ts, tg_id))
+        if len(self._heap) > 2 * len(self._due) + 1024:
+            # too many stale entries, rebuild from the live deadlines
+            self._heap = [(due, user_id) for user_id, due in self._due.items()]
+            heapq.heapify(self._heap)
+
+    async def load(self):
+        users = await BDB.users_expiring_between(
+            None,
+            time.time() + SCHEDULE_HORIZON_SECONDS,
+            without_mark="expired",
+        )
+        self._due = {}
+        for user in users:
+            due_ts = _next_deadline(user)
+            if due_ts is not None:
+                self._due[user["telegram_id"]] = max(due_ts, self._hold.get(user["telegram_id"], 0.0))
+        self._heap = [(due, user_id) for user_id, due in self._due.items()]
+        heapq.heapify(self._heap)
+        logger.info("Expiry schedule loaded: users=%s", len(self._due))
+
+    async def _refresh(self, tg_id: int):
+        self._schedule(tg_id, _next_deadline(await BDB.get_user(tg_id)))
+
+    def _pop_due(self, now: float) -> list[int]:
+        due_ids = []
+        while self._heap and self._heap[0][0] <= now:
+            due_ts, tg_id = heapq.heappop(self._heap)
+            if self._due.get(tg_id) == due_ts:
+                del self._due[tg_id]
+                due_ids.append(tg_id)
+        return due_ids
+
+    def _seconds_to_next(self, now: float) -> float | None:
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - now)
+
+    async def _process(self, tg_id: int):
+        user = await BDB.get_user(tg_id)
+        now = time.time()
+        due_ts = _next_deadline(user)
+        if due_ts is None:
+            return
+        if due_ts > now:
+            # subscription moved after the entry was queued
+            self._schedule(tg_id, due_ts)
+            return
+
+        # one stage per pass: an overdue backlog is worked off a minute per stage
+        self._hold[tg_id] = now + CHECK_INTERVAL_SECONDS
+        await send_warning_once(user, (user["subscription_end_ts"] - now) / 86400.0)
+        await self._refresh(tg_id)
+
+    async def _process_safe(self, tg_id: int):
+        try:
+            await self._process(tg_id)
+        except Exception:
+            logger.exception("Error processing user: %s", tg_id)
+            self._hold[tg_id] = time.time() + CHECK_INTERVAL_SECONDS
+            self._schedule(tg_id, time.time())
+
+    async def run(self):
+        await self.load()
+        resync_at = time.monotonic() + RESYNC_SECONDS
+        while True:
+            self._wake.clear()
+            while self._dirty:
+                await self._refresh(self._dirty.pop())
+
+            now = time.time()
+            self._hold = {tg_id: until for tg_id, until in self._hold.items() if until > now}
+            # only queues outbox jobs, the sending happens in OutboxWorker
+            for tg_id in self._pop_due(now):
+                await self._process_safe(tg_id)
+
+            if time.monotonic() >= resync_at:
+                await self.load()
+                resync_at = time.monotonic() + RESYNC_SECONDS
+
+            timeout = resync_at - time.monotonic()
+            next_due = self._seconds_to_next(time.time())
+            if next_due is not None:
+                timeout = min(timeout, next_due)
+            if self._dirty:
+                continue
             try:
-                await send_warning_once(bot, user, days_left)
-            except Exception:
-                logger.exception(
-                    "Error processing user: %s",
-                    user.get("telegram_id"),
-                )
+                await asyncio.wait_for(self._wake.wait(), max(0.0, timeout))
+            except asyncio.TimeoutError:
+                pass
 
-        await asyncio.sleep(CHECK_INTERVAL_SECONDS)
 
+async def reminder_payment():
+    scheduler = ExpiryScheduler()
+    # змінені дати/мітки приходять подіями після коміту
+    BDB.add_listener(scheduler.notify)
+    await scheduler.run()
 
-async def kick_expired_once(bot: Bot):
+
+async def kick_expired_once():
     """
-    One-time sweep on startup: try to kick users whose subscription already expired
-    (even if they were already marked as expired).
+    One-time sweep on startup: queue a kick for every user whose subscription already
+    expired (even if they were already marked as expired). Users still in no channel
+    get no message.
     """
     now = datetime.now(KYIV)
-    candidates = 0
-    kicked = 0
-    marked_before = 0
-    no_date = 0
-    errors = 0
-
-    for user in BDB.get_users_by_job_title("user"):
-        sub_end_raw = user.get("subscription_end")
-        sub_end = _parse_dt_kyiv(sub_end_raw)
-        if not sub_end:
-            no_date += 1
-            continue
-        if sub_end > now:
-            continue
-
-        marks = _load_marks(user)
-        had_expired_mark = "expired" in marks
-        if had_expired_mark:
-            marked_before += 1
-
-        candidates += 1
-        try:
-            ok = await _send_stage_message(bot, user, "KICK", "expired")
-            if ok:
-                kicked += 1
-            else:
-                _rollback_subscription(user, days=5, reason="startup_kick_failed")
-        except Exception:
-            errors += 1
-            logger.exception("Startup kick failed: user=%s", user.get("telegram_id"))
-            _rollback_subscription(user, days=5, reason="startup_kick_exception")
-
+    no_date = await BDB.count_users_without_subscription_end()
+    users = await BDB.users_expired_before(now)
+    marked_before = sum(1 for user in users if "expired" in _load_marks(user))
+
+    def queue_all(db):
+        queued = 0
+        for user in users:
+            payload = {"telegram_id": user["telegram_id"], "stage_key": "KICK", "notify": False}
+            if db.enqueue_outbox("kick", payload, dedupe_key=f"kick:{user['telegram_id']}") is not None:
+                queued += 1
+        return queued
+
+    queued = await BDB.run_in_transaction(queue_all)
     logger.info(
-        "Startup kick sweep done: candidates=%s kicked=%s marked_before=%s no_date=%s errors=%s",
-        candidates,
-        kicked,
+        "Startup kick sweep done: candidates=%s queued=%s marked_before=%s no_date=%s",
+        len(users),
+        queued,
         marked_before,
         no_date,
-        errors,
     )
-
@@ -0,0 +1,20 @@
+import sqlite3
+
+import pytest
+
+from database import Database
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = Database(tmp_path / "db.sqlite")
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def raw(tmp_path):
+    """Independent connection on the same file, sees only committed data."""
+    conn = sqlite3.connect(tmp_path / "db.sqlite")
+    yield conn
+    conn.close()
@@ -0,0 +1,111 @@
+import random
+from datetime import datetime, timedelta
+
+PLANS = ["VIP", "Signals", "Crypto"]
+JOB_TITLES = ["user", "tp", "admin"]
+
+
+def _nonzero(rows):
+    return sorted(tuple(row) for row in rows if row[-1] != 0)
+
+
+def _expected_user_days(cursor):
+    return _nonzero(cursor.execute(
+        """
+        SELECT COALESCE(job_title, 'user'), COALESCE(CAST(subscription_end_ts / 86400 AS INTEGER), -1), COUNT(*)
+        FROM users GROUP BY 1, 2
+        """
+    ))
+
+
+def _expected_plan_days(cursor):
+    return _nonzero(cursor.execute(
+        """
+        SELECT up.plan, CAST(u.subscription_end_ts / 86400 AS INTEGER), COUNT(*)
+        FROM user_plans up JOIN users u ON u.telegram_id = up.telegram_id
+        WHERE u.subscription_end_ts IS NOT NULL
+        GROUP BY 1, 2
+        """
+    ))
+
+
+def _expected_latest_paid(cursor):
+    latest = {}
+    for telegram_id, payment_id, amount, jd in cursor.execute(
+        """
+        SELECT telegram_id, id, amount,
+               COALESCE(julianday(paid_at), julianday(tx_timestamp), julianday(updated_at), julianday(created_at))
+        FROM payments WHERE lower(status) = 'paid'
+        """
+    ):
+        if telegram_id not in latest or jd > latest[telegram_id][2]:
+            latest[telegram_id] = (payment_id, amount, jd)
+    return sorted((telegram_id, payment_id, amount) for telegram_id, (payment_id, amount, _) in latest.items())
+
+
+def _assert_aggregates(db):
+    cursor = db.cursor
+    assert _nonzero(cursor.execute("SELECT job_title, day, users FROM user_expiry_days")) == _expected_user_days(cursor)
+    assert _nonzero(cursor.execute("SELECT plan, day, members FROM plan_expiry_days")) == _expected_plan_days(cursor)
+    assert sorted(
+        tuple(row) for row in cursor.execute("SELECT telegram_id, payment_id, amount FROM user_latest_paid")
+    ) == _expected_latest_paid(cursor)
+
+
+def test_aggregates_follow_random_changes(db):
+    rng = random.Random(7)
+    base = datetime(2030, 1, 1, 12, 0)
+    users = list(range(1, 41))
+    for tg_id in users:
+        db.add_user(tg_id)
+    payments = []
+    paid_minute = 0
+
+    for step in range(600):
+        tg_id = rng.choice(users)
+        action = rng.randrange(7)
+        if action == 0:
+            end = None if rng.random() < 0.2 else base + timedelta(days=rng.randrange(-5, 20), hours=rng.randrange(24))
+            db.update_user_fields(tg_id, subscription_end=end.strftime("%Y-%m-%d %H:%M:%S.%f") if end else None)
+        elif action == 1:
+            db.update_user_fields(tg_id, job_title=rng.choice(JOB_TITLES))
+        elif action == 2:
+            db.add_subscription_plan(tg_id, rng.choice(PLANS))
+        elif action == 3:
+            db.remove_subscription_plan(tg_id, rng.choice(PLANS))
+        elif action == 4:
+            payments.append(db.create_payment_entry(
+                telegram_id=tg_id, method="cryptobot", amount=rng.randrange(10, 100), plan="one_month",
+            ))
+        elif action == 5 and payments:
+            paid_minute += 1
+            db.update_payment_entry(
+                rng.choice(payments),
+                status=rng.choice(["paid", "canceled"]),
+                # distinct times, so "latest" is never a tie
+                paid_at=(base + timedelta(minutes=paid_minute)).strftime("%Y-%m-%d %H:%M:%S"),
+            )
+        elif action == 6 and rng.random() < 0.1:
+            db.cursor.execute("DELETE FROM user_plans WHERE telegram_id = ?", (tg_id,))
+            db.cursor.execute("DELETE FROM users WHERE telegram_id = ?", (tg_id,))
+            db.conn.commit()
+            users.remove(tg_id)
+            users.append(max(users) + 1)
+            db.add_user(users[-1])
+        if step % 100 == 0:
+            _assert_aggregates(db)
+
+    _assert_aggregates(db)
+
+
+def test_plan_member_counts_match_memberships(db):
+    end = (datetime.now() + timedelta(days=30)).strftime("%Y-%m-%d %H:%M:%S.%f")
+    for tg_id in (1, 2, 3):
+        db.add_user(tg_id)
+        db.update_user_fields(tg_id, subscription_end=end)
+    db.add_subscription_plan(1, "VIP")
+    db.add_subscription_plan(2, "VIP")
+    db.add_subscription_plan(3, "Signals")
+    db.remove_subscription_plan(2, "VIP")
+
+    assert db.get_plan_member_counts() == {"VIP": 1, "Signals": 1}
@@ -0,0 +1,138 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from database import AsyncDatabase, Database
+
+
+def _committed_users(raw):
+    return [row[0] for row in raw.execute("SELECT telegram_id FROM users ORDER BY telegram_id")]
+
+
+def test_writes_are_committed_together_at_the_count_limit(tmp_path, raw):
+    db = Database(tmp_path / "db.sqlite", group_commit_max=3)
+    try:
+        db.add_user(1)
+        db.add_user(2)
+        assert db.pending_writes == 2
+        assert _committed_users(raw) == []
+        # the writer itself already sees its queued writes
+        assert db.get_user(2) is not None
+
+        db.add_user(3)
+        assert db.pending_writes == 0
+        assert _committed_users(raw) == [1, 2, 3]
+        assert db.commits_saved == 2
+    finally:
+        db.close()
+
+
+def test_flush_commits_pending_writes(tmp_path, raw):
+    db = Database(tmp_path / "db.sqlite", group_commit_max=100)
+    try:
+        db.add_user(1)
+        assert db.flush() == 1
+        assert db.flush() == 0
+        assert _committed_users(raw) == [1]
+    finally:
+        db.close()
+
+
+def test_transaction_flushes_queued_writes_and_commits_at_once(tmp_path, raw):
+    db = Database(tmp_path / "db.sqlite", group_commit_max=100)
+    try:
+        db.add_user(1)
+        with db.transaction():
+            db.add_user(2)
+            db.update_user_fields(2, access_granted=1)
+        assert _committed_users(raw) == [1, 2]
+    finally:
+        db.close()
+
+
+def test_events_are_delivered_after_commit_only(tmp_path):
+    db = Database(tmp_path / "db.sqlite", group_commit_max=2)
+    seen = []
+    db.add_listener(seen.extend)
+    try:
+        db.add_user(1)
+        assert seen == []
+        db.add_user(2)
+        assert [event["telegram_id"] for event in seen] == [1, 2]
+
+        with pytest.raises(RuntimeError):
+            with db.transaction():
+                db.add_user(3)
+                raise RuntimeError
+        assert [event["telegram_id"] for event in seen] == [1, 2]
+    finally:
+        db.close()
+
+
+def _create_fk_tables(db):
+    db.cursor.execute("CREATE TABLE parent (id INTEGER PRIMARY KEY)")
+    db.cursor.execute("CREATE TABLE child (parent_id REFERENCES parent(id))")
+    db.conn.commit()
+    # has no effect inside an open transaction
+    db.cursor.execute("PRAGMA foreign_keys = ON")
+
+
+def _queue_failing_commit(db):
+    # a deferred foreign key violation only fails at COMMIT
+    db.cursor.execute("PRAGMA defer_foreign_keys = ON")
+    db.cursor.execute("INSERT INTO child VALUES (99)")
+    db._commit()
+
+
+def test_failed_flush_rolls_back_and_raises(tmp_path, raw):
+    db = Database(tmp_path / "db.sqlite", group_commit_max=100)
+    try:
+        _create_fk_tables(db)
+        db.add_user(1)
+        _queue_failing_commit(db)
+        with pytest.raises(sqlite3.OperationalError, match="2 write"):
+            db.flush()
+        assert db.pending_writes == 0
+        assert db.get_user(1) is None
+        assert _committed_users(raw) == []
+
+        db.add_user(2)
+        db.flush()
+        assert _committed_users(raw) == [2]
+    finally:
+        db.close()
+
+
+def test_async_timer_flush_commits_the_tail_of_a_burst(tmp_path, raw):
+    async def scenario():
+        db = AsyncDatabase(tmp_path / "db.sqlite", group_commit_ms=20)
+        try:
+            await db.add_user(1)
+            await db.add_user(2)
+            await asyncio.sleep(0.2)
+            return _committed_users(raw)
+        finally:
+            db.close()
+
+    assert asyncio.run(scenario()) == [1, 2]
+
+
+def test_async_failed_timer_flush_is_raised_by_the_next_write(tmp_path):
+    async def scenario():
+        db = AsyncDatabase(tmp_path / "db.sqlite", group_commit_ms=20)
+        try:
+            await db.run(_create_fk_tables)
+            await db.add_user(1)
+            await db.run(_queue_failing_commit)
+            await asyncio.sleep(0.2)
+            with pytest.raises(sqlite3.OperationalError):
+                await db.add_user(2)
+            assert await db.get_user(1) is None
+            await db.add_user(3)
+            await db.flush()
+            return await db.get_user(3)
+        finally:
+            db.close()
+
+    assert asyncio.run(scenario()) is not None
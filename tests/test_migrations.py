@@ -0,0 +1,137 @@
+import json
+import sqlite3
+
+from database import Database, to_epoch
+from database.migrations import LATEST_VERSION, MIGRATIONS
+
+# schema as the bot created it before versioned migrations existed
+BASELINE_SCHEMA = """
+CREATE TABLE users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id INTEGER NOT NULL UNIQUE,
+    user_name TEXT,
+    first_name TEXT,
+    subscription_plan TEXT DEFAULT '[]',
+    subscription_end DATETIME,
+    job_title TEXT DEFAULT 'user',
+    access_granted INTEGER DEFAULT 0,
+    payment INTEGER DEFAULT 0,
+    notified_marks TEXT DEFAULT '[]'
+);
+CREATE TABLE settings (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE payments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id INTEGER NOT NULL,
+    method TEXT NOT NULL,
+    plan TEXT,
+    amount REAL,
+    status TEXT NOT NULL,
+    provider_invoice_id TEXT,
+    pay_url TEXT,
+    wallet_address TEXT,
+    tx_hash TEXT,
+    tx_from TEXT,
+    tx_to TEXT,
+    tx_value REAL,
+    tx_timestamp DATETIME,
+    user_name TEXT,
+    first_name TEXT,
+    admin_id INTEGER,
+    admin_name TEXT,
+    old_subscription_end DATETIME,
+    new_subscription_end DATETIME,
+    payload TEXT,
+    description TEXT,
+    raw_response TEXT,
+    paid_at DATETIME,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX idx_payments_user ON payments(telegram_id);
+CREATE INDEX idx_payments_status ON payments(status);
+"""
+
+
+def _baseline_db(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany(
+        "INSERT INTO settings (key, value) VALUES (?, ?)",
+        [
+            ("channel", json.dumps([{"id": -100, "name": "VIP"}, {"id": -200, "name": "Signals"}])),
+            ("crypto_address", json.dumps([{"address": "TAddr1"}, {"address": "TAddr2"}])),
+        ],
+    )
+    conn.executemany(
+        "INSERT INTO users (telegram_id, subscription_plan, subscription_end) VALUES (?, ?, ?)",
+        [
+            (1, '["VIP", "Signals"]', "2030-01-01 10:00:00.000000"),
+            (2, '["VIP"]', "15.02.2030"),
+            (3, "not json", None),
+        ],
+    )
+    conn.executemany(
+        "INSERT INTO payments (telegram_id, method, plan, amount, status, raw_response, paid_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (1, "cryptobot", "one_month", 50, "paid", '{"invoice_id": 7}', "2025-03-01 12:00:00"),
+            (2, "usdt_trc20", "one_month", 50, "pending", None, None),
+        ],
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_migrations_are_numbered_in_order():
+    versions = [item.version for item in MIGRATIONS]
+    assert versions == sorted(set(versions))
+    assert LATEST_VERSION == versions[-1]
+
+
+def test_baseline_database_is_migrated(tmp_path):
+    path = tmp_path / "db.sqlite"
+    _baseline_db(path)
+
+    db = Database(path)
+    try:
+        assert db.schema_version == LATEST_VERSION
+        assert db.get_channels() == [{"name": "VIP", "id": -100}, {"name": "Signals", "id": -200}]
+        assert sorted(db.get_user_plans(1)) == ["Signals", "VIP"]
+        assert db.get_user_plans(2) == ["VIP"]
+        assert db.get_user_plans(3) == []
+
+        assert db.get_user(1)["subscription_end_ts"] == to_epoch("2030-01-01 10:00:00.000000")
+        assert db.get_user(2)["subscription_end_ts"] == to_epoch("15.02.2030")
+        assert db.get_user(3)["subscription_end_ts"] is None
+
+        assert db.get_payment_raw(1) == {"invoice_id": 7}
+        assert db.get_revenue_daily() == [
+            {"day": "2025-03-01", "method": "cryptobot", "plan": "one_month", "payments": 1, "amount": 50.0}
+        ]
+        addresses = {row[0] for row in db.cursor.execute("SELECT address FROM crypto_addresses")}
+        assert addresses == {"TAddr1", "TAddr2"}
+    finally:
+        db.close()
+
+
+def test_reopening_applies_nothing(tmp_path):
+    path = tmp_path / "db.sqlite"
+    _baseline_db(path)
+    Database(path).close()
+
+    conn = sqlite3.connect(path)
+    applied = conn.execute("SELECT version FROM schema_version ORDER BY version").fetchall()
+    conn.close()
+    assert [row[0] for row in applied] == [item.version for item in MIGRATIONS]
+
+    db = Database(path)
+    try:
+        assert db.schema_version == LATEST_VERSION
+        assert db.cursor.execute("SELECT COUNT(*) FROM schema_version").fetchone()[0] == len(MIGRATIONS)
+    finally:
+        db.close()
+
+
+def test_fresh_database_gets_every_migration(db):
+    assert db.schema_version == LATEST_VERSION
+    assert db.get_channels() == []
@@ -0,0 +1,124 @@
+import sqlite3
+import time
+
+import pytest
+
+
+def _status(db, job_id):
+    return tuple(db.cursor.execute("SELECT status, attempts FROM outbox WHERE id = ?", (job_id,)).fetchone())
+
+
+def test_dedupe_key_is_unique_among_live_jobs(db):
+    first = db.enqueue_outbox("kick", {"telegram_id": 1}, dedupe_key="kick:1")
+    assert first is not None
+    assert db.enqueue_outbox("kick", {"telegram_id": 1}, dedupe_key="kick:1") is None
+    # no key, no dedupe
+    assert db.enqueue_outbox("message", {"chat_id": 1}) != db.enqueue_outbox("message", {"chat_id": 1})
+
+    assert db.claim_outbox(10, 60)[0]["id"] == first
+    assert db.enqueue_outbox("kick", {"telegram_id": 1}, dedupe_key="kick:1") is None
+
+    db.complete_outbox(first)
+    assert db.enqueue_outbox("kick", {"telegram_id": 1}, dedupe_key="kick:1") is not None
+
+
+def test_claim_leases_each_job_once(db):
+    ids = [db.enqueue_outbox("message", {"n": n}) for n in range(5)]
+    claimed = db.claim_outbox(3, 60)
+    assert [job["id"] for job in claimed] == ids[:3]
+    assert all(job["attempts"] == 1 for job in claimed)
+    assert claimed[0]["payload"] == {"n": 0}
+
+    rest = db.claim_outbox(10, 60)
+    assert [job["id"] for job in rest] == ids[3:]
+    assert db.claim_outbox(10, 60) == []
+
+
+def test_expired_lease_is_handed_out_again(db):
+    job_id = db.enqueue_outbox("message", {})
+    assert [job["id"] for job in db.claim_outbox(1, 0)] == [job_id]
+    time.sleep(0.01)
+    (again,) = db.claim_outbox(1, 60)
+    assert again["id"] == job_id
+    assert again["attempts"] == 2
+
+
+def test_delayed_and_retried_jobs_wait_for_run_at(db):
+    db.enqueue_outbox("message", {}, delay=60)
+    assert db.claim_outbox(10, 60) == []
+    assert db.outbox_next_run_at() == pytest.approx(time.time() + 60, abs=5)
+
+    job_id = db.enqueue_outbox("message", {})
+    db.claim_outbox(10, 60)
+    db.fail_outbox(job_id, "boom", retry_in=60)
+    assert _status(db, job_id) == ("pending", 1)
+    assert db.claim_outbox(10, 60) == []
+
+
+def test_dead_letter_and_requeue(db):
+    job_id = db.enqueue_outbox("message", {"chat_id": 1})
+    db.claim_outbox(1, 60)
+    db.fail_outbox(job_id, "Forbidden: bot was blocked")
+    assert _status(db, job_id) == ("dead", 1)
+    assert db.get_outbox_counts()["dead"] == 1
+    assert db.list_outbox(status="dead")[0]["last_error"] == "Forbidden: bot was blocked"
+
+    assert db.requeue_outbox(job_id) == (1, 0)
+    assert _status(db, job_id) == ("pending", 0)
+
+
+def test_requeue_skips_dead_jobs_whose_key_is_live(db):
+    old = db.enqueue_outbox("kick", {}, dedupe_key="kick:1")
+    db.claim_outbox(1, 60)
+    db.fail_outbox(old, "boom")
+    older = db.enqueue_outbox("kick", {}, dedupe_key="kick:1")
+    db.claim_outbox(1, 60)
+    db.fail_outbox(older, "boom")
+    live = db.enqueue_outbox("kick", {}, dedupe_key="kick:2")
+    stale = db.enqueue_outbox("kick", {}, dedupe_key="kick:2")
+    assert stale is None
+
+    # the newest dead kick:1 comes back, the other one has to stay dead
+    assert db.requeue_outbox() == (1, 1)
+    assert _status(db, older)[0] == "pending"
+    assert _status(db, old)[0] == "dead"
+    assert _status(db, live)[0] == "pending"
+
+
+def test_enqueue_rolls_back_with_the_transaction(db):
+    db.add_user(1)
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.update_user_fields(1, access_granted=1)
+            db.enqueue_outbox("message", {"chat_id": 1})
+            raise RuntimeError("handler failed")
+    assert db.get_outbox_counts()["pending"] == 0
+    assert db.get_user(1)["access_granted"] == 0
+
+
+def test_complete_queues_follow_ups_in_the_same_commit(db, raw):
+    job_id = db.enqueue_outbox("kick", {"telegram_id": 1})
+    db.claim_outbox(1, 60)
+    db.complete_outbox(job_id, [("message", {"chat_id": 1})])
+    rows = raw.execute("SELECT kind, status FROM outbox ORDER BY id").fetchall()
+    assert rows == [("kick", "done"), ("message", "pending")]
+
+
+def test_saved_payload_is_seen_by_the_retry(db):
+    job_id = db.enqueue_outbox("kick", {"telegram_id": 1})
+    (job,) = db.claim_outbox(1, 0)
+    job["payload"]["own_bans"] = [-100]
+    db.save_outbox_payload(job_id, job["payload"])
+    time.sleep(0.01)
+    (retry,) = db.claim_outbox(1, 60)
+    assert retry["payload"] == {"telegram_id": 1, "own_bans": [-100]}
+
+
+def test_live_dedupe_index_exists(db):
+    job_id = db.enqueue_outbox("kick", {}, dedupe_key="k")
+    with pytest.raises(sqlite3.IntegrityError):
+        db.cursor.execute(
+            "INSERT INTO outbox (kind, payload, run_at, dedupe_key) VALUES ('kick', '{}', 0, 'k')"
+        )
+    db.conn.rollback()
+    assert _status(db, job_id)[0] == "pending"
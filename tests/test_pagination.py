@@ -0,0 +1,68 @@
+def _all_pages(fetch, key):
+    pages = []
+    after = None
+    while True:
+        page = fetch(after)
+        pages.append(page[key])
+        after = page["next_after"]
+        if after is None:
+            return pages
+
+
+def test_list_users_pages_are_complete_without_duplicates(db):
+    for tg_id in range(1, 58):
+        db.add_user(tg_id)
+
+    pages = _all_pages(lambda after: db.list_users(after=after, limit=10), "users")
+    ids = [user["telegram_id"] for page in pages for user in page]
+    assert ids == list(range(1, 58))
+    assert [len(page) for page in pages] == [10, 10, 10, 10, 10, 7]
+
+
+def test_list_users_last_full_page_has_no_next_key(db):
+    for tg_id in range(1, 21):
+        db.add_user(tg_id)
+    pages = _all_pages(lambda after: db.list_users(after=after, limit=10), "users")
+    assert [len(page) for page in pages] == [10, 10]
+
+
+def test_list_users_search_pages_by_name_and_id(db):
+    names = ["alice", "Alex", "alina", "bob", "al_x", "AL%", "alice"]
+    for tg_id, name in enumerate(names, start=1):
+        db.add_user(tg_id)
+        db.update_user_fields(tg_id, user_name=name)
+
+    pages = _all_pages(lambda after: db.list_users(search="@al", after=after, limit=2), "users")
+    found = [(user["user_name"], user["telegram_id"]) for page in pages for user in page]
+    expected = sorted(
+        ((name, tg_id) for tg_id, name in enumerate(names, start=1) if name.lower().startswith("al")),
+        key=lambda item: (item[0].lower(), item[1]),
+    )
+    assert found == expected
+
+
+def test_list_users_pages_survive_inserts_between_pages(db):
+    for tg_id in range(1, 11):
+        db.add_user(tg_id)
+    first = db.list_users(limit=5)
+    db.add_user(100)
+    second = db.list_users(after=first["next_after"], limit=10)
+    ids = [user["telegram_id"] for user in first["users"] + second["users"]]
+    assert ids == [*range(1, 11), 100]
+
+
+def test_list_payments_newest_first_with_filters(db):
+    db.add_user(1)
+    db.add_user(2)
+    for n in range(25):
+        db.create_payment_entry(
+            telegram_id=1 + n % 2, method="cryptobot" if n % 3 else "usdt_trc20", amount=n, status="pending",
+        )
+
+    pages = _all_pages(lambda after: db.list_payments(after=after, limit=7), "payments")
+    ids = [payment["id"] for page in pages for payment in page]
+    assert ids == list(range(25, 0, -1))
+
+    pages = _all_pages(lambda after: db.list_payments(telegram_id=1, method="cryptobot", after=after, limit=3), "payments")
+    ids = [payment["id"] for page in pages for payment in page]
+    assert ids == [n + 1 for n in range(24, -1, -1) if n % 2 == 0 and n % 3]
@@ -0,0 +1,122 @@
+import random
+from collections import defaultdict
+
+from database.dates import payment_day
+
+METHODS = ["cryptobot", "usdt_trc20", "admin"]
+PLANS = ["one_month", "three_months", None]
+
+
+def _rollup(db):
+    return {
+        (row["day"], row["method"], row["plan"]): (row["payments"], round(row["amount"], 6))
+        for row in db.get_revenue_daily()
+    }
+
+
+def _expected(db):
+    totals = defaultdict(lambda: [0, 0.0])
+    for row in db.cursor.execute(
+        """
+        SELECT method, plan, amount, paid_at, tx_timestamp, updated_at, created_at
+        FROM payments WHERE lower(status) = 'paid'
+        """
+    ):
+        day = payment_day(row["paid_at"], row["tx_timestamp"], row["updated_at"], row["created_at"])
+        # revenue_daily keeps a missing plan as ''
+        key = (day, row["method"] or "", row["plan"] or "")
+        totals[key][0] += 1
+        totals[key][1] += row["amount"] or 0
+    return {key: (count, round(amount, 6)) for key, (count, amount) in totals.items()}
+
+
+def _pay(db, tg_id, day, amount, method="cryptobot", plan="one_month"):
+    payment_id = db.create_payment_entry(telegram_id=tg_id, method=method, amount=amount, plan=plan)
+    db.update_payment_entry(payment_id, status="paid", paid_at=f"{day} 12:00:00")
+    return payment_id
+
+
+def test_rollup_matches_paid_payments(db):
+    rng = random.Random(3)
+    db.add_user(1)
+    payments = []
+    for _ in range(300):
+        if payments and rng.random() < 0.4:
+            db.update_payment_entry(
+                rng.choice(payments),
+                status=rng.choice(["paid", "canceled", "pending", "PAID"]),
+                paid_at=f"2030-01-{rng.randrange(1, 29):02d} {rng.randrange(24):02d}:00:00",
+            )
+        else:
+            payments.append(db.create_payment_entry(
+                telegram_id=1, method=rng.choice(METHODS), plan=rng.choice(PLANS),
+                amount=rng.randrange(1, 200) / 4, status=rng.choice(["pending", "paid"]),
+            ))
+    assert _rollup(db) == _expected(db)
+
+
+def test_status_flip_removes_the_payment_from_its_day(db):
+    db.add_user(1)
+    first = _pay(db, 1, "2030-01-02", 50)
+    _pay(db, 1, "2030-01-02", 20)
+    assert _rollup(db) == {("2030-01-02", "cryptobot", "one_month"): (2, 70.0)}
+
+    db.update_payment_entry(first, status="canceled")
+    assert _rollup(db) == {("2030-01-02", "cryptobot", "one_month"): (1, 20.0)}
+
+    # moving the payment to another day moves its amount too
+    db.update_payment_entry(first, status="paid", paid_at="2030-01-03 09:00:00")
+    assert _rollup(db) == {
+        ("2030-01-02", "cryptobot", "one_month"): (1, 20.0),
+        ("2030-01-03", "cryptobot", "one_month"): (1, 50.0),
+    }
+
+
+def test_redating_a_paid_payment_moves_it(db):
+    db.add_user(1)
+    payment_id = _pay(db, 1, "2030-01-02", 50)
+    db.update_payment_entry(payment_id, paid_at="2030-01-04 08:00:00")
+    assert _rollup(db) == {("2030-01-04", "cryptobot", "one_month"): (1, 50.0)}
+
+    db.update_payment_entry(payment_id, status="paid", tx_timestamp="2030-01-01 00:00:00", paid_at="2030-01-05 08:00:00")
+    assert _rollup(db) == {("2030-01-05", "cryptobot", "one_month"): (1, 50.0)}
+
+
+def test_rebuild_repairs_a_drifted_rollup(db):
+    db.add_user(1)
+    _pay(db, 1, "2030-01-02", 50)
+    _pay(db, 1, "2030-01-05", 30, method="usdt_trc20")
+    expected = _rollup(db)
+
+    db.cursor.execute("UPDATE revenue_daily SET payments = payments + 3, amount = 999 WHERE day = '2030-01-02'")
+    db.cursor.execute("DELETE FROM revenue_daily WHERE day = '2030-01-05'")
+    db.cursor.execute(
+        "INSERT INTO revenue_daily (day, method, plan, payments, amount) VALUES ('2029-12-31', 'admin', '', 4, 10)"
+    )
+    db.conn.commit()
+    assert _rollup(db) != expected
+
+    assert db.rebuild_revenue_daily() == 2
+    assert _rollup(db) == expected
+    assert db.rebuild_revenue_daily() == 2
+    assert _rollup(db) == expected
+
+
+def test_archived_payments_keep_counting(tmp_path, db):
+    db.add_user(1)
+    old = _pay(db, 1, "2029-06-01", 40)
+    _pay(db, 1, "2030-01-02", 10)
+    db.cursor.execute("UPDATE payments SET created_at = datetime('now', '-400 days') WHERE id = ?", (old,))
+    db.conn.commit()
+    expected = _rollup(db)
+
+    archive_file = tmp_path / "archive.sqlite"
+    assert db.archive_payments(archive_file, older_than_days=365, batch_size=1) == 1
+    assert db.cursor.execute("SELECT COUNT(*) FROM payments").fetchone()[0] == 1
+    assert _rollup(db) == expected
+
+    assert db.rebuild_revenue_daily(archive_file) == 2
+    assert _rollup(db) == expected
+    # without the archive only the live payment is left
+    assert db.rebuild_revenue_daily() == 1
+    assert _rollup(db) == {("2030-01-02", "cryptobot", "one_month"): (1, 10.0)}
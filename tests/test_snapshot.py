@@ -0,0 +1,76 @@
+import json
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from database import Database
+
+NOW = datetime(2030, 1, 15, 12, 0, 30).timestamp()
+
+
+@pytest.fixture(autouse=True)
+def frozen_time(monkeypatch):
+    # the body depends on the minute, keep every call inside the same one
+    monkeypatch.setattr(time, "time", lambda: NOW)
+
+
+def _fill(db):
+    end = (datetime.fromtimestamp(NOW) + timedelta(days=3)).strftime("%Y-%m-%d %H:%M:%S.%f")
+    for tg_id in (1, 2):
+        db.add_user(tg_id)
+        db.update_user_fields(tg_id, subscription_end=end, access_granted=1)
+    db.add_channel("VIP", -100)
+    db.add_subscription_plan(1, "VIP")
+    payment_id = db.create_payment_entry(telegram_id=1, method="cryptobot", amount=50, plan="one_month")
+    db.update_payment_entry(payment_id, status="paid", paid_at="2030-01-10 10:00:00")
+
+
+def test_etag_is_stable_without_changes(db):
+    _fill(db)
+    etag, body = db.get_dashboard_snapshot_json()
+    assert db.get_dashboard_snapshot_json() == (etag, body)
+    assert json.loads(body)["stats"] == json.loads(json.dumps(db.get_dashboard_snapshot()["stats"]))
+
+
+def test_etag_changes_after_a_write(db):
+    _fill(db)
+    etag, _ = db.get_dashboard_snapshot_json()
+    db.update_user_fields(2, first_name="Bob")
+    changed, _ = db.get_dashboard_snapshot_json()
+    assert changed != etag
+    assert db.get_dashboard_snapshot_json()[0] == changed
+
+
+def test_etag_changes_after_a_write_from_another_connection(db, raw):
+    _fill(db)
+    etag, _ = db.get_dashboard_snapshot_json()
+    raw.execute("UPDATE users SET first_name = 'Ann' WHERE telegram_id = 1")
+    raw.commit()
+    assert db.get_dashboard_snapshot_json()[0] != etag
+
+
+def test_etag_is_the_same_for_a_new_connection(tmp_path, db):
+    _fill(db)
+    etag, body = db.get_dashboard_snapshot_json()
+    other = Database(tmp_path / "db.sqlite")
+    try:
+        assert other.get_dashboard_snapshot_json() == (etag, body)
+    finally:
+        other.close()
+
+
+def test_etag_follows_queued_writes(tmp_path):
+    db = Database(tmp_path / "db.sqlite", group_commit_max=100)
+    try:
+        _fill(db)
+        db.flush()
+        etag, _ = db.get_dashboard_snapshot_json()
+        db.update_user_fields(2, first_name="Bob")
+        # the queued write is visible to the writer, so the snapshot follows it
+        queued, _ = db.get_dashboard_snapshot_json()
+        assert queued != etag
+        db.flush()
+        assert db.get_dashboard_snapshot_json()[0] == queued
+    finally:
+        db.close()